@@ -3,25 +3,33 @@ Steganography API Routes
 """
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import StreamingResponse
-import tempfile
+from typing import List
 import os
+import io
 import base64
 import json
 import asyncio
+import zipfile
 from app.core.steganography import LSB_Stego
-from app.core.utils import calculate_psnr, calculate_ssim
-import cv2
+from app.core.sharding import ShardedStego
+from app.core.utils import calculate_quality_metrics, encode_image, load_image
 
 router = APIRouter()
 
 @router.post("/embed")
 async def embed_message(
     cover_image: UploadFile = File(...),
-    message: str = Form(...),
+    message: str = Form(None),
+    attachment: UploadFile = File(None),
     use_encryption: bool = Form(False),
-    password: str = Form(None)
+    password: str = Form(None),
+    bits_per_channel: int = Form(1),
+    use_compression: bool = Form(False),
+    use_adaptive: bool = Form(False),
+    metrics: str = Form('psnr,ssim'),
+    fast_ssim: bool = Form(False)
 ):
-    """Embed text message into image with progress streaming"""
+    """Embed text message or file attachment into image with progress streaming (metrics: quality metrics to report)"""
     
     async def generate():
         try:
@@ -29,12 +37,14 @@ async def embed_message(
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': 'Đang tải ảnh lên...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            temp_dir = tempfile.mkdtemp()
-            cover_path = os.path.join(temp_dir, "cover.png")
-            stego_path = os.path.join(temp_dir, "stego.png")
+            # Ảnh giữ trong bộ nhớ: decode 1 lần, encode 1 lần (không qua file tạm)
+            cover_bytes = await cover_image.read()
             
-            with open(cover_path, "wb") as f:
-                f.write(await cover_image.read())
+            # File đính kèm được nhúng dạng raw bytes, text dạng UTF-8
+            secret = await attachment.read() if attachment else message
+            if not secret:
+                yield f"data: {json.dumps({'stage': 'error', 'message': 'Vui lòng nhập tin nhắn hoặc chọn file cần giấu.'})}\n\n"
+                return
             
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong ảnh'})}\n\n"
             await asyncio.sleep(0.1)
@@ -43,7 +53,7 @@ async def embed_message(
             yield f"data: {json.dumps({'stage': 'validate', 'progress': 0, 'message': 'Đang kiểm tra ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            cover_img = cv2.imread(cover_path)
+            cover_img = load_image(cover_bytes)
             if cover_img is None:
                 yield f"data: {json.dumps({'stage': 'error', 'message': 'Không thể đọc ảnh. Vui lòng kiểm tra định dạng file (PNG, BMP, JPG).'})}\n\n"
                 return
@@ -55,8 +65,15 @@ async def embed_message(
             yield f"data: {json.dumps({'stage': 'embedding', 'progress': 0, 'message': 'Đang nhúng tin nhắn...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            stego = LSB_Stego(use_encryption=use_encryption, password=password)
-            result = stego.embed(cover_path, message, stego_path)
+            stego = LSB_Stego(
+                use_encryption=use_encryption,
+                password=password,
+                use_adaptive=use_adaptive,
+                bits_per_channel=bits_per_channel,
+                use_compression=use_compression
+            )
+            # Nhúng trên bản sao trong bộ nhớ: ảnh gốc giữ lại để tính metrics (không đọc lại file)
+            stego_img, result = stego.embed_array(cover_img, secret)
             
             yield f"data: {json.dumps({'stage': 'embedding', 'progress': 100, 'message': 'Đã nhúng xong tin nhắn'})}\n\n"
             await asyncio.sleep(0.1)
@@ -65,10 +82,7 @@ async def embed_message(
             yield f"data: {json.dumps({'stage': 'metrics', 'progress': 0, 'message': 'Đang tính chất lượng...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            original_img = cv2.imread(cover_path)
-            stego_img = cv2.imread(stego_path)
-            psnr = calculate_psnr(original_img, stego_img)
-            ssim = calculate_ssim(original_img, stego_img)
+            quality = calculate_quality_metrics(cover_img, stego_img, metrics, fast_ssim)
             
             yield f"data: {json.dumps({'stage': 'metrics', 'progress': 100, 'message': 'Đã tính xong metrics'})}\n\n"
             await asyncio.sleep(0.1)
@@ -77,20 +91,23 @@ async def embed_message(
             yield f"data: {json.dumps({'stage': 'encoding', 'progress': 0, 'message': 'Đang mã hóa ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            with open(stego_path, "rb") as f:
-                stego_bytes = f.read()
-                stego_base64 = base64.b64encode(stego_bytes).decode('utf-8')
+            # PNG để tránh mất dữ liệu do compression (như LSB_Stego.embed)
+            stego_base64 = base64.b64encode(encode_image(stego_img, '.png')).decode('utf-8')
             
             # Hoàn thành - Gửi result nhỏ gọn, ảnh sẽ gửi riêng
             final_result = {
                 "success": True,
                 "message_length": result['message_length'],
+                "payload_bytes": result['payload_bytes'],
+                "is_file": result['is_file'],
+                "compression": result['compression'],
                 "bits_used": result['bits_used'],
                 "capacity": result['capacity'],
                 "usage_percent": result['usage_percent'],
                 "encrypted": result['encrypted'],
-                "psnr": float(psnr),
-                "ssim": float(ssim),
+                "algorithm": result['algorithm'],
+                "bits_per_channel": result['bits_per_channel'],
+                **{name: float(value) for name, value in quality.items()},
                 "stego_image": f"data:image/png;base64,{stego_base64}"
             }
             
@@ -103,7 +120,7 @@ async def embed_message(
             }, ensure_ascii=False)
             
             yield f"data: {result_json}\n\n"
-            
+        
         except Exception as e:
             yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
     
@@ -113,9 +130,10 @@ async def embed_message(
 async def extract_message(
     stego_image: UploadFile = File(...),
     use_decryption: bool = Form(False),
-    password: str = Form(None)
+    password: str = Form(None),
+    auto_detect: bool = Form(True)
 ):
-    """Extract hidden message from stego image with progress streaming"""
+    """Extract hidden message from stego image with progress streaming (auto-detects the embedding mode)"""
     
     async def generate():
         try:
@@ -123,11 +141,7 @@ async def extract_message(
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': 'Đang tải ảnh lên...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            temp_dir = tempfile.mkdtemp()
-            stego_path = os.path.join(temp_dir, "stego.png")
-            
-            with open(stego_path, "wb") as f:
-                f.write(await stego_image.read())
+            stego_bytes = await stego_image.read()
             
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong ảnh'})}\n\n"
             await asyncio.sleep(0.1)
@@ -136,7 +150,7 @@ async def extract_message(
             yield f"data: {json.dumps({'stage': 'validate', 'progress': 0, 'message': 'Đang kiểm tra ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            stego_img = cv2.imread(stego_path)
+            stego_img = load_image(stego_bytes)
             if stego_img is None:
                 yield f"data: {json.dumps({'stage': 'error', 'message': 'Không thể đọc ảnh stego. Vui lòng kiểm tra định dạng file (PNG, BMP).'})}\n\n"
                 return
@@ -149,12 +163,197 @@ async def extract_message(
             await asyncio.sleep(0.1)
             
             stego = LSB_Stego(use_encryption=use_decryption, password=password)
-            message = stego.extract(stego_path)
+            detection = {}
+            if auto_detect:
+                # Thử lần lượt Standard / Pseudorandom / Adaptive trên 1 lần đọc ảnh
+                detection = stego.extract_auto_array(stego_img)
+                message = detection.pop('message')
+            else:
+                message = stego.extract_array(stego_img)
+            
+            # Hoàn thành - file đính kèm trả về dạng base64
+            if isinstance(message, bytes):
+                final_result = {
+                    "message": None,
+                    "file": base64.b64encode(message).decode('utf-8'),
+                    "length": len(message)
+                }
+            else:
+                final_result = {"message": message, "length": len(message)}
+            final_result.update(detection)
+            result_json = json.dumps({
+                'stage': 'complete',
+                'progress': 100,
+                'message': 'Hoàn thành!',
+                'result': final_result
+            }, ensure_ascii=False)
+            
+            yield f"data: {result_json}\n\n"
+        
+        except Exception as e:
+            yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
+    
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+@router.post("/capacity")
+async def capacity_preflight(
+    cover_image: UploadFile = File(...),
+    payload_bytes: int = Form(None),
+    use_encryption: bool = Form(False),
+    include_adaptive: bool = Form(True),
+    measure_psnr: bool = Form(False)
+):
+    """
+    Per-mode capacity of a cover image before embedding (adaptive analysis is cached for the next embed)
+    
+    bits_per_channel lists capacity and estimated PSNR for k = 1..4; with payload_bytes and
+    measure_psnr, a random payload of that size is also trial-embedded per k ('measured').
+    """
+    # Ảnh giữ trong bộ nhớ: chỉ đọc header (PIL) và decode khi cần edge map / nhúng thử
+    cover_data = await cover_image.read()
+    
+    try:
+        # Chỉ cần biết overhead mã hóa, không mã hóa thật
+        stego = LSB_Stego(use_encryption=use_encryption, password="preflight" if use_encryption else None)
+        loop = asyncio.get_running_loop()
+        report = await loop.run_in_executor(
+            None, stego.analyze_capacity, cover_data, include_adaptive, payload_bytes
+        )
+        
+        # PSNR đo thật: nhúng thử payload ngẫu nhiên (không nén được, trường hợp xấu nhất) với từng k
+        if measure_psnr and payload_bytes:
+            report['measured'] = await loop.run_in_executor(
+                None, stego.compare_bits_per_channel, cover_data, os.urandom(payload_bytes)
+            )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return report
+
+@router.post("/embed-sharded")
+async def embed_sharded(
+    cover_images: List[UploadFile] = File(...),
+    message: str = Form(None),
+    attachment: UploadFile = File(None),
+    parity_shards: int = Form(0),
+    use_encryption: bool = Form(False),
+    password: str = Form(None),
+    bits_per_channel: int = Form(1),
+    use_compression: bool = Form(False)
+):
+    """
+    Split a large payload across many cover images, return a zip of stego images
+    
+    Shards are equal-sized: the largest payload is (covers - parity_shards) x the capacity
+    of the smallest cover, not the sum of all capacities.
+    """
+    
+    async def generate():
+        try:
+            # Bước 1: Upload
+            yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': f'Đang tải {len(cover_images)} ảnh lên...'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            # Ảnh giữ trong bộ nhớ (không qua file tạm), mỗi worker decode / encode 1 ảnh
+            covers = [await cover_image.read() for cover_image in cover_images]
+            
+            secret = await attachment.read() if attachment else message
+            if not secret:
+                yield f"data: {json.dumps({'stage': 'error', 'message': 'Vui lòng nhập tin nhắn hoặc chọn file cần giấu.'})}\n\n"
+                return
             
-            # Hoàn thành
-            final_result = {"message": message, "length": len(message)}
-            yield f"data: {json.dumps({'stage': 'complete', 'progress': 100, 'message': 'Hoàn thành!', 'result': final_result})}\n\n"
+            yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong ảnh'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            # Bước 2: Nhúng song song vào các ảnh
+            yield f"data: {json.dumps({'stage': 'embedding', 'progress': 0, 'message': 'Đang chia và nhúng payload vào các ảnh...'})}\n\n"
+            await asyncio.sleep(0.1)
             
+            sharded = ShardedStego(
+                use_encryption=use_encryption,
+                password=password,
+                bits_per_channel=bits_per_channel,
+                use_compression=use_compression,
+                parity_shards=parity_shards
+            )
+            loop = asyncio.get_running_loop()
+            stego_images, result = await loop.run_in_executor(None, sharded.embed_bytes, covers, secret)
+            
+            yield f"data: {json.dumps({'stage': 'embedding', 'progress': 100, 'message': 'Đã nhúng xong'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            # Bước 3: Đóng gói zip
+            yield f"data: {json.dumps({'stage': 'encoding', 'progress': 0, 'message': 'Đang đóng gói ảnh...'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            zip_buffer = io.BytesIO()
+            with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as archive:
+                for index, stego_png in enumerate(stego_images):
+                    archive.writestr(f"stego_{index:03d}.png", stego_png)
+            zip_base64 = base64.b64encode(zip_buffer.getvalue()).decode('utf-8')
+            
+            result.pop('shards')
+            result['stego_zip'] = f"data:application/zip;base64,{zip_base64}"
+            
+            result_json = json.dumps({
+                'stage': 'complete',
+                'progress': 100,
+                'message': 'Hoàn thành!',
+                'result': result
+            }, ensure_ascii=False)
+            
+            yield f"data: {result_json}\n\n"
+        
+        except Exception as e:
+            yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
+    
+    return StreamingResponse(generate(), media_type="text/event-stream")
+
+@router.post("/extract-sharded")
+async def extract_sharded(
+    stego_images: List[UploadFile] = File(...),
+    use_decryption: bool = Form(False),
+    password: str = Form(None)
+):
+    """Reassemble a payload split across many stego images"""
+    
+    async def generate():
+        try:
+            # Bước 1: Upload
+            yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': f'Đang tải {len(stego_images)} ảnh lên...'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            stego_data = [await stego_image.read() for stego_image in stego_images]
+            
+            yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong ảnh'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            # Bước 2: Trích xuất song song
+            yield f"data: {json.dumps({'stage': 'extracting', 'progress': 0, 'message': 'Đang trích xuất các shards...'})}\n\n"
+            await asyncio.sleep(0.1)
+            
+            sharded = ShardedStego(use_encryption=use_decryption, password=password)
+            loop = asyncio.get_running_loop()
+            message = await loop.run_in_executor(None, sharded.extract, stego_data)
+            
+            # Hoàn thành - file đính kèm trả về dạng base64
+            if isinstance(message, bytes):
+                final_result = {
+                    "message": None,
+                    "file": base64.b64encode(message).decode('utf-8'),
+                    "length": len(message)
+                }
+            else:
+                final_result = {"message": message, "length": len(message)}
+            result_json = json.dumps({
+                'stage': 'complete',
+                'progress': 100,
+                'message': 'Hoàn thành!',
+                'result': final_result
+            }, ensure_ascii=False)
+            
+            yield f"data: {result_json}\n\n"
+        
         except Exception as e:
             yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
     
@@ -11,6 +11,8 @@ import json
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 from app.core.video_proc import VideoWatermark
+from app.core.reference import WatermarkReference, require_reference_key
+from app.core.utils import encode_image
 
 router = APIRouter()
 
@@ -25,10 +27,12 @@ async def embed_video_watermark(
     frame_skip: int = Form(5),
     arnold_iterations: int = Form(10),
     use_scene_detection: bool = Form(True),
-    scene_threshold: float = Form(30.0)
+    scene_threshold: float = Form(30.0),
+    with_reference: bool = Form(False),
+    frame_metrics: bool = Form(False)
 ):
     """
-    Embed watermark into video with progress streaming
+    Embed watermark into video with progress streaming (frame_metrics: average PSNR / SSIM of key frames)
     
     CHUẨN HỌC THUẬT:
     - Scene Change Detection: Phát hiện thay đổi cảnh bằng histogram difference
@@ -38,6 +42,10 @@ async def embed_video_watermark(
     
     async def generate():
         try:
+            # Bản ghi tham chiếu cần khóa ký cố định: báo lỗi trước khi xử lý video
+            if with_reference:
+                require_reference_key()
+            
             # Bước 1: Lưu files
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': 'Đang tải files lên...'})}\n\n"
             await asyncio.sleep(0.1)
@@ -95,7 +103,9 @@ async def embed_video_watermark(
                 video_path,
                 wm_path,
                 output_path,
-                progress_callback
+                progress_callback,
+                with_reference,
+                frame_metrics
             )
             
             # Stream progress while processing
@@ -130,6 +140,14 @@ async def embed_video_watermark(
             # Bước 5: Hoàn thành - Sử dụng ensure_ascii=False
             result['watermarked_video'] = f"data:video/mp4;base64,{video_base64}"
             
+            # Bản ghi tham chiếu đã ký: dùng thay cho video gốc khi trích xuất
+            if with_reference:
+                reference = result.pop('reference')
+                if reference is not None:
+                    reference_bytes = reference.to_bytes()
+                    result['reference'] = f"data:application/octet-stream;base64,{base64.b64encode(reference_bytes).decode('utf-8')}"
+                    result['reference_bytes'] = len(reference_bytes)
+            
             result_json = json.dumps({
                 'stage': 'complete', 
                 'progress': 100, 
@@ -138,7 +156,7 @@ async def embed_video_watermark(
             }, ensure_ascii=False)
             
             yield f"data: {result_json}\n\n"
-            
+        
         except Exception as e:
             yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
     
@@ -147,12 +165,13 @@ async def embed_video_watermark(
 @router.post("/extract")
 async def extract_video_watermark(
     watermarked_video: UploadFile = File(...),
-    original_video: UploadFile = File(...),
+    original_video: UploadFile = File(None),
     frame_number: int = Form(0),
     watermark_size: int = Form(64),
-    arnold_iterations: int = Form(10)
+    arnold_iterations: int = Form(10),
+    reference: UploadFile = File(None)
 ):
-    """Extract watermark from a specific frame of video with progress streaming"""
+    """Extract watermark from a specific frame of video, using either the original video or a reference record"""
     
     async def generate():
         try:
@@ -166,8 +185,18 @@ async def extract_video_watermark(
             
             with open(watermarked_path, "wb") as f:
                 f.write(await watermarked_video.read())
-            with open(original_path, "wb") as f:
-                f.write(await original_video.read())
+            
+            # Bản ghi tham chiếu thay cho video gốc (không cần upload / decode video gốc)
+            wm_reference = None
+            if reference:
+                wm_reference = WatermarkReference.from_bytes(await reference.read())
+                original_path = None
+            elif original_video:
+                with open(original_path, "wb") as f:
+                    f.write(await original_video.read())
+            else:
+                yield f"data: {json.dumps({'stage': 'error', 'message': 'Vui lòng tải lên video gốc hoặc bản ghi tham chiếu.'})}\n\n"
+                return
             
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong video'})}\n\n"
             await asyncio.sleep(0.1)
@@ -177,15 +206,17 @@ async def extract_video_watermark(
             await asyncio.sleep(0.1)
             
             cap_wm = cv2.VideoCapture(watermarked_path)
-            cap_orig = cv2.VideoCapture(original_path)
+            opened = cap_wm.isOpened()
+            cap_wm.release()
+            if original_path:
+                cap_orig = cv2.VideoCapture(original_path)
+                opened = opened and cap_orig.isOpened()
+                cap_orig.release()
             
-            if not cap_wm.isOpened() or not cap_orig.isOpened():
+            if not opened:
                 yield f"data: {json.dumps({'stage': 'error', 'message': 'Không thể mở video. Vui lòng kiểm tra định dạng file.'})}\n\n"
                 return
             
-            cap_wm.release()
-            cap_orig.release()
-            
             yield f"data: {json.dumps({'stage': 'validate', 'progress': 100, 'message': 'Video hợp lệ'})}\n\n"
             await asyncio.sleep(0.1)
             
@@ -198,8 +229,10 @@ async def extract_video_watermark(
                 watermarked_path, 
                 original_path, 
                 frame_number, 
-                watermark_size
+                watermark_size,
+                reference=wm_reference
             )
+            extracted_size = wm_reference.watermark_size if wm_reference is not None else watermark_size
             
             yield f"data: {json.dumps({'stage': 'extracting', 'progress': 100, 'message': 'Đã trích xuất xong'})}\n\n"
             await asyncio.sleep(0.1)
@@ -208,18 +241,13 @@ async def extract_video_watermark(
             yield f"data: {json.dumps({'stage': 'encoding', 'progress': 0, 'message': 'Đang mã hóa watermark...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            extracted_path = os.path.join(temp_dir, "extracted.png")
-            cv2.imwrite(extracted_path, extracted)
-            
-            with open(extracted_path, "rb") as f:
-                img_data = f.read()
-                img_base64 = base64.b64encode(img_data).decode('utf-8')
+            img_base64 = base64.b64encode(encode_image(extracted, '.png')).decode('utf-8')
             
             result = {
                 'success': True,
                 'extracted_watermark': f"data:image/png;base64,{img_base64}",
                 'frame_number': frame_number,
-                'watermark_size': watermark_size
+                'watermark_size': extracted_size
             }
             
             # Hoàn thành - Sử dụng ensure_ascii=False
@@ -231,7 +259,7 @@ async def extract_video_watermark(
             }, ensure_ascii=False)
             
             yield f"data: {result_json}\n\n"
-            
+        
         except Exception as e:
             yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
     
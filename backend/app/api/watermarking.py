@@ -3,41 +3,125 @@ Watermarking API Routes
 """
 from fastapi import APIRouter, UploadFile, File, Form, HTTPException
 from fastapi.responses import StreamingResponse
+from typing import List, Optional
 import tempfile
 import os
+import shutil
 import base64
 import json
 import asyncio
-from app.core.watermarking import DWT_DCT_SVD_Watermark
-from app.core.utils import calculate_psnr, calculate_ssim, calculate_nc
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark, compare_watermark_modes, \
+    prepared_watermark_cache
+from app.core.parallel_watermarking import ParallelWatermark
+from app.core.fingerprinting import FingerprintFanout, recipient_file_stem
+from app.core.robustness import run_robustness_benchmark
+from app.core.reference import WatermarkReference, require_reference_key
+from app.core.utils import calculate_nc, decode_image, encode_image, inspect_image, load_image, QUALITY_METRICS
 import cv2
+import numpy as np
 
 router = APIRouter()
 
+# Thuật toán chọn được qua API: 'svd' = S'[0] = S[0] * (1 ± alpha) (cần ảnh gốc), 'qim' = QIM (mù)
+ALGORITHMS = ('svd', 'qim')
+
+# Khối đọc file upload / ảnh đích (bội số của 3 để base64 từng khối nối lại đúng)
+UPLOAD_CHUNK_SIZE = 3 << 20
+
+# MIME type của ảnh đích tiled theo phần mở rộng
+OUTPUT_MIME_TYPES = {'.tif': 'image/tiff', '.tiff': 'image/tiff', '.npy': 'application/octet-stream'}
+
+
+def _stream_file_event(event, key, path):
+    """
+    Sự kiện SSE với event['result'][key] = data URL của file, mã hóa base64 theo từng khối
+    
+    Chỉ giữ một khối UPLOAD_CHUNK_SIZE trong bộ nhớ thay vì cả ảnh đích (ảnh tiled rất lớn).
+    """
+    placeholder = f"@@{key}@@"
+    event['result'][key] = placeholder
+    prefix, suffix = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".split(placeholder, 1)
+    mime_type = OUTPUT_MIME_TYPES.get(os.path.splitext(path)[1].lower(), 'image/png')
+    yield f"{prefix}data:{mime_type};base64,"
+    with open(path, "rb") as f:
+        while chunk := f.read(UPLOAD_CHUNK_SIZE):
+            yield base64.b64encode(chunk).decode('utf-8')
+    yield suffix
+
+
+def _cap_workers(workers):
+    """Số process của 1 request, tối đa số CPU (các request dùng chung 1 process pool)"""
+    if workers is None:
+        return None
+    return max(1, min(workers, os.cpu_count() or 1))
+
+
+def _make_watermarker(algorithm, alpha, quantization_step, arnold_iterations, metrics=QUALITY_METRICS, fast_ssim=False):
+    """Tạo watermarker theo thuật toán được chọn (metrics: quality metrics tính sau khi nhúng)"""
+    if algorithm == 'qim':
+        return DWT_DCT_SVD_QIM_Watermark(quantization_step=quantization_step, arnold_iterations=arnold_iterations,
+                                         use_dwt=True, wavelet='haar', metrics=metrics, fast_ssim=fast_ssim)
+    if algorithm == 'svd':
+        return DWT_DCT_SVD_Watermark(alpha=alpha, arnold_iterations=arnold_iterations, use_dwt=True, wavelet='haar',
+                                     metrics=metrics, fast_ssim=fast_ssim)
+    raise ValueError(f"Unknown algorithm: {algorithm} (expected one of {', '.join(ALGORITHMS)})")
+
 @router.post("/embed")
 async def embed_watermark(
     host_image: UploadFile = File(...),
     watermark_image: UploadFile = File(...),
     alpha: float = Form(0.1),
-    arnold_iterations: int = Form(10)
+    arnold_iterations: int = Form(10),
+    with_reference: bool = Form(False),
+    algorithm: str = Form('svd'),
+    quantization_step: float = Form(120.0),
+    compare_modes: bool = Form(False),
+    tiled: bool = Form(False),
+    workers: int = Form(1),
+    target_psnr: Optional[float] = Form(None),
+    target_ssim: Optional[float] = Form(None),
+    metrics: str = Form(','.join(QUALITY_METRICS)),
+    fast_ssim: bool = Form(False)
 ):
-    """Embed watermark into host image with progress streaming"""
+    """
+    Embed watermark with progress streaming (optionally emit a signed reference record, or pick alpha for a target PSNR / SSIM)
+    
+    Chế độ nhúng: target_psnr / target_ssim (chọn alpha), tiled (ảnh rất lớn) và workers > 1
+    (song song) loại trừ nhau - target_psnr / target_ssim kèm tiled hoặc workers > 1 trả về lỗi.
+    """
     
     async def generate():
+        temp_dir = None
         try:
+            # Bản ghi tham chiếu cần khóa ký cố định: báo lỗi trước khi nhúng
+            if with_reference:
+                require_reference_key()
+            
+            # Alpha tự động dùng phân rã cache của FingerprintFanout trên ảnh đầy đủ (tuần tự):
+            # không kết hợp được với tiled / workers
+            if (target_psnr is not None or target_ssim is not None) and (tiled or workers > 1):
+                yield f"data: {json.dumps({'stage': 'error', 'message': 'target_psnr / target_ssim không dùng được cùng tiled hoặc workers > 1'})}\n\n"
+                return
+            
             # Bước 1: Upload
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': 'Đang tải ảnh lên...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            temp_dir = tempfile.mkdtemp()
-            host_path = os.path.join(temp_dir, "host.png")
-            wm_path = os.path.join(temp_dir, "watermark.png")
-            output_path = os.path.join(temp_dir, "watermarked.png")
-            
-            with open(host_path, "wb") as f:
-                f.write(await host_image.read())
-            with open(wm_path, "wb") as f:
-                f.write(await watermark_image.read())
+            # Ảnh giữ trong bộ nhớ: decode 1 lần, encode 1 lần (không qua file tạm)
+            # Tiled mode: ảnh gốc ghi thẳng ra file (giữ phần mở rộng thật để memory-map được)
+            if tiled:
+                if compare_modes:
+                    yield f"data: {json.dumps({'stage': 'error', 'message': 'compare_modes cần decode cả ảnh, không dùng được với tiled'})}\n\n"
+                    return
+                temp_dir = tempfile.mkdtemp()
+                extension = os.path.splitext(host_image.filename or '')[1].lower() or '.png'
+                host_path = os.path.join(temp_dir, f"host{extension}")
+                with open(host_path, "wb") as f:
+                    while chunk := await host_image.read(UPLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+            else:
+                host_bytes = await host_image.read()
+            wm_bytes = await watermark_image.read()
             
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong ảnh'})}\n\n"
             await asyncio.sleep(0.1)
@@ -46,10 +130,12 @@ async def embed_watermark(
             yield f"data: {json.dumps({'stage': 'validate', 'progress': 0, 'message': 'Đang kiểm tra ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            host_img = cv2.imread(host_path)
-            wm_img = cv2.imread(wm_path)
+            # Tiled mode chỉ đọc header ảnh gốc (không decode pixel)
+            host_info = inspect_image(host_path) if tiled else None
+            host_img = None if tiled else load_image(host_bytes)
+            wm_img = load_image(wm_bytes)
             
-            if host_img is None:
+            if host_img is None and host_info is None:
                 yield f"data: {json.dumps({'stage': 'error', 'message': 'Không thể đọc ảnh gốc. Vui lòng kiểm tra định dạng file.'})}\n\n"
                 return
             if wm_img is None:
@@ -60,11 +146,46 @@ async def embed_watermark(
             await asyncio.sleep(0.1)
             
             # Bước 3: Nhúng watermark
-            yield f"data: {json.dumps({'stage': 'embedding', 'progress': 0, 'message': 'Đang nhúng watermark bằng DWT-DCT-SVD...'})}\n\n"
+            yield f"data: {json.dumps({'stage': 'embedding', 'progress': 0, 'message': f'Đang nhúng watermark bằng DWT-DCT-SVD ({algorithm.upper()})...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            watermarker = DWT_DCT_SVD_Watermark(alpha=alpha, arnold_iterations=arnold_iterations, use_dwt=True, wavelet='haar')
-            result = watermarker.embed(host_path, wm_path, output_path)
+            watermarker = _make_watermarker(algorithm, alpha, quantization_step, arnold_iterations, metrics, fast_ssim)
+            # Alpha tự động: chia đôi alpha trên phân rã đã cache đến khi đạt PSNR / SSIM mục tiêu
+            # Tiled mode: chỉ biến đổi các tiles chứa watermark (ảnh rất lớn, cần file để memory-map)
+            # workers > 1: chia lưới block cho nhiều process (shared memory)
+            if target_psnr is not None or target_ssim is not None:
+                fanout = FingerprintFanout(host_img, watermarker)
+                watermarked_bgr, result = fanout.search_alpha(wm_img, target_psnr=target_psnr, target_ssim=target_ssim)
+                if with_reference:
+                    result['reference'] = fanout.reference(alpha=result['alpha'])
+            elif tiled:
+                # Ảnh đích cùng định dạng memory-mapped với ảnh gốc (ghi từng tile qua create_image_memmap);
+                # định dạng không memory-map được bị decode cả ảnh -> cảnh báo, ảnh đích là PNG
+                memory_mapped = host_info[2]
+                output_extension = extension if memory_mapped else '.png'
+                wm_path = os.path.join(temp_dir, "watermark.png")
+                output_path = os.path.join(temp_dir, f"watermarked{output_extension}")
+                with open(wm_path, "wb") as f:
+                    f.write(wm_bytes)
+                
+                result = watermarker.embed_tiled(host_path, wm_path, output_path, with_reference=with_reference)
+                result['memory_mapped'] = memory_mapped
+                if not memory_mapped:
+                    result['warning'] = (f"Định dạng {extension} không memory-map được: ảnh gốc đã được decode toàn bộ. "
+                                         f"Dùng .npy hoặc TIFF không nén cho ảnh rất lớn.")
+            elif workers > 1:
+                watermarked_bgr, result = ParallelWatermark(watermarker, max_workers=_cap_workers(workers)).embed_array(
+                    host_img, wm_img, with_reference=with_reference
+                )
+            else:
+                watermarked_bgr, result = watermarker.embed_array(host_img, wm_img, with_reference=with_reference)
+            
+            # So sánh PSNR / NC của mode SVD và QIM trên cùng ảnh (parity report)
+            if compare_modes:
+                result['parity'] = compare_watermark_modes(
+                    host_img, wm_img, alpha=alpha, quantization_step=quantization_step,
+                    arnold_iterations=arnold_iterations
+                )
             
             yield f"data: {json.dumps({'stage': 'embedding', 'progress': 100, 'message': 'Đã nhúng xong watermark'})}\n\n"
             await asyncio.sleep(0.1)
@@ -73,36 +194,54 @@ async def embed_watermark(
             yield f"data: {json.dumps({'stage': 'encoding', 'progress': 0, 'message': 'Đang mã hóa ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            with open(output_path, "rb") as f:
-                watermarked_bytes = f.read()
-                watermarked_base64 = base64.b64encode(watermarked_bytes).decode('utf-8')
+            if not tiled:
+                watermarked_base64 = base64.b64encode(encode_image(watermarked_bgr, '.png')).decode('utf-8')
+                result['watermarked_image'] = f"data:image/png;base64,{watermarked_base64}"
             
-            result['watermarked_image'] = f"data:image/png;base64,{watermarked_base64}"
+            # Bản ghi tham chiếu đã ký: dùng thay cho ảnh gốc khi trích xuất
+            if with_reference:
+                reference = result.pop('reference')
+                if reference is not None:
+                    reference_bytes = reference.to_bytes()
+                    result['reference'] = f"data:application/octet-stream;base64,{base64.b64encode(reference_bytes).decode('utf-8')}"
+                    result['reference_bytes'] = len(reference_bytes)
             
             # Hoàn thành - Sử dụng ensure_ascii=False
-            result_json = json.dumps({
+            complete = {
                 'stage': 'complete', 
                 'progress': 100, 
                 'message': 'Hoàn thành!', 
                 'result': result
-            }, ensure_ascii=False)
-            
-            yield f"data: {result_json}\n\n"
-            
+            }
+            if tiled:
+                # Ảnh đích tiled được mã hóa base64 theo từng khối khi stream (không đọc cả file vào bộ nhớ)
+                for part in _stream_file_event(complete, 'watermarked_image', output_path):
+                    yield part
+            else:
+                result_json = json.dumps(complete, ensure_ascii=False)
+                yield f"data: {result_json}\n\n"
+        
         except Exception as e:
             yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
+        finally:
+            if temp_dir is not None:
+                shutil.rmtree(temp_dir, ignore_errors=True)
     
     return StreamingResponse(generate(), media_type="text/event-stream")
 
 @router.post("/extract")
 async def extract_watermark(
     watermarked_image: UploadFile = File(...),
-    original_image: UploadFile = File(...),
+    original_image: UploadFile = File(None),
     original_watermark: UploadFile = File(None),
     watermark_size: int = Form(32),
-    arnold_iterations: int = Form(10)
+    arnold_iterations: int = Form(10),
+    reference: UploadFile = File(None),
+    algorithm: str = Form('svd'),
+    quantization_step: float = Form(120.0),
+    reduced_decode: bool = Form(False)
 ):
-    """Extract watermark from watermarked image with progress streaming"""
+    """Extract watermark with progress streaming, using the original image, a reference record or blind QIM"""
     
     async def generate():
         try:
@@ -110,14 +249,30 @@ async def extract_watermark(
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 0, 'message': 'Đang tải ảnh lên...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            temp_dir = tempfile.mkdtemp()
-            wm_path = os.path.join(temp_dir, "watermarked.png")
-            orig_path = os.path.join(temp_dir, "original.png")
+            wm_bytes = await watermarked_image.read()
+            
+            if algorithm not in ALGORITHMS:
+                yield f"data: {json.dumps({'stage': 'error', 'message': f'Thuật toán không hợp lệ: {algorithm}'})}\n\n"
+                return
             
-            with open(wm_path, "wb") as f:
-                f.write(await watermarked_image.read())
-            with open(orig_path, "wb") as f:
-                f.write(await original_image.read())
+            # Bản ghi tham chiếu thay cho ảnh gốc (không cần upload / decode ảnh gốc)
+            wm_reference = None
+            orig_bytes = None
+            blind = algorithm == 'qim'
+            if blind:
+                # QIM trích xuất mù: không cần cả ảnh gốc lẫn bản ghi
+                # Kích thước watermark suy ra từ kích thước ảnh
+                watermarker = _make_watermarker(algorithm, None, quantization_step, arnold_iterations)
+            elif reference:
+                # Cấu hình (wavelet, Arnold, kích thước watermark) lấy từ bản ghi
+                wm_reference = WatermarkReference.from_bytes(await reference.read())
+                watermarker = wm_reference.watermarker()
+            elif original_image:
+                orig_bytes = await original_image.read()
+                watermarker = DWT_DCT_SVD_Watermark(arnold_iterations=arnold_iterations, use_dwt=True, wavelet='haar')
+            else:
+                yield f"data: {json.dumps({'stage': 'error', 'message': 'Vui lòng tải lên ảnh gốc hoặc bản ghi tham chiếu.'})}\n\n"
+                return
             
             yield f"data: {json.dumps({'stage': 'upload', 'progress': 100, 'message': 'Đã tải xong ảnh'})}\n\n"
             await asyncio.sleep(0.1)
@@ -126,15 +281,22 @@ async def extract_watermark(
             yield f"data: {json.dumps({'stage': 'validate', 'progress': 0, 'message': 'Đang kiểm tra ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            wm_img = cv2.imread(wm_path)
-            orig_img = cv2.imread(orig_path)
-            
-            if wm_img is None or orig_img is None:
+            # Decode 1 lần trong bộ nhớ (reduced_decode: thẳng ở 1/2 độ phân giải), dùng lại khi trích xuất
+            try:
+                wm_img = watermarker.open_extraction_image(wm_bytes, reduced_decode)
+                if blind:
+                    orig_shape = wm_img.shape[:2]
+                elif wm_reference is not None:
+                    orig_shape = (wm_reference.height, wm_reference.width)
+                else:
+                    orig_img = watermarker.open_extraction_image(orig_bytes, reduced_decode)
+                    orig_shape = orig_img.shape[:2]
+            except ValueError:
                 yield f"data: {json.dumps({'stage': 'error', 'message': 'Không thể đọc ảnh. Vui lòng kiểm tra định dạng file.'})}\n\n"
                 return
             
-            if wm_img.shape != orig_img.shape:
-                error_msg = f"Hai ảnh phải có cùng kích thước. Ảnh đã watermark: {wm_img.shape[1]}x{wm_img.shape[0]}, Ảnh gốc: {orig_img.shape[1]}x{orig_img.shape[0]}"
+            if wm_img.shape[:2] != orig_shape:
+                error_msg = f"Hai ảnh phải có cùng kích thước. Ảnh đã watermark: {wm_img.shape[1]}x{wm_img.shape[0]}, Ảnh gốc: {orig_shape[1]}x{orig_shape[0]}"
                 yield f"data: {json.dumps({'stage': 'error', 'message': error_msg})}\n\n"
                 return
             
@@ -142,15 +304,26 @@ async def extract_watermark(
             await asyncio.sleep(0.1)
             
             # Bước 3: Trích xuất
-            yield f"data: {json.dumps({'stage': 'extracting', 'progress': 0, 'message': 'Đang trích xuất watermark bằng DWT-DCT-SVD...'})}\n\n"
+            yield f"data: {json.dumps({'stage': 'extracting', 'progress': 0, 'message': f'Đang trích xuất watermark bằng DWT-DCT-SVD ({algorithm.upper()})...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            watermarker = DWT_DCT_SVD_Watermark(arnold_iterations=arnold_iterations, use_dwt=True, wavelet='haar')
-            extracted = watermarker.extract(wm_path, orig_path, watermark_size)
-            
-            # Save extracted watermark
-            extracted_path = os.path.join(temp_dir, "extracted_watermark.png")
-            cv2.imwrite(extracted_path, extracted)
+            if blind:
+                extracted, confidence = watermarker.extract_array(wm_img, return_confidence=True)
+                extracted_size = extracted.shape[0]
+            elif wm_reference is not None:
+                extracted_size = wm_reference.watermark_size
+                extracted, confidence = watermarker.extract_array(wm_img, reference=wm_reference, return_confidence=True)
+            else:
+                extracted_size = watermark_size
+                extracted, confidence = watermarker.extract_array(wm_img, orig_img, watermark_size, return_confidence=True)
+            
+            # Soft confidence
+            # SVD: độ lệch của tỉ số S0_wm / S0_orig khỏi 1 (bit yếu < 1%)
+            # QIM: khoảng cách tới biên quyết định trong [0, 1] (bit yếu < 0.2)
+            if blind:
+                margins, weak_threshold, values_key = confidence, 0.2, "values"
+            else:
+                margins, weak_threshold, values_key = np.abs(confidence - 1), 0.01, "ratios"
             
             yield f"data: {json.dumps({'stage': 'extracting', 'progress': 100, 'message': 'Đã trích xuất xong'})}\n\n"
             await asyncio.sleep(0.1)
@@ -159,23 +332,24 @@ async def extract_watermark(
             yield f"data: {json.dumps({'stage': 'encoding', 'progress': 0, 'message': 'Đang mã hóa ảnh...'})}\n\n"
             await asyncio.sleep(0.1)
             
-            with open(extracted_path, "rb") as f:
-                extracted_bytes = f.read()
-                extracted_base64 = base64.b64encode(extracted_bytes).decode('utf-8')
+            extracted_base64 = base64.b64encode(encode_image(extracted, '.png')).decode('utf-8')
             
             result = {
                 "extracted_watermark": f"data:image/png;base64,{extracted_base64}",
-                "size": watermark_size
+                "size": extracted_size,
+                "algorithm": algorithm,
+                "confidence": {
+                    "mean_margin": float(margins.mean()),
+                    "min_margin": float(margins.min()),
+                    "weak_bits": int((margins < weak_threshold).sum()),
+                    values_key: np.round(confidence, 4).tolist()
+                }
             }
             
             # Calculate NC if original watermark provided
             if original_watermark:
-                orig_wm_path = os.path.join(temp_dir, "original_watermark.png")
-                with open(orig_wm_path, "wb") as f:
-                    f.write(await original_watermark.read())
-                
-                orig_wm = cv2.imread(orig_wm_path, cv2.IMREAD_GRAYSCALE)
-                orig_wm_resized = cv2.resize(orig_wm, (watermark_size, watermark_size))
+                orig_wm = decode_image(await original_watermark.read(), cv2.IMREAD_GRAYSCALE)
+                orig_wm_resized = cv2.resize(orig_wm, (extracted_size, extracted_size))
                 
                 nc = calculate_nc(orig_wm_resized, extracted)
                 result['nc'] = float(nc)
@@ -189,8 +363,97 @@ async def extract_watermark(
             }, ensure_ascii=False)
             
             yield f"data: {result_json}\n\n"
-            
+        
         except Exception as e:
             yield f"data: {json.dumps({'stage': 'error', 'message': str(e)})}\n\n"
     
     return StreamingResponse(generate(), media_type="text/event-stream")
+
+
+@router.post("/fanout")
+async def fanout_watermark(
+    host_image: UploadFile = File(...),
+    watermark_images: List[UploadFile] = File(...),
+    alpha: float = Form(0.1),
+    arnold_iterations: int = Form(10),
+    algorithm: str = Form('svd'),
+    quantization_step: float = Form(120.0),
+    with_reference: bool = Form(False),
+    metrics: str = Form(','.join(QUALITY_METRICS))
+):
+    """Watermark one host for many recipients (one mark each), streamed back as a zip"""
+    if with_reference:
+        try:
+            require_reference_key()
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    host = load_image(await host_image.read())
+    if host is None:
+        raise HTTPException(status_code=400, detail="Cannot read host image")
+    
+    # Tên file trong zip theo tên file watermark (không trùng)
+    recipients = []
+    used_names = set()
+    for index, watermark_image in enumerate(watermark_images):
+        watermark = load_image(await watermark_image.read())
+        if watermark is None:
+            raise HTTPException(status_code=400, detail=f"Cannot read watermark image: {watermark_image.filename}")
+        
+        stem = os.path.splitext(os.path.basename(watermark_image.filename or ''))[0]
+        recipients.append((recipient_file_stem(stem, index, used_names), watermark))
+    
+    try:
+        # Phân rã ảnh gốc 1 lần (chạy trong executor), mỗi người nhận chỉ cập nhật rank-1
+        watermarker = _make_watermarker(algorithm, alpha, quantization_step, arnold_iterations, metrics)
+        loop = asyncio.get_running_loop()
+        fanout = await loop.run_in_executor(None, FingerprintFanout, host, watermarker)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return StreamingResponse(
+        fanout.stream_zip(recipients, include_reference=with_reference),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="watermarked.zip"'}
+    )
+
+
+@router.post("/robustness")
+async def robustness_benchmark(
+    host_image: UploadFile = File(...),
+    watermark_image: UploadFile = File(...),
+    algorithm: str = Form('svd'),
+    alphas: str = Form('0.05,0.1,0.2'),
+    quantization_step: float = Form(120.0),
+    arnold_iterations: int = Form(10),
+    attacks: Optional[str] = Form(None),
+    workers: Optional[int] = Form(None),
+    seed: int = Form(0)
+):
+    """Embed -> attack -> extract -> NC/BER matrix over alphas x attack grid (attacks: JSON {attack: [params, ...]})"""
+    host = load_image(await host_image.read())
+    watermark = load_image(await watermark_image.read())
+    if host is None or watermark is None:
+        raise HTTPException(status_code=400, detail="Cannot read images")
+    
+    try:
+        # QIM không dùng alpha: chỉ 1 hàng với quantization_step
+        alpha_values = [float(value) for value in alphas.split(',') if value.strip()] if algorithm == 'svd' else None
+        watermarker = _make_watermarker(
+            algorithm, alpha_values[0] if alpha_values else 0.1, quantization_step, arnold_iterations
+        )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, lambda: run_robustness_benchmark(
+                host, watermark, watermarker, alphas=alpha_values, attacks=attacks,
+                max_workers=_cap_workers(workers), seed=seed
+            )
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/cache")
+async def watermark_cache_stats():
+    """Hit / miss counters of the prepared watermark cache"""
+    return prepared_watermark_cache.stats()
@@ -0,0 +1,396 @@
+"""
+Fingerprint Fan-out - Nhúng watermark riêng cho từng người nhận vào cùng 1 ảnh gốc
+Mở rộng DWT_DCT_SVD_Watermark:
+- Phân rã ảnh gốc 1 lần: YCrCb, DWT, DCT và singular triplet lớn nhất (u0, S0, v0) của từng block
+- Mỗi người nhận chỉ cần thay đổi rank-1 của S[0] và IDWT trên dải chứa watermark
+- Kết quả được ghi ra thư mục hoặc stream thành file zip
+- Tìm alpha tự động theo PSNR / SSIM mục tiêu (dùng lại phân rã đã cache)
+"""
+
+import io
+import copy
+import os
+import json
+import zipfile
+import numpy as np
+import cv2
+import pywt
+from app.core.watermarking import DWT_DCT_SVD_Watermark
+from app.core.utils import calculate_ssim_rows, SSIM_PAD, _psnr_from_mse
+
+
+def recipient_file_stem(recipient_id, index, used_names):
+    """
+    Tên file an toàn của 1 người nhận (không chứa đường dẫn, không trùng)
+    
+    Ký tự ngoài chữ / số / '-' / '_' (kể cả '/', '.') được thay bằng '_' nên
+    file không thể nằm ngoài thư mục đích / zip. Tên đã dùng được thêm index.
+    
+    Args:
+        recipient_id: Id người nhận (tên file watermark, mã người dùng, ...)
+        index: Số thứ tự người nhận (tên mặc định / tránh trùng)
+        used_names: set các tên đã dùng (được cập nhật)
+    """
+    stem = ''.join(c if c.isalnum() or c in '-_' else '_' for c in str(recipient_id)) or f"recipient_{index:03d}"
+    if stem in used_names:
+        stem = f"{stem}_{index:03d}"
+    used_names.add(stem)
+    return stem
+
+
+class _ZipStream(io.RawIOBase):
+    """File-like không seek được: gom bytes zipfile ghi ra để stream theo từng phần"""
+    
+    def __init__(self):
+        self._chunks = []
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+    
+    def drain(self):
+        """Lấy và xóa các bytes đã ghi"""
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class FingerprintFanout:
+    """
+    Fan-out watermark: 1 ảnh gốc, nhiều watermark (mỗi người nhận 1 watermark)
+    
+    Phần phụ thuộc ảnh gốc được tính 1 lần lúc khởi tạo:
+    - Ảnh mẫu: pipeline YCrCb -> DWT -> IDWT không nhúng (phần ảnh ngoài dải
+      watermark giống nhau cho mọi người nhận)
+    - Dải đầu ảnh chứa các payload blocks (kèm lề): YCrCb, sub-band, chi tiết DWT
+    - u0, S[0], v0 của từng payload block (chỉ S[0] thay đổi khi nhúng)
+    - MSE / SSIM của phần ảnh ngoài dải
+    
+    Mỗi người nhận chỉ cần: chuẩn bị watermark (có cache), cập nhật rank-1
+    S[0] trên các blocks, IDWT và chuyển màu trên dải đầu ảnh. Với ảnh kích
+    thước chẵn kết quả giống hệt DWT_DCT_SVD_Watermark.embed.
+    """
+    
+    def __init__(self, host, watermarker=None):
+        """
+        Args:
+            host: Đường dẫn ảnh gốc hoặc ảnh BGR uint8 đã decode
+            watermarker: DWT_DCT_SVD_Watermark hoặc DWT_DCT_SVD_QIM_Watermark (mặc định cấu hình chuẩn)
+        """
+        if isinstance(host, str):
+            host = cv2.imread(host)
+            if host is None:
+                raise ValueError("Cannot read images")
+        
+        self.watermarker = watermarker if watermarker is not None else DWT_DCT_SVD_Watermark()
+        self.host = host
+        self._decompose()
+    
+    def _decompose(self):
+        """Phân rã ảnh gốc 1 lần (xem docstring của class)"""
+        watermarker = self.watermarker
+        height, width = self.host.shape[:2]
+        b = watermarker.block_size
+        band_h, band_w = watermarker._band_shape(height, width)
+        
+        self.watermark_size = watermarker._watermark_size(band_h, band_w)
+        self.num_bits = min(self.watermark_size ** 2, (band_h // b) * (band_w // b))
+        band_rows = -(-self.num_bits // max(band_w // b, 1)) * b
+        
+        scale, filter_length, margin = watermarker._tile_geometry()
+        self.strip_rows = min(height, scale * band_rows + 2 * filter_length) if self.num_bits else 0
+        self._region_rows = min(height, scale * (band_rows + margin))
+        
+        # Ảnh mẫu: phần ngoài dải watermark của mọi người nhận
+        no_bits = np.zeros(0, dtype=np.float32)
+        host_ycrcb, host_y, _, _ = watermarker._embed_tile(self.host, (0, 0), (height, width), no_bits, 0)
+        self.template = watermarker._tile_bgr(host_ycrcb, host_y, (slice(None), slice(None)))
+        
+        # Dải đầu ảnh: sub-band và triplets của các payload blocks
+        self._region_ycrcb = host_ycrcb[:self._region_rows]
+        region_y = self._region_ycrcb[:, :, 0].astype(np.float32)
+        if watermarker.use_dwt:
+            self._band, self._details = pywt.dwt2(region_y, watermarker.wavelet)
+        else:
+            self._band, self._details = region_y, None
+        
+        self.original_s0 = np.zeros(0, dtype=np.float32)
+        if self.num_bits:
+            blocks, self._block_rows = watermarker._to_blocks(self._band, self.num_bits)
+            self._blocks = blocks.copy()
+            self._u0, self.original_s0, self._v0 = watermarker._decompose_blocks(self._blocks)
+        
+        # Metrics của phần ảnh ngoài dải (cửa sổ SSIM không chạm tới dải)
+        outside = self.strip_rows + SSIM_PAD
+        self._outside_squared_error = float(np.sum(
+            (self.host[self.strip_rows:].astype(np.float64) - self.template[self.strip_rows:]) ** 2
+        ))
+        outside_gray = cv2.cvtColor(self.template[self.strip_rows:], cv2.COLOR_BGR2GRAY) \
+            if self.strip_rows < height else np.zeros(1, dtype=np.uint8)
+        self._outside_gray_range = (int(outside_gray.min()), int(outside_gray.max()))
+        self._outside_ssim = {}
+        self._outside_ssim_rows = outside
+    
+    def _ssim_outside(self, data_range):
+        """Tổng SSIM (và số pixels) phần ngoài dải, cache theo data range"""
+        if data_range not in self._outside_ssim:
+            self._outside_ssim[data_range] = calculate_ssim_rows(
+                self.host, self.template, self._outside_ssim_rows, self.host.shape[0], data_range
+            )
+        return self._outside_ssim[data_range]
+    
+    def _load_watermark(self, watermark):
+        """Đọc (nếu là đường dẫn) và chuẩn bị watermark, trả về mảng bits"""
+        if isinstance(watermark, str):
+            watermark = cv2.imread(watermark)
+            if watermark is None:
+                raise ValueError("Cannot read images")
+        return self.watermarker._prepare_watermark(watermark, self.watermark_size).flatten()
+    
+    def _strip_bgr(self, blocks):
+        """Ảnh kết quả: ảnh mẫu với dải đầu ảnh dựng lại từ các blocks đã nhúng"""
+        watermarked_bgr = self.template.copy()
+        if not self.num_bits:
+            return watermarked_bgr
+        
+        watermarker = self.watermarker
+        band = self._band.copy()
+        watermarker._from_blocks(band, blocks, self._block_rows)
+        
+        if watermarker.use_dwt:
+            region_y = pywt.idwt2((band, self._details), watermarker.wavelet)
+            region_y = region_y[:self._region_rows, :self.host.shape[1]]
+        else:
+            region_y = band
+        
+        written = (slice(0, self.strip_rows), slice(None))
+        watermarked_bgr[:self.strip_rows] = watermarker._tile_bgr(self._region_ycrcb, region_y, written)
+        return watermarked_bgr
+    
+    def _mse(self, watermarked_bgr):
+        """MSE toàn ảnh: dải watermark + phần ngoài dải đã tính sẵn"""
+        strip_original = self.host[:self.strip_rows].astype(np.float64)
+        squared_error = self._outside_squared_error + float(np.sum((strip_original - watermarked_bgr[:self.strip_rows]) ** 2))
+        return squared_error / self.host.size
+    
+    def _ssim(self, watermarked_bgr):
+        """SSIM toàn ảnh: dải watermark + phần ngoài dải đã tính sẵn"""
+        strip_gray = cv2.cvtColor(watermarked_bgr[:self.strip_rows], cv2.COLOR_BGR2GRAY) \
+            if self.strip_rows else np.zeros(1, dtype=np.uint8)
+        data_range = max(int(strip_gray.max()), self._outside_gray_range[1]) - \
+            min(int(strip_gray.min()), self._outside_gray_range[0])
+        strip_ssim = calculate_ssim_rows(self.host, watermarked_bgr, 0, self._outside_ssim_rows, data_range)
+        outside_ssim = self._ssim_outside(data_range)
+        return (strip_ssim[0] + outside_ssim[0]) / max(strip_ssim[1] + outside_ssim[1], 1)
+    
+    def _finish(self, watermarker, blocks):
+        """Ảnh kết quả và dict thông tin (như _embed_image) từ các blocks đã nhúng"""
+        watermarked_bgr = self._strip_bgr(blocks)
+        mse = self._mse(watermarked_bgr)
+        psnr = _psnr_from_mse(mse)
+        ssim_val = self._ssim(watermarked_bgr) if 'ssim' in watermarker.metrics else None
+        
+        result = watermarker._embed_result(self.watermark_size, self.num_bits, psnr, ssim_val, mse)
+        return watermarked_bgr, result
+    
+    def _with_alpha(self, alpha):
+        """Watermarker cùng cấu hình với alpha khác (None = giữ nguyên)"""
+        if alpha is None:
+            return self.watermarker
+        if self.watermarker.alpha is None:
+            raise ValueError("Alpha is not used by the QIM algorithm (use quantization_step)")
+        watermarker = copy.copy(self.watermarker)
+        watermarker.alpha = alpha
+        return watermarker
+    
+    def embed(self, watermark, alpha=None):
+        """
+        Nhúng watermark của 1 người nhận
+        
+        Args:
+            watermark: Đường dẫn ảnh watermark hoặc ảnh đã decode
+            alpha: Alpha dùng thay cho cấu hình của watermarker (None = giữ nguyên)
+        
+        Returns:
+            tuple (watermarked_bgr, result): như DWT_DCT_SVD_Watermark._embed_image
+        """
+        watermarker = self._with_alpha(alpha)
+        watermark_flat = self._load_watermark(watermark)
+        
+        blocks = None
+        if self.num_bits:
+            # Chỉ S[0] thay đổi: cập nhật rank-1 từ triplets đã cache
+            blocks = watermarker._apply_rank1(
+                self._blocks, self._u0, self.original_s0, self._v0, watermark_flat[:self.num_bits]
+            )
+        return self._finish(watermarker, blocks)
+    
+    def search_alpha(self, watermark, target_psnr=None, target_ssim=None, alpha_range=(0.001, 1.0),
+                     tolerance=None, max_trials=20):
+        """
+        Tìm alpha lớn nhất (bền nhất) vẫn đạt PSNR hoặc SSIM mục tiêu (chia đôi)
+        
+        Thay đổi S[0] tuyến tính theo alpha: dS0 = ±alpha * S[0], nên hướng
+        thay đổi rank-1 của từng block chỉ tính 1 lần; mỗi lần thử chỉ cần
+        blocks + alpha * hướng, IDWT / chuyển màu dải đầu ảnh và metric mục
+        tiêu. Chất lượng giảm đơn điệu theo alpha (PSNR ~ -20 log10(alpha)) nên
+        khoảng alpha được chia đôi theo thang log. Ảnh kết quả được nhúng lại
+        với alpha đã chọn nên giống hệt embed với alpha đó.
+        
+        Args:
+            watermark: Đường dẫn ảnh watermark hoặc ảnh đã decode
+            target_psnr: PSNR mục tiêu (dB), hoặc
+            target_ssim: SSIM mục tiêu (chỉ 1 trong 2)
+            alpha_range: Khoảng tìm kiếm (min, max) của alpha
+            tolerance: Sai số chấp nhận trên mục tiêu (mặc định 0.05 dB / 0.0001 SSIM)
+            max_trials: Số lần thử tối đa (kể cả 2 đầu khoảng)
+        
+        Returns:
+            tuple (watermarked_bgr, result): result như embed, thêm 'alpha_search'
+            (metric, target, reached, trials = đường cong alpha -> metric đã thử)
+        """
+        if (target_psnr is None) == (target_ssim is None):
+            raise ValueError("Exactly one of target_psnr / target_ssim is required")
+        if self.watermarker.alpha is None:
+            raise ValueError("Alpha search requires the SVD algorithm (QIM uses quantization_step)")
+        if not self.num_bits:
+            raise ValueError("Image too small for watermark")
+        
+        low, high = alpha_range
+        if not 0 < low < high:
+            raise ValueError("alpha_range must satisfy 0 < min < max")
+        
+        metric = 'psnr' if target_psnr is not None else 'ssim'
+        target = target_psnr if target_psnr is not None else target_ssim
+        if tolerance is None:
+            tolerance = 0.05 if metric == 'psnr' else 1e-4
+        
+        # Hướng thay đổi rank-1 khi alpha = 1 (dS0 = ±S[0])
+        watermark_flat = self._load_watermark(watermark)
+        sign = np.where(watermark_flat[:self.num_bits] == 1, 1, -1).astype(np.float32)
+        direction = (sign * self.original_s0)[:, None, None] * self._u0[:, :, None] * self._v0[:, None, :]
+        
+        trials = []
+        
+        def evaluate(alpha):
+            watermarked_bgr = self._strip_bgr(self._blocks + np.float32(alpha) * direction)
+            if metric == 'psnr':
+                mse = self._mse(watermarked_bgr)
+                value = float(_psnr_from_mse(mse))
+            else:
+                value = float(self._ssim(watermarked_bgr))
+            trials.append({'alpha': float(alpha), metric: value})
+            return value
+        
+        # Mục tiêu đạt được ở alpha lớn nhất / không đạt được ở alpha nhỏ nhất
+        if evaluate(high) >= target:
+            chosen, reached = high, True
+        elif evaluate(low) < target:
+            chosen, reached = low, False
+        else:
+            chosen, reached = low, True
+            while len(trials) < max_trials:
+                alpha = float(np.sqrt(low * high))
+                value = evaluate(alpha)
+                if value >= target:
+                    low = chosen = alpha
+                    if value - target <= tolerance:
+                        break
+                else:
+                    high = alpha
+        
+        # Nhúng lại với alpha đã chọn (cùng pipeline với embed)
+        watermarked_bgr, result = self.embed(watermark, alpha=chosen)
+        result['alpha_search'] = {
+            'metric': metric,
+            'target': target,
+            'reached': reached,
+            'alpha_range': [float(alpha_range[0]), float(alpha_range[1])],
+            'trials': trials
+        }
+        return watermarked_bgr, result
+    
+    def reference(self, alpha=None):
+        """
+        Bản ghi tham chiếu dùng chung cho mọi người nhận (S[0] gốc chỉ phụ thuộc ảnh gốc)
+        
+        Args:
+            alpha: Alpha đã dùng khi nhúng nếu khác cấu hình (vd. kết quả search_alpha)
+        
+        Returns:
+            WatermarkReference, hoặc None nếu ảnh quá nhỏ / mode trích xuất mù
+        """
+        return self._with_alpha(alpha)._make_reference(
+            self.watermark_size, self.host.shape[:2], self.original_s0,
+            self.num_bits == self.watermark_size ** 2
+        )
+    
+    def iter_embed(self, recipients, image_format='.png'):
+        """
+        Nhúng lần lượt cho từng người nhận
+        
+        Args:
+            recipients: Iterable (recipient_id, watermark) với watermark là đường dẫn hoặc ảnh
+            image_format: Định dạng ảnh kết quả (phần mở rộng cho cv2.imencode)
+        
+        Yields:
+            tuple (recipient_id, encoded image bytes, result): result kèm 'file' (tên file
+            an toàn, xem recipient_file_stem)
+        """
+        used_names = set()
+        for index, (recipient_id, watermark) in enumerate(recipients):
+            watermarked_bgr, result = self.embed(watermark)
+            ok, encoded = cv2.imencode(image_format, watermarked_bgr)
+            if not ok:
+                raise ValueError(f"Cannot encode image as {image_format}")
+            result['file'] = f"{recipient_file_stem(recipient_id, index, used_names)}{image_format}"
+            yield recipient_id, encoded.tobytes(), result
+    
+    def write_directory(self, recipients, output_dir, image_format='.png'):
+        """
+        Ghi ảnh của từng người nhận vào thư mục (result['file'] + manifest.json)
+        
+        Tên file được làm sạch (recipient_file_stem): id như '../x' không ghi ra ngoài output_dir.
+        
+        Returns:
+            dict: {recipient_id: result}
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        manifest = {}
+        for recipient_id, data, result in self.iter_embed(recipients, image_format):
+            with open(os.path.join(output_dir, result['file']), "wb") as f:
+                f.write(data)
+            manifest[recipient_id] = result
+        
+        with open(os.path.join(output_dir, "manifest.json"), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+    
+    def stream_zip(self, recipients, image_format='.png', include_reference=False):
+        """
+        Stream file zip gồm ảnh của từng người nhận (mỗi ảnh được gửi ngay khi nhúng xong)
+        
+        Zip dùng ZIP_STORED (ảnh đã nén) và data descriptors nên không cần
+        seek: bộ nhớ chỉ giữ 1 ảnh tại 1 thời điểm. Cuối zip là manifest.json
+        (kết quả của từng người nhận) và reference.wmrf nếu include_reference.
+        
+        Yields:
+            bytes: Các phần liên tiếp của file zip
+        """
+        stream = _ZipStream()
+        manifest = {}
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_STORED) as archive:
+            for recipient_id, data, result in self.iter_embed(recipients, image_format):
+                archive.writestr(result['file'], data)
+                manifest[recipient_id] = result
+                yield stream.drain()
+            
+            if include_reference:
+                reference = self.reference()
+                if reference is not None:
+                    archive.writestr("reference.wmrf", reference.to_bytes())
+            archive.writestr("manifest.json", json.dumps(manifest, ensure_ascii=False, indent=2))
+        yield stream.drain()
@@ -0,0 +1,362 @@
+"""
+Parallel Watermarking - Nhúng DWT-DCT-SVD song song trên nhiều CPU cores
+Mở rộng DWT_DCT_SVD_Watermark:
+- Ảnh host / ảnh kết quả nằm trong multiprocessing.shared_memory (workers không pickle ảnh)
+- Các hàng block chứa payload được chia thành các dải thẳng hàng với lưới DWT / block 8x8
+- Mỗi worker xử lý 1 dải (kèm lề): YCrCb -> DWT -> DCT-SVD -> IDWT -> BGR; phần ảnh
+  ngoài dải payload được copy và tính metrics (MSE, SSIM cục bộ) song song theo khối hàng
+- Process pool dùng chung giữa các lần gọi (utils.process_map, không tạo process mới mỗi request)
+
+Đo scaling: python -m app.core.parallel_watermarking host.png watermark.png
+"""
+
+import argparse
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+from app.core.watermarking import DWT_DCT_SVD_Watermark
+from app.core.utils import calculate_ssim_rows, process_map, process_pool_size, _psnr_from_mse
+
+
+def _shared_image(segment, shape):
+    """View ảnh uint8 trên shared memory segment"""
+    return np.ndarray(shape, dtype=np.uint8, buffer=segment.buf)
+
+
+def _close_segments(segments):
+    """Đóng các shared memory segments đã attach (bỏ qua nếu views còn được giữ khi worker lỗi)"""
+    for segment in segments:
+        try:
+            segment.close()
+        except BufferError:
+            pass
+
+
+def _embed_rows(task):
+    """
+    Worker: nhúng watermark vào 1 dải hàng của ảnh (chạy trong process pool)
+    
+    Returns:
+        tuple (bit_index, s0, squared_error, gray_min, gray_max) của dải
+    """
+    watermarker, host_name, output_name, shape, written_rows, region_rows, watermark_flat, num_bits = task
+    segments = [shared_memory.SharedMemory(name=host_name), shared_memory.SharedMemory(name=output_name)]
+    try:
+        return _embed_rows_shared(
+            watermarker, _shared_image(segments[0], shape), _shared_image(segments[1], shape),
+            written_rows, region_rows, watermark_flat, num_bits
+        )
+    finally:
+        _close_segments(segments)
+
+
+def _embed_rows_shared(watermarker, host, output, written_rows, region_rows, watermark_flat, num_bits):
+    """Nhúng dải hàng written_rows (biến đổi trên region_rows kèm lề) từ host vào output"""
+    (y0, y1), (ry0, ry1) = written_rows, region_rows
+    region = host[ry0:ry1]
+    region_ycrcb, watermarked_y, bit_index, s0 = watermarker._embed_tile(
+        region, (ry0, 0), host.shape[:2], watermark_flat, num_bits
+    )
+    
+    written = (slice(y0 - ry0, y1 - ry0), slice(None))
+    rows_bgr = watermarker._tile_bgr(region_ycrcb, watermarked_y, written)
+    output[y0:y1] = rows_bgr
+    
+    squared_error = float(np.sum((region[written].astype(np.float64) - rows_bgr) ** 2))
+    gray = cv2.cvtColor(rows_bgr, cv2.COLOR_BGR2GRAY)
+    return bit_index, s0, squared_error, int(gray.min()), int(gray.max())
+
+
+def _copy_rows(task):
+    """
+    Worker: copy nguyên 1 khối hàng ngoài dải payload từ host sang output
+    
+    Returns:
+        tuple (gray_min, gray_max) của khối (data range cho SSIM)
+    """
+    host_name, output_name, shape, (y0, y1) = task
+    segments = [shared_memory.SharedMemory(name=host_name), shared_memory.SharedMemory(name=output_name)]
+    try:
+        rows = _shared_image(segments[0], shape)[y0:y1]
+        _shared_image(segments[1], shape)[y0:y1] = rows
+        gray = cv2.cvtColor(rows, cv2.COLOR_BGR2GRAY)
+        return int(gray.min()), int(gray.max())
+    finally:
+        _close_segments(segments)
+
+
+def _ssim_rows(task):
+    """
+    Worker: tổng SSIM map (giống calculate_ssim) trên 1 dải hàng
+    
+    Returns:
+        tuple (tổng SSIM, số pixels) trong phần dải nằm trong vùng SSIM của toàn ảnh
+    """
+    host_name, output_name, shape, (y0, y1), data_range = task
+    segments = [shared_memory.SharedMemory(name=host_name), shared_memory.SharedMemory(name=output_name)]
+    try:
+        return calculate_ssim_rows(
+            _shared_image(segments[0], shape), _shared_image(segments[1], shape), y0, y1, data_range
+        )
+    finally:
+        _close_segments(segments)
+
+
+class ParallelWatermark:
+    """
+    Nhúng watermark DWT-DCT-SVD song song theo dải hàng block
+    
+    Chỉ các hàng block chứa payload (dải đầu sub-band, xem plan_frames) cần
+    biến đổi: các hàng block này được chia thành các dải (bội số block size)
+    cho từng worker. Mỗi dải được biến đổi kèm lề dài hơn filter của wavelet
+    nên kết quả giống hệt embed_frame: dải payload giống hệt
+    DWT_DCT_SVD_Watermark.embed, phần còn lại giữ nguyên pixels gốc (embed
+    làm tròn lại toàn ảnh qua YCrCb / IDWT, sai khác <= 2 mức), watermark
+    trích xuất như nhau. Ảnh kích thước lẻ (embed resize sau IDWT) được nhúng
+    tuần tự bằng watermarker để kết quả giống embed.
+    
+    Phần ảnh ngoài dải payload được copy và tính SSIM song song theo khối
+    hàng. Ảnh được chia sẻ qua multiprocessing.shared_memory: mỗi task chỉ
+    pickle cấu hình và bits; process pool được dùng chung giữa các lần gọi.
+    """
+    
+    def __init__(self, watermarker=None, max_workers=None):
+        """
+        Args:
+            watermarker: DWT_DCT_SVD_Watermark (hoặc DWT_DCT_SVD_QIM_Watermark), mặc định cấu hình chuẩn
+            max_workers: Số process song song (None = số CPU, 1 = chạy tuần tự trong process hiện tại)
+        """
+        self.watermarker = watermarker if watermarker is not None else DWT_DCT_SVD_Watermark()
+        self.max_workers = max_workers or os.cpu_count() or 1
+        
+        if self.max_workers < 1:
+            raise ValueError("max_workers must be >= 1")
+    
+    def _row_bands(self, height, width, num_bits):
+        """
+        Chia các hàng block chứa payload thành các dải cho workers
+        
+        Returns:
+            list[tuple]: ((y0, y1) hàng ảnh được ghi, (ry0, ry1) hàng ảnh được biến đổi)
+        """
+        b = self.watermarker.block_size
+        band_h, band_w = self.watermarker._band_shape(height, width)
+        scale, _, margin = self.watermarker._tile_geometry()
+        payload_h = min(band_h, -(-num_bits // max(band_w // b, 1)) * b)
+        
+        parts = max(1, min(self.max_workers, payload_h // max(b, margin)))
+        bounds = [min(payload_h, round(payload_h * i / parts / b) * b) for i in range(parts)] + [payload_h]
+        
+        bands = []
+        for r0, r1 in zip(bounds[:-1], bounds[1:]):
+            if r1 <= r0:
+                continue
+            written = (scale * r0, height if r1 >= band_h else scale * r1)
+            region = (max(0, scale * (r0 - margin)), height if r1 + margin >= band_h else scale * (r1 + margin))
+            bands.append((written, region))
+        return bands
+    
+    def _row_chunks(self, y0, y1):
+        """Chia các hàng [y0, y1) thành tối đa max_workers khối liên tiếp"""
+        parts = max(1, min(self.max_workers, y1 - y0))
+        bounds = [y0 + (y1 - y0) * i // parts for i in range(parts + 1)]
+        return [(a, b) for a, b in zip(bounds[:-1], bounds[1:]) if b > a]
+    
+    def embed(self, host_image_path, watermark_image_path, output_path, with_reference=False):
+        """
+        Nhúng watermark vào ảnh gốc (song song)
+        
+        Args:
+            host_image_path, watermark_image_path, output_path, with_reference:
+                Như DWT_DCT_SVD_Watermark.embed
+        
+        Returns:
+            dict: Như DWT_DCT_SVD_Watermark.embed, thêm 'workers' và 'row_bands'
+        """
+        host = cv2.imread(host_image_path)
+        watermark = cv2.imread(watermark_image_path)
+        
+        if host is None or watermark is None:
+            raise ValueError("Cannot read images")
+        
+        watermarked_bgr, result = self._embed_image(host, watermark, with_reference)
+        cv2.imwrite(output_path, watermarked_bgr)
+        
+        return result
+    
+    def embed_array(self, host, watermark, with_reference=False):
+        """
+        Nhúng watermark vào ảnh đã decode (song song), hoàn toàn trong bộ nhớ
+        
+        Returns:
+            tuple (watermarked_bgr, result): như DWT_DCT_SVD_Watermark.embed_array
+        """
+        if host is None or watermark is None:
+            raise ValueError("Cannot read images")
+        if host.ndim != 3 or host.shape[2] != 3 or host.dtype != np.uint8:
+            raise ValueError("Host image must be an 8-bit BGR array")
+        
+        return self._embed_image(host, watermark, with_reference)
+    
+    def _embed_image(self, host, watermark, with_reference=False):
+        """
+        Nhúng watermark vào ảnh đã decode (song song)
+        
+        Returns:
+            tuple (watermarked_bgr, result): như DWT_DCT_SVD_Watermark._embed_image,
+            thêm 'workers' (số process thực sự dùng) và 'row_bands' (số dải payload)
+        """
+        watermarker = self.watermarker
+        height, width = host.shape[:2]
+        plan = watermarker.plan_frames(watermark, height, width)
+        
+        # Ảnh kích thước lẻ: embed resize toàn ảnh sau IDWT, không chia dải được
+        if plan['strip'] is None:
+            watermarked_bgr, result = watermarker._embed_image(host, watermark, with_reference)
+            result.update({'workers': 1, 'row_bands': 1})
+            return watermarked_bgr, result
+        
+        watermark_flat = plan['bits']
+        num_bits = len(watermark_flat)
+        bands = self._row_bands(height, width, num_bits)
+        payload_end = bands[-1][0][1]
+        copy_chunks = self._row_chunks(payload_end, height)
+        
+        # Ảnh host và ảnh kết quả trong shared memory (workers attach theo tên)
+        host_segment = shared_memory.SharedMemory(create=True, size=host.nbytes)
+        output_segment = shared_memory.SharedMemory(create=True, size=host.nbytes)
+        try:
+            _shared_image(host_segment, host.shape)[:] = host
+            names = (host_segment.name, output_segment.name, host.shape)
+            
+            embed_tasks = [
+                (watermarker, *names, written, region, watermark_flat, num_bits)
+                for written, region in bands
+            ]
+            copy_tasks = [(*names, rows) for rows in copy_chunks]
+            
+            embedded = process_map(_embed_rows, embed_tasks, self.max_workers)
+            copied = process_map(_copy_rows, copy_tasks, self.max_workers)
+            
+            # Data range của ảnh kết quả (grayscale), giống calculate_ssim
+            ssim_parts = []
+            if 'ssim' in watermarker.metrics:
+                gray_ranges = [part[3:] for part in embedded] + copied
+                data_range = max(part[1] for part in gray_ranges) - min(part[0] for part in gray_ranges)
+                ssim_tasks = [(*names, rows, data_range) for rows in self._row_chunks(0, height)]
+                ssim_parts = process_map(_ssim_rows, ssim_tasks, self.max_workers)
+            
+            watermarked_bgr = _shared_image(output_segment, host.shape).copy()
+        finally:
+            for segment in (host_segment, output_segment):
+                segment.close()
+                segment.unlink()
+        
+        original_s0 = np.zeros(num_bits, dtype=np.float32)
+        for bit_index, s0, _, _, _ in embedded:
+            original_s0[bit_index] = s0
+        
+        # Các hàng ngoài dải payload giữ nguyên: MSE chỉ đến từ các dải
+        mse = sum(part[2] for part in embedded) / host.size
+        psnr = _psnr_from_mse(mse)
+        ssim_count = sum(part[1] for part in ssim_parts)
+        ssim_val = sum(part[0] for part in ssim_parts) / ssim_count if ssim_count else 1.0
+        
+        result = watermarker._embed_result(plan['watermark_size'], num_bits, psnr, ssim_val, mse)
+        result.update({'workers': min(self.max_workers, process_pool_size()), 'row_bands': len(bands)})
+        
+        if with_reference:
+            result['reference'] = watermarker._make_reference(
+                plan['watermark_size'], (height, width), original_s0, plan['complete']
+            )
+        
+        return watermarked_bgr, result
+
+
+def benchmark_scaling(host_image_path, watermark_image_path,
+                      resolutions=((1920, 1080), (3840, 2160), (7680, 4320)), worker_counts=None, repeats=3):
+    """
+    Đo thời gian nhúng song song theo số workers cho từng độ phân giải
+    
+    Ảnh host được resize về từng độ phân giải; mỗi cấu hình chạy 1 lần khởi
+    động (tạo process pool) rồi lấy thời gian tốt nhất trong `repeats` lần
+    (không tính đọc / ghi file).
+    
+    Args:
+        host_image_path, watermark_image_path: Ảnh dùng để đo
+        resolutions: Các độ phân giải (width, height)
+        worker_counts: Các số workers (mặc định 1, 2, 4, ... đến số CPU)
+        repeats: Số lần lặp mỗi cấu hình
+    
+    Returns:
+        list[dict]: resolution, workers, seconds, speedup (so với 1 worker),
+        row_bands và payload_rows (tỉ lệ hàng ảnh đi qua DWT-DCT-SVD)
+    """
+    host = cv2.imread(host_image_path)
+    watermark = cv2.imread(watermark_image_path)
+    if host is None or watermark is None:
+        raise ValueError("Cannot read images")
+    
+    if worker_counts is None:
+        cpus = os.cpu_count() or 1
+        worker_counts = sorted({1, cpus} | {2 ** k for k in range(cpus.bit_length()) if 2 ** k <= cpus})
+    
+    report = []
+    for width, height in resolutions:
+        resized = cv2.resize(host, (width, height), interpolation=cv2.INTER_AREA)
+        baseline = None
+        for workers in worker_counts:
+            parallel = ParallelWatermark(max_workers=workers)
+            _, result = parallel._embed_image(resized, watermark)
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                parallel._embed_image(resized, watermark)
+                timings.append(time.perf_counter() - start)
+            
+            seconds = min(timings)
+            baseline = baseline or seconds
+            strip = parallel.watermarker.plan_frames(watermark, height, width)['strip']
+            report.append({
+                'resolution': f"{width}x{height}",
+                'workers': workers,
+                'seconds': seconds,
+                'speedup': baseline / seconds,
+                'row_bands': result['row_bands'],
+                'payload_rows': (strip[0] if strip is not None else height) / height
+            })
+    
+    return report
+
+
+def _parse_resolution(value):
+    """'1920x1080' -> (1920, 1080)"""
+    try:
+        width, height = (int(part) for part in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid resolution: {value} (expected WIDTHxHEIGHT)")
+    return width, height
+
+
+def main(argv=None):
+    """CLI: in bảng scaling theo số workers cho từng độ phân giải"""
+    parser = argparse.ArgumentParser(description="Benchmark parallel watermark embedding scaling")
+    parser.add_argument('host_image', help="Ảnh host (được resize về từng độ phân giải)")
+    parser.add_argument('watermark_image', help="Ảnh watermark")
+    parser.add_argument('--resolutions', type=_parse_resolution, nargs='+',
+                        default=[(1920, 1080), (3840, 2160), (7680, 4320)], help="WIDTHxHEIGHT ...")
+    parser.add_argument('--workers', type=int, nargs='+', default=None, help="Số workers (mặc định 1, 2, 4, ... số CPU)")
+    parser.add_argument('--repeats', type=int, default=3, help="Số lần lặp mỗi cấu hình")
+    args = parser.parse_args(argv)
+    
+    print(f"CPUs: {os.cpu_count()}")
+    print(f"{'resolution':>11} {'workers':>7} {'seconds':>8} {'speedup':>7} {'bands':>5} {'payload rows':>12}")
+    for row in benchmark_scaling(args.host_image, args.watermark_image, args.resolutions, args.workers, args.repeats):
+        print(f"{row['resolution']:>11} {row['workers']:>7} {row['seconds']:>8.3f} {row['speedup']:>6.2f}x "
+              f"{row['row_bands']:>5} {row['payload_rows']:>11.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Watermark Reference - Bản ghi tham chiếu thay cho ảnh/video gốc khi trích xuất
+Trích xuất DWT-DCT-SVD cần S[0] của từng block ảnh gốc. Thay vì gửi lại
+toàn bộ ảnh/video gốc, lúc nhúng có thể xuất 1 bản ghi nhỏ gồm:
+- Các giá trị S[0] gốc của từng block (float32) cho từng frame đã nhúng
+- Bố cục block, wavelet, alpha, số lần Arnold, kích thước watermark
+- Chữ ký HMAC-SHA256 để phát hiện bản ghi bị sửa / giả mạo
+"""
+
+import os
+import hmac
+import hashlib
+import struct
+import numpy as np
+
+
+# Khóa ký lấy từ biến môi trường (bắt buộc): phải cố định và dùng chung cho mọi worker,
+# nếu không bản ghi do worker này ký sẽ không xác thực được ở worker khác / sau khi khởi động lại
+REFERENCE_KEY_ENV = "WATERMARK_REFERENCE_KEY"
+
+
+def _reference_key():
+    """
+    Khóa HMAC dùng để ký / xác thực bản ghi tham chiếu
+    
+    Raises:
+        ValueError: Chưa cấu hình WATERMARK_REFERENCE_KEY
+    """
+    key = os.getenv(REFERENCE_KEY_ENV)
+    if not key:
+        raise ValueError(
+            f"Watermark references require a signing key: set {REFERENCE_KEY_ENV} to a persistent secret "
+            "shared by all server workers"
+        )
+    return key.encode('utf-8')
+
+
+def require_reference_key():
+    """Kiểm tra khóa ký trước khi nhúng kèm bản ghi / trích xuất bằng bản ghi (raise ValueError nếu chưa có)"""
+    _reference_key()
+
+
+class WatermarkReference:
+    """
+    Bản ghi tham chiếu (sidecar) của 1 lần nhúng watermark
+    
+    Định dạng nhị phân: header, tên wavelet, danh sách frame numbers, ma trận
+    S[0] gốc (frames x watermark_size^2, float32 big-endian), chữ ký HMAC.
+    Ảnh tĩnh được lưu như video 1 frame (frame 0).
+    """
+    
+    MAGIC = b'WMRF'
+    VERSION = 1
+    # magic, version, flags, block size, arnold iterations, alpha, watermark size, height, width, số frames
+    HEADER_STRUCT = struct.Struct('>4sBBBHfHIII')
+    SIGNATURE_SIZE = hashlib.sha256().digest_size
+    
+    FLAG_DWT = 0x01
+    FLAG_VIDEO = 0x02
+    
+    def __init__(self, block_size, alpha, arnold_iterations, use_dwt, wavelet, watermark_size,
+                 height, width, frames, is_video=False):
+        """
+        Args:
+            block_size, alpha, arnold_iterations, use_dwt, wavelet: Cấu hình DWT_DCT_SVD_Watermark
+            watermark_size: Kích thước watermark (watermark_size x watermark_size)
+            height, width: Kích thước ảnh / frame
+            frames: dict {frame_number: mảng S[0] gốc (watermark_size^2,)}
+            is_video: Bản ghi của video (nhiều frames)
+        """
+        self.block_size = block_size
+        self.alpha = alpha
+        self.arnold_iterations = arnold_iterations
+        self.use_dwt = use_dwt
+        self.wavelet = wavelet
+        self.watermark_size = watermark_size
+        self.height = height
+        self.width = width
+        self.frames = {
+            int(number): np.asarray(values, dtype=np.float32).reshape(-1)
+            for number, values in frames.items()
+        }
+        self.is_video = is_video
+        
+        for number, values in self.frames.items():
+            if len(values) != watermark_size * watermark_size:
+                raise ValueError(f"Reference frame {number} has {len(values)} values, expected {watermark_size ** 2}")
+    
+    def watermarker(self):
+        """Tạo DWT_DCT_SVD_Watermark với đúng cấu hình lúc nhúng"""
+        from app.core.watermarking import DWT_DCT_SVD_Watermark
+        
+        return DWT_DCT_SVD_Watermark(
+            block_size=self.block_size,
+            alpha=self.alpha,
+            arnold_iterations=self.arnold_iterations,
+            use_dwt=self.use_dwt,
+            wavelet=self.wavelet or 'haar'
+        )
+    
+    def original_s0(self, frame_number=0):
+        """S[0] gốc của các blocks trong frame_number"""
+        if frame_number not in self.frames:
+            frames = sorted(self.frames)
+            listed = ', '.join(str(number) for number in frames[:10]) + (', ...' if len(frames) > 10 else '')
+            raise ValueError(f"Frame {frame_number} is not in the reference (watermarked frames: {listed})")
+        return self.frames[frame_number]
+    
+    def to_bytes(self):
+        """Đóng gói và ký bản ghi"""
+        flags = (self.FLAG_DWT if self.use_dwt else 0) | (self.FLAG_VIDEO if self.is_video else 0)
+        wavelet = (self.wavelet or '').encode('ascii')
+        numbers = sorted(self.frames)
+        
+        body = b''.join([
+            self.HEADER_STRUCT.pack(
+                self.MAGIC, self.VERSION, flags, self.block_size, self.arnold_iterations,
+                self.alpha, self.watermark_size, self.height, self.width, len(numbers)
+            ),
+            struct.pack('>B', len(wavelet)), wavelet,
+            np.asarray(numbers, dtype='>u4').tobytes(),
+            np.stack([self.frames[number] for number in numbers]).astype('>f4').tobytes() if numbers else b'',
+        ])
+        signature = hmac.new(_reference_key(), body, hashlib.sha256).digest()
+        return body + signature
+    
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Xác thực chữ ký và đọc bản ghi
+        
+        Raises:
+            ValueError: Bản ghi sai định dạng hoặc chữ ký không hợp lệ
+        """
+        header_size = cls.HEADER_STRUCT.size
+        if len(data) < header_size + 1 + cls.SIGNATURE_SIZE:
+            raise ValueError("Invalid watermark reference")
+        
+        body, signature = data[:-cls.SIGNATURE_SIZE], data[-cls.SIGNATURE_SIZE:]
+        expected = hmac.new(_reference_key(), body, hashlib.sha256).digest()
+        if not hmac.compare_digest(signature, expected):
+            raise ValueError("Watermark reference signature is invalid")
+        
+        magic, version, flags, block_size, arnold_iterations, alpha, watermark_size, height, width, num_frames = \
+            cls.HEADER_STRUCT.unpack(body[:header_size])
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ValueError("Invalid watermark reference")
+        
+        offset = header_size
+        wavelet_length = body[offset]
+        wavelet = body[offset + 1:offset + 1 + wavelet_length].decode('ascii') or None
+        offset += 1 + wavelet_length
+        
+        numbers = np.frombuffer(body, dtype='>u4', count=num_frames, offset=offset)
+        offset += num_frames * 4
+        
+        num_bits = watermark_size * watermark_size
+        if len(body) - offset != num_frames * num_bits * 4:
+            raise ValueError("Invalid watermark reference")
+        values = np.frombuffer(body, dtype='>f4', offset=offset).reshape(num_frames, num_bits)
+        
+        return cls(
+            block_size=block_size,
+            # alpha lưu float32: làm tròn về giá trị thập phân ban đầu
+            alpha=float(np.format_float_positional(np.float32(alpha))),
+            arnold_iterations=arnold_iterations,
+            use_dwt=bool(flags & cls.FLAG_DWT),
+            wavelet=wavelet,
+            watermark_size=watermark_size,
+            height=height,
+            width=width,
+            frames=dict(zip(numbers.tolist(), values)),
+            is_video=bool(flags & cls.FLAG_VIDEO)
+        )
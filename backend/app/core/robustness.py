@@ -0,0 +1,273 @@
+"""
+Robustness Benchmark - Đánh giá độ bền watermark trước các tấn công (apply_attack)
+Mỗi ô của lưới (alpha x tấn công): nhúng -> tấn công -> trích xuất -> NC / BER
+- Nhúng từng alpha bằng FingerprintFanout (phân rã ảnh gốc 1 lần)
+- Các ô tấn công chạy song song trong process pool dùng chung (utils.process_map),
+  hoàn toàn trong bộ nhớ (ảnh đã watermark nằm trong shared memory, JPEG qua imencode / imdecode)
+- Trích xuất dùng S[0] gốc (bản ghi tham chiếu) nên không cần ảnh gốc
+Chạy từ dòng lệnh: python -m app.core.robustness host.png watermark.png --alphas 0.05 0.1 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark
+from app.core.fingerprinting import FingerprintFanout
+from app.core.utils import apply_attack, calculate_nc, process_map, process_pool_size, ATTACK_TYPES
+
+
+# Lưới tấn công mặc định: {loại tấn công: [tham số của từng mức]}
+DEFAULT_ATTACKS = {
+    'jpeg_compression': [{'quality': quality} for quality in (90, 70, 50, 30)],
+    'gaussian_noise': [{'std': std} for std in (2, 5, 10)],
+    'crop': [{'crop_percent': percent} for percent in (0.02, 0.05)],
+    'rotate': [{'angle': angle} for angle in (0.5, 2)],
+}
+
+# Cột đầu tiên của ma trận: ảnh đã watermark không bị tấn công
+NO_ATTACK = 'none'
+
+def _run_cell(task):
+    """
+    Worker: tấn công -> trích xuất -> NC / BER cho 1 ô (alpha, tấn công)
+    
+    Task mang cấu hình của hàng (watermarker, tham chiếu) và tên shared memory
+    chứa các ảnh đã watermark: pool dùng chung không giữ trạng thái giữa các lần chạy.
+    
+    Returns:
+        tuple (row, column, nc, ber, seconds)
+    """
+    (row, column, attack_type, params, seed), (watermarker, reference), (images_name, images_shape), \
+        watermark_size, expected = task
+    segment = shared_memory.SharedMemory(name=images_name)
+    try:
+        watermarked = np.ndarray(images_shape, dtype=np.uint8, buffer=segment.buf)[row].copy()
+    finally:
+        segment.close()
+    
+    start = time.perf_counter()
+    if attack_type == NO_ATTACK:
+        attacked = watermarked
+    else:
+        # Seed theo ô: kết quả tấn công ngẫu nhiên (nhiễu) lặp lại được, không phụ thuộc worker
+        np.random.seed(seed)
+        attacked = apply_attack(watermarked, attack_type, **params)
+    
+    if watermarker.BLIND:
+        extracted = watermarker._extract_image(attacked, watermark_size=watermark_size)
+    else:
+        extracted = watermarker._extract_image(attacked, reference=reference)
+    seconds = time.perf_counter() - start
+    
+    nc = float(calculate_nc(expected, extracted))
+    ber = float(np.mean((extracted > 127) != (expected > 127)))
+    return row, column, nc, ber, seconds
+
+
+def parse_attacks(attacks):
+    """
+    Chuẩn hóa lưới tấn công
+    
+    Args:
+        attacks: dict {loại: [params, ...]} hoặc list [(loại, params), ...]
+            (None = DEFAULT_ATTACKS, chuỗi JSON được chấp nhận)
+    
+    Returns:
+        list[tuple]: (loại tấn công, params) theo thứ tự
+    """
+    if attacks is None:
+        attacks = DEFAULT_ATTACKS
+    if isinstance(attacks, str):
+        try:
+            attacks = json.loads(attacks)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Invalid attack grid: {e}")
+    
+    if isinstance(attacks, dict):
+        cells = [(attack_type, params) for attack_type, levels in attacks.items() for params in (levels or [{}])]
+    else:
+        cells = [(attack_type, params or {}) for attack_type, params in attacks]
+    
+    for attack_type, params in cells:
+        if attack_type not in ATTACK_TYPES:
+            raise ValueError(f"Unknown attack: {attack_type} (expected one of {', '.join(ATTACK_TYPES)})")
+        if not isinstance(params, dict):
+            raise ValueError(f"Attack parameters must be an object: {attack_type}")
+    return cells
+
+
+def _attack_label(attack_type, params):
+    """Tên cột: jpeg_compression(quality=50)"""
+    if not params:
+        return attack_type
+    return f"{attack_type}({', '.join(f'{name}={value}' for name, value in params.items())})"
+
+
+def run_robustness_benchmark(host, watermark, watermarker=None, alphas=None, attacks=None, max_workers=None, seed=0):
+    """
+    Chạy lưới nhúng -> tấn công -> trích xuất -> NC / BER
+    
+    Args:
+        host: Đường dẫn ảnh gốc hoặc ảnh BGR đã decode
+        watermark: Đường dẫn ảnh watermark hoặc ảnh đã decode
+        watermarker: DWT_DCT_SVD_Watermark / DWT_DCT_SVD_QIM_Watermark (mặc định cấu hình chuẩn)
+        alphas: Các alpha cần so sánh (hàng của ma trận; None = alpha của watermarker,
+            QIM chỉ có 1 hàng với quantization_step của watermarker)
+        attacks: Lưới tấn công (xem parse_attacks)
+        max_workers: Số process song song (None = số CPU, 1 = chạy tuần tự trong process hiện tại)
+        seed: Seed cho các tấn công ngẫu nhiên (mỗi ô dùng seed + số thứ tự ô)
+    
+    Returns:
+        dict: rows (alpha + chất lượng ảnh), attacks (cột), ma trận nc / ber / seconds
+            (hàng x cột, cột đầu là ảnh không bị tấn công), thời gian
+    """
+    if isinstance(watermark, str):
+        watermark = cv2.imread(watermark)
+        if watermark is None:
+            raise ValueError("Cannot read images")
+    
+    watermarker = watermarker if watermarker is not None else DWT_DCT_SVD_Watermark()
+    max_workers = max_workers or os.cpu_count() or 1
+    if max_workers < 1:
+        raise ValueError("max_workers must be >= 1")
+    
+    if watermarker.BLIND:
+        if alphas:
+            raise ValueError("Alpha is not used by the QIM algorithm (use quantization_step)")
+        alphas = [None]
+    elif not alphas:
+        alphas = [watermarker.alpha]
+    
+    columns = [(NO_ATTACK, {})] + parse_attacks(attacks)
+    start = time.perf_counter()
+    
+    # Nhúng từng alpha trên cùng 1 phân rã ảnh gốc
+    fanout = FingerprintFanout(host, watermarker)
+    if fanout.num_bits < fanout.watermark_size ** 2:
+        raise ValueError("Image too small for watermark")
+    
+    rows, images, references, watermarkers = [], [], [], []
+    for alpha in alphas:
+        embed_start = time.perf_counter()
+        watermarked, result = fanout.embed(watermark, alpha=alpha)
+        images.append(watermarked)
+        references.append(fanout.reference(alpha=alpha))
+        watermarkers.append(fanout._with_alpha(alpha))
+        rows.append({
+            'alpha': alpha,
+            'quantization_step': getattr(watermarker, 'quantization_step', None),
+            'quality_metrics': result['quality_metrics'],
+            'embed_seconds': time.perf_counter() - embed_start
+        })
+    
+    # Watermark mong đợi (trước Arnold): so với watermark trích xuất sau khi giải xáo trộn
+    watermark_size = fanout.watermark_size
+    watermark_gray = cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY) if watermark.ndim == 3 else watermark
+    expected = watermarker._binary_watermark(watermark_gray, watermark_size) * 255
+    
+    shape = (len(alphas), len(columns))
+    nc, ber, seconds = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    
+    # Ảnh đã watermark của mọi alpha trong 1 shared memory segment (workers attach theo tên)
+    stacked = np.stack(images)
+    images_shape = stacked.shape
+    segment = shared_memory.SharedMemory(create=True, size=stacked.nbytes)
+    try:
+        np.ndarray(images_shape, dtype=np.uint8, buffer=segment.buf)[:] = stacked
+        del stacked, images
+        tasks = [
+            ((row, column, attack_type, params, seed + row * len(columns) + column),
+             (watermarkers[row], references[row]), (segment.name, images_shape), watermark_size, expected)
+            for row in range(len(alphas))
+            for column, (attack_type, params) in enumerate(columns)
+        ]
+        
+        for row, column, cell_nc, cell_ber, cell_seconds in process_map(_run_cell, tasks, max_workers):
+            nc[row, column], ber[row, column], seconds[row, column] = cell_nc, cell_ber, cell_seconds
+    finally:
+        segment.close()
+        segment.unlink()
+    
+    return {
+        'algorithm': watermarker._algorithm_name(),
+        'watermark_size': f"{watermark_size}x{watermark_size}",
+        'workers': min(max_workers, process_pool_size()),
+        'rows': rows,
+        'attacks': [
+            {'attack': attack_type, 'params': params, 'label': _attack_label(attack_type, params)}
+            for attack_type, params in columns
+        ],
+        'nc': nc.tolist(),
+        'ber': ber.tolist(),
+        'seconds': seconds.tolist(),
+        'total_seconds': time.perf_counter() - start
+    }
+
+
+def _format_table(report):
+    """Bảng NC (BER) dạng text: mỗi hàng 1 alpha, mỗi cột 1 tấn công"""
+    labels = [attack['label'] for attack in report['attacks']]
+    width = max(len(label) for label in labels + ['alpha'])
+    lines = []
+    for row_index, row in enumerate(report['rows']):
+        strength = row['alpha'] if row['alpha'] is not None else f"step={row['quantization_step']}"
+        metrics = ', '.join(f"{name}={value:.4f}" for name, value in row['quality_metrics'].items())
+        lines.append(f"alpha={strength}  ({metrics})")
+        for column, label in enumerate(labels):
+            lines.append(
+                f"  {label:<{width}}  NC {report['nc'][row_index][column]:.4f}  "
+                f"BER {report['ber'][row_index][column]:.4f}  {report['seconds'][row_index][column] * 1000:.0f} ms"
+            )
+    lines.append(f"{report['algorithm']} {report['watermark_size']}, {report['workers']} workers, "
+                 f"{report['total_seconds']:.2f} s")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """CLI: python -m app.core.robustness host.png watermark.png [--alphas ...] [--attacks grid.json]"""
+    parser = argparse.ArgumentParser(description="Watermark robustness benchmark (embed -> attack -> extract -> NC/BER)")
+    parser.add_argument('host', help="Host image")
+    parser.add_argument('watermark', help="Watermark image")
+    parser.add_argument('--algorithm', choices=('svd', 'qim'), default='svd')
+    parser.add_argument('--alphas', type=float, nargs='+', help="Alpha values to compare (SVD)")
+    parser.add_argument('--quantization-step', type=float, default=120.0, help="QIM quantization step")
+    parser.add_argument('--arnold-iterations', type=int, default=10)
+    parser.add_argument('--attacks', help="Attack grid: JSON string or path to a JSON file ({attack: [params, ...]})")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: CPU count)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', help="Write the full report to this JSON file")
+    args = parser.parse_args(argv)
+    
+    if args.algorithm == 'qim':
+        watermarker = DWT_DCT_SVD_QIM_Watermark(quantization_step=args.quantization_step,
+                                                arnold_iterations=args.arnold_iterations)
+    else:
+        watermarker = DWT_DCT_SVD_Watermark(arnold_iterations=args.arnold_iterations)
+    
+    attacks = args.attacks
+    if attacks is not None and os.path.isfile(attacks):
+        with open(attacks, encoding='utf-8') as f:
+            attacks = f.read()
+    
+    try:
+        report = run_robustness_benchmark(
+            args.host, args.watermark, watermarker, alphas=args.alphas, attacks=attacks,
+            max_workers=args.workers, seed=args.seed
+        )
+    except ValueError as e:
+        parser.exit(1, f"error: {e}\n")
+    
+    print(_format_table(report))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
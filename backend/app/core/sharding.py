@@ -0,0 +1,283 @@
+"""
+Sharded Steganography - Chia payload lớn ra nhiều ảnh cover
+Mở rộng LSB_Stego:
+- Mỗi ảnh cover chứa 1 shard kèm shard header (payload id, thứ tự, số shards)
+- Parity shards (XOR xen kẽ) để khôi phục shard bị mất
+- Nhúng / trích xuất các shards song song trong process pool dùng chung (utils.process_map)
+"""
+
+import os
+import struct
+import numpy as np
+from app.core.steganography import LSB_Stego
+from app.core.utils import process_map, process_pool_size
+
+
+def _embed_shard(task):
+    """
+    Worker: nhúng 1 shard vào 1 ảnh cover (chạy trong process pool)
+    
+    Returns:
+        tuple (bytes PNG của ảnh stego nếu output_path là None, ngược lại None; dict kết quả)
+    """
+    config, cover, shard, output_path = task
+    stego = LSB_Stego(**config)
+    if output_path is None:
+        return stego.embed_bytes(cover, shard)
+    return None, stego.embed(cover, shard, output_path)
+
+
+def _extract_shard(task):
+    """
+    Worker: trích xuất 1 shard (chạy trong process pool)
+    
+    Returns:
+        tuple (shard bytes hoặc None, thông báo lỗi hoặc None)
+    """
+    config, stego_image = task
+    stego = LSB_Stego(**config)
+    try:
+        if isinstance(stego_image, (bytes, bytearray)):
+            data = stego.extract_bytes(stego_image)
+        else:
+            data = stego.extract(stego_image)
+    except ValueError as e:
+        return None, str(e)
+    if not isinstance(data, bytes):
+        return None, "Image does not contain a shard"
+    return data, None
+
+
+class ShardedStego:
+    """
+    Class giấu 1 payload lớn trong nhiều ảnh cover
+    
+    Payload được chia thành D data shards bằng nhau và P parity shards
+    (parity shard g = XOR các data shard có index % P == g), mỗi shard được
+    nhúng vào 1 ảnh bằng LSB_Stego. Mỗi nhóm parity khôi phục được 1 data
+    shard bị mất. Các ảnh có thể được đưa vào theo thứ tự bất kỳ khi extract.
+    
+    Các shards có cùng kích thước nên payload tối đa là D x capacity của ảnh
+    cover nhỏ nhất (không phải tổng capacity các ảnh).
+    """
+    
+    # Shard header: magic, version, flags, payload id, index, data shards, parity shards, độ dài payload
+    SHARD_MAGIC = b'SHRD'
+    SHARD_VERSION = 1
+    SHARD_STRUCT = struct.Struct('>4sBB8sHHHQ')
+    
+    FLAG_BINARY = 0x01  # Payload là file (bytes), không phải text UTF-8
+    FLAG_COMPRESSION_SHIFT = 6  # Bits 6-7: thuật toán nén (giống LSB_Stego)
+    
+    def __init__(self, use_encryption=False, password=None, use_adaptive=False, use_pseudorandom=False, seed=None,
+                 bits_per_channel=1, use_compression=False, parity_shards=0, max_workers=None):
+        """
+        Args:
+            use_encryption, password, use_adaptive, use_pseudorandom, seed, bits_per_channel:
+                Cấu hình LSB_Stego cho từng shard
+            use_compression: Nén toàn bộ payload trước khi chia shard
+            parity_shards: Số parity shards (0 = không dùng parity)
+            max_workers: Số shards xử lý song song (None = số CPU, tối đa số CPU; 1 = chạy tuần tự)
+        """
+        self.config = {
+            'use_encryption': use_encryption,
+            'password': password,
+            'use_adaptive': use_adaptive,
+            'use_pseudorandom': use_pseudorandom,
+            'seed': seed,
+            'bits_per_channel': bits_per_channel,
+        }
+        # Kiểm tra cấu hình ngay (raise ValueError giống LSB_Stego)
+        self.stego = LSB_Stego(use_compression=use_compression, **self.config)
+        
+        if parity_shards < 0:
+            raise ValueError("parity_shards must be >= 0")
+        
+        # Các request dùng chung 1 process pool (số CPU): không tạo process mới mỗi lần gọi
+        self.use_compression = use_compression
+        self.parity_shards = parity_shards
+        self.max_workers = min(max_workers or process_pool_size(), process_pool_size())
+        
+        if self.max_workers < 1:
+            raise ValueError("max_workers must be >= 1")
+    
+    def _map(self, function, tasks):
+        """Chạy function trên các tasks, song song trong process pool dùng chung nếu có thể"""
+        return process_map(function, tasks, self.max_workers)
+    
+    def _parity(self, shards, group):
+        """XOR các shards thuộc nhóm parity group"""
+        parity = np.zeros(len(shards[0]), dtype=np.uint8)
+        for index in range(group, len(shards), self.parity_shards):
+            parity ^= np.frombuffer(shards[index], dtype=np.uint8)
+        return parity.tobytes()
+    
+    def split(self, secret_message, num_covers):
+        """
+        Chia payload thành data shards + parity shards (kèm shard header)
+        
+        Args:
+            secret_message: str (text UTF-8) hoặc bytes (file)
+            num_covers: Tổng số ảnh cover
+        
+        Returns:
+            list[bytes]: num_covers shards
+        """
+        data_shards = num_covers - self.parity_shards
+        if data_shards < 1:
+            raise ValueError(f"Need more covers than parity shards ({self.parity_shards})")
+        if self.parity_shards > data_shards:
+            raise ValueError("parity_shards cannot exceed the number of data shards")
+        
+        is_binary = isinstance(secret_message, (bytes, bytearray))
+        payload = bytes(secret_message) if is_binary else secret_message.encode('utf-8')
+        
+        compression = LSB_Stego.COMPRESSION_NONE
+        if self.use_compression:
+            payload, compression = self.stego._compress_payload(payload)
+        
+        flags = compression << self.FLAG_COMPRESSION_SHIFT
+        if is_binary:
+            flags |= self.FLAG_BINARY
+        
+        # Data shards bằng nhau (pad 0 cho shard cuối)
+        shard_size = max(1, -(-len(payload) // data_shards))
+        padded = payload.ljust(shard_size * data_shards, b'\x00')
+        shards = [padded[i * shard_size:(i + 1) * shard_size] for i in range(data_shards)]
+        shards += [self._parity(shards, group) for group in range(self.parity_shards)]
+        
+        payload_id = os.urandom(8)
+        return [
+            self.SHARD_STRUCT.pack(
+                self.SHARD_MAGIC, self.SHARD_VERSION, flags, payload_id,
+                index, data_shards, self.parity_shards, len(payload)
+            ) + shard
+            for index, shard in enumerate(shards)
+        ]
+    
+    def join(self, shards):
+        """
+        Ghép các shards (thứ tự bất kỳ, có thể thiếu / None) thành payload
+        
+        Returns:
+            str (text) hoặc bytes (file)
+        """
+        parsed = {}
+        meta = None
+        header_size = self.SHARD_STRUCT.size
+        
+        for shard in shards:
+            if shard is None or len(shard) < header_size:
+                continue
+            magic, version, flags, payload_id, index, data_shards, parity_shards, length = \
+                self.SHARD_STRUCT.unpack(shard[:header_size])
+            if magic != self.SHARD_MAGIC or version != self.SHARD_VERSION:
+                continue
+            
+            shard_meta = (flags, payload_id, data_shards, parity_shards, length)
+            if meta is None:
+                meta = shard_meta
+            elif shard_meta != meta:
+                raise ValueError("Shards belong to different payloads")
+            parsed[index] = shard[header_size:]
+        
+        if meta is None:
+            raise ValueError("No hidden shards found")
+        
+        flags, _, data_shards, parity_shards, length = meta
+        
+        # Khôi phục data shard bị mất bằng parity (mỗi nhóm tối đa 1 shard)
+        for index in range(data_shards):
+            if index in parsed:
+                continue
+            
+            group = index % parity_shards if parity_shards else 0
+            members = [m for m in range(group, data_shards, max(parity_shards, 1)) if m != index]
+            parity_index = data_shards + group
+            if not parity_shards or parity_index not in parsed or any(m not in parsed for m in members):
+                raise ValueError(f"Shard {index} is missing and cannot be recovered")
+            
+            recovered = np.frombuffer(parsed[parity_index], dtype=np.uint8).copy()
+            for member in members:
+                recovered ^= np.frombuffer(parsed[member], dtype=np.uint8)
+            parsed[index] = recovered.tobytes()
+        
+        payload = b''.join(parsed[index] for index in range(data_shards))[:length]
+        payload = self.stego._decompress_payload(payload, flags >> self.FLAG_COMPRESSION_SHIFT)
+        
+        if flags & self.FLAG_BINARY:
+            return payload
+        return payload.decode('utf-8')
+    
+    def embed(self, cover_paths, secret_message, output_paths):
+        """
+        Nhúng payload vào nhiều ảnh cover song song
+        
+        Args:
+            cover_paths: Danh sách đường dẫn ảnh cover
+            secret_message: str (text) hoặc bytes (file)
+            output_paths: Danh sách đường dẫn lưu ảnh stego (cùng độ dài)
+        
+        Returns:
+            dict: Thông tin về quá trình nhúng
+        """
+        if len(cover_paths) != len(output_paths):
+            raise ValueError("cover_paths and output_paths must have the same length")
+        
+        _, result = self._embed_shards(cover_paths, secret_message, output_paths)
+        return result
+    
+    def embed_bytes(self, cover_images, secret_message):
+        """
+        Nhúng payload vào nhiều ảnh cover đã mã hóa (bytes của file upload), không qua file tạm
+        
+        Args:
+            cover_images: Danh sách bytes ảnh cover
+            secret_message: str (text) hoặc bytes (file)
+        
+        Returns:
+            tuple (list[bytes], dict): ảnh stego PNG theo thứ tự cover, thông tin như embed
+        """
+        return self._embed_shards(cover_images, secret_message, [None] * len(cover_images))
+    
+    def _embed_shards(self, covers, secret_message, output_paths):
+        """Chia payload và nhúng từng shard song song (output_path None: trả về bytes PNG)"""
+        shards = self.split(secret_message, len(covers))
+        tasks = [
+            (self.config, cover, shard, output_path)
+            for cover, shard, output_path in zip(covers, shards, output_paths)
+        ]
+        images, results = zip(*self._map(_embed_shard, tasks))
+        
+        return list(images), {
+            'success': True,
+            'message_length': len(secret_message),
+            'num_covers': len(covers),
+            'data_shards': len(covers) - self.parity_shards,
+            'parity_shards': self.parity_shards,
+            'shard_bytes': len(shards[0]),
+            'bits_used': sum(result['bits_used'] for result in results),
+            'capacity': sum(result['capacity'] for result in results),
+            'encrypted': self.config['use_encryption'],
+            'shards': list(results)
+        }
+    
+    def extract(self, stego_paths):
+        """
+        Trích xuất payload từ nhiều ảnh stego song song
+        
+        Args:
+            stego_paths: Danh sách đường dẫn hoặc bytes ảnh stego (thứ tự bất kỳ)
+        
+        Returns:
+            str (text) hoặc bytes (file)
+        """
+        tasks = [(self.config, stego_path) for stego_path in stego_paths]
+        results = self._map(_extract_shard, tasks)
+        
+        shards = [shard for shard, _ in results]
+        if all(shard is None for shard in shards):
+            errors = [error for _, error in results if error]
+            raise ValueError(errors[0] if errors else "No hidden shards found")
+        
+        return self.join(shards)
@@ -6,12 +6,164 @@ Chuẩn học thuật theo:
 - LSB Pseudorandom Algorithm using Skew Tent Map (2019)
 """
 
+import io
 import numpy as np
 import cv2
+from PIL import Image
 from Crypto.Cipher import AES
-from Crypto.Util.Padding import pad, unpad
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Util.Padding import unpad
 from Crypto.Random import get_random_bytes
+from functools import lru_cache
 import hashlib
+from app.core.utils import calculate_psnr, encode_image, load_image
+import struct
+import zlib
+import lzma
+import threading
+from collections import OrderedDict
+
+
+@lru_cache(maxsize=128)
+def _derive_key(password, salt, iterations):
+    """
+    Sinh AES key từ password + salt bằng PBKDF2-HMAC-SHA256
+    
+    Được memoize theo (password, salt, iterations) nên extract lặp lại
+    trên cùng ảnh không phải chạy lại KDF. Password được mã hóa UTF-8 (như
+    key AES-CBC cũ) để mật khẩu tiếng Việt dùng được.
+    """
+    return PBKDF2(password.encode('utf-8'), salt, dkLen=32, count=iterations, hmac_hash_module=SHA256)
+
+
+class EdgeMapCache:
+    """
+    LRU cache kết quả phân tích edge (Adaptive LSB) theo content hash
+    
+    Key là hash của các bit plane cao (đúng phần dữ liệu Canny nhìn thấy),
+    nên ảnh cover và ảnh stego sinh ra từ nó dùng chung 1 entry. Edge map
+    được lưu dạng packed bits (1 bit/pixel) để giới hạn bộ nhớ với ảnh lớn.
+    An toàn khi dùng từ nhiều thread (API chạy embed trong executor).
+    """
+    
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        """Lấy entry (packed edge map, shape, số pixel edge) hoặc None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+    
+    def put(self, key, entry):
+        """Thêm entry, loại entry ít dùng nhất khi vượt maxsize"""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        """Xóa toàn bộ cache và bộ đếm"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+    
+    def stats(self):
+        """Thống kê cache: số entries, hits, misses"""
+        with self._lock:
+            return {'entries': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+
+# Cache dùng chung cho mọi instance LSB_Stego (capacity preflight -> embed -> extract)
+edge_map_cache = EdgeMapCache()
+
+
+class KeyedPermutation:
+    """
+    Hoán vị giả ngẫu nhiên có khóa trên miền chỉ số [0, N)
+    
+    Dùng mạng Feistel cân bằng trên miền 2^(2h) >= N kết hợp cycle-walking
+    (format-preserving): giá trị rơi ra ngoài [0, N) được hoán vị tiếp cho
+    đến khi quay về miền. Mỗi vị trí được tính độc lập nên có thể lấy
+    N vị trí đầu tiên theo yêu cầu mà không cần xáo trộn toàn bộ ảnh.
+    
+    Round keys sinh từ generator riêng của instance (np.random.default_rng),
+    không đụng vào trạng thái global của np.random.
+    """
+    
+    ROUNDS = 4
+    
+    _MUL1 = np.uint64(0xBF58476D1CE4E5B9)
+    _MUL2 = np.uint64(0x94D049BB133111EB)
+    
+    def __init__(self, domain_size, seed):
+        """
+        Args:
+            domain_size: Kích thước miền N (số samples H*W*3)
+            seed: Khóa của hoán vị
+        """
+        if domain_size <= 0:
+            raise ValueError("Permutation domain must be non-empty")
+        
+        self.domain_size = domain_size
+        self.half_bits = max(1, ((domain_size - 1).bit_length() + 1) // 2)
+        self.half_mask = np.uint64((1 << self.half_bits) - 1)
+        
+        rng = np.random.default_rng(seed)
+        self.round_keys = rng.integers(0, 2 ** 63, size=self.ROUNDS, dtype=np.uint64)
+    
+    def _round(self, right, key):
+        """Hàm vòng F(R, K): trộn bit kiểu splitmix64 rồi cắt về h bits"""
+        x = (right ^ key) * self._MUL1
+        x ^= x >> np.uint64(31)
+        x *= self._MUL2
+        x ^= x >> np.uint64(29)
+        return x & self.half_mask
+    
+    def _encrypt(self, values):
+        """Áp dụng các vòng Feistel lên mảng uint64"""
+        shift = np.uint64(self.half_bits)
+        left = values >> shift
+        right = values & self.half_mask
+        for key in self.round_keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << shift) | right
+    
+    def __call__(self, indices):
+        """
+        Tính vị trí hoán vị cho mảng chỉ số
+        
+        Args:
+            indices: Mảng chỉ số trong [0, N)
+        
+        Returns:
+            Mảng vị trí int64 trong [0, N) (không trùng lặp)
+        """
+        values = self._encrypt(np.asarray(indices, dtype=np.uint64))
+        
+        # Cycle-walking: hoán vị tiếp các giá trị nằm ngoài miền
+        pending = np.flatnonzero(values >= self.domain_size)
+        while pending.size:
+            values[pending] = self._encrypt(values[pending])
+            pending = pending[values[pending] >= self.domain_size]
+        
+        return values.astype(np.int64)
+    
+    def positions(self, start, stop):
+        """Vị trí của các bits thứ [start, stop) trong thứ tự giả ngẫu nhiên"""
+        return self(np.arange(start, stop, dtype=np.uint64))
 
 
 class LSB_Stego:
@@ -21,12 +173,47 @@ class LSB_Stego:
     Cải tiến theo chuẩn học thuật:
     1. Adaptive LSB: Nhúng nhiều bits ở vùng edge, ít bits ở vùng smooth
     2. Pseudorandom embedding: Nhúng theo thứ tự ngẫu nhiên thay vì tuần tự
-    3. AES encryption: Mã hóa message trước khi nhúng
+    3. AES-GCM encryption: Mã hóa + xác thực từng chunk (payload dạng bytes, không hex)
+    4. k-bit LSB + OPAP: Nhúng k bits/kênh, giảm distortion bằng OPAP (Chan & Cheng 2004)
     """
     
-    DELIMITER = "<<<END_OF_MESSAGE>>>"
+    DELIMITER = "<<<END_OF_MESSAGE>>>"  # Định dạng cũ (legacy), chỉ dùng khi extract
+    
+    # Header nhị phân đặt trước payload: magic, version, flags, độ dài payload, CRC32
+    # Version 1: payload là text latin-1, ciphertext dạng hex (chỉ còn đọc)
+    # Version 2: payload là raw bytes (UTF-8 text hoặc file), có thể nén, AES-CBC
+    # Version 3: như version 2 nhưng mã hóa AES-GCM theo từng chunk
+    HEADER_MAGIC = b'LSBS'
+    HEADER_VERSION = 3
+    SUPPORTED_HEADER_VERSIONS = (1, 2, 3)
+    HEADER_STRUCT = struct.Struct('>4sBBII')
+    HEADER_BITS = HEADER_STRUCT.size * 8
+    
+    # Mode flags trong header
+    FLAG_ENCRYPTED = 0x01
+    FLAG_ADAPTIVE = 0x02
+    FLAG_PSEUDORANDOM = 0x04
+    FLAG_BINARY = 0x08  # Payload là file (bytes), không phải text UTF-8
+    FLAG_BITS_SHIFT = 4  # Bits 4-5 của flags lưu (k - 1) của k-bit LSB
+    FLAG_COMPRESSION_SHIFT = 6  # Bits 6-7 của flags lưu thuật toán nén
+    
+    COMPRESSION_NONE = 0
+    COMPRESSION_ZLIB = 1
+    COMPRESSION_LZMA = 2
+    COMPRESSION_NAMES = {COMPRESSION_NONE: None, COMPRESSION_ZLIB: 'zlib', COMPRESSION_LZMA: 'lzma'}
+    
+    MAX_BITS_PER_CHANNEL = 4
+    
+    # Luồng payload được xử lý theo chunk để giới hạn bộ nhớ
+    STREAM_CHUNK_SIZE = 64 * 1024
     
-    def __init__(self, use_encryption=False, password=None, use_adaptive=False, use_pseudorandom=False, seed=None):
+    # Mã hóa chunked AES-GCM: preamble (salt, nonce prefix, chunk size), mỗi chunk = ciphertext + tag
+    KDF_ITERATIONS = 200_000
+    ENCRYPTION_PREAMBLE = struct.Struct('>16s8sI')
+    ENCRYPTION_TAG_SIZE = 16
+    
+    def __init__(self, use_encryption=False, password=None, use_adaptive=False, use_pseudorandom=False, seed=None,
+                 bits_per_channel=1, use_compression=False):
         """
         Args:
             use_encryption: Có mã hóa message trước khi nhúng không
@@ -34,35 +221,152 @@ class LSB_Stego:
             use_adaptive: Sử dụng Adaptive LSB (nhúng nhiều bits ở edge)
             use_pseudorandom: Sử dụng pseudorandom embedding (tăng security)
             seed: Seed cho pseudorandom (nếu use_pseudorandom=True)
+            bits_per_channel: Số bits nhúng vào mỗi kênh (k = 1..4, k > 1 dùng OPAP)
+            use_compression: Nén payload (zlib hoặc LZMA, chọn bản nhỏ hơn)
         """
         self.use_encryption = use_encryption
         self.password = password
         self.use_adaptive = use_adaptive
         self.use_pseudorandom = use_pseudorandom
         self.seed = seed if seed is not None else 42
+        self.bits_per_channel = bits_per_channel
+        self.use_compression = use_compression
+        self._permutations = {}
         
         if use_encryption and not password:
             raise ValueError("Password is required when encryption is enabled")
+        if not 1 <= bits_per_channel <= self.MAX_BITS_PER_CHANNEL:
+            raise ValueError(f"bits_per_channel must be between 1 and {self.MAX_BITS_PER_CHANNEL}")
+        if use_adaptive and bits_per_channel != 1:
+            raise ValueError("Adaptive LSB does not support bits_per_channel > 1")
     
     def _get_key(self):
-        """Tạo AES key từ password"""
+        """Tạo AES key từ password (định dạng cũ AES-CBC, chỉ dùng khi extract)"""
         return hashlib.sha256(self.password.encode()).digest()
     
-    def _encrypt_message(self, message):
-        """Mã hóa message bằng AES"""
-        key = self._get_key()
-        cipher = AES.new(key, AES.MODE_CBC)
-        ct_bytes = cipher.encrypt(pad(message.encode(), AES.block_size))
-        iv = cipher.iv
-        return iv + ct_bytes
-    
     def _decrypt_message(self, encrypted_data):
-        """Giải mã message"""
+        """Giải mã message AES-CBC của định dạng cũ (version <= 2), trả về bytes"""
         key = self._get_key()
         iv = encrypted_data[:16]
         ct = encrypted_data[16:]
         cipher = AES.new(key, AES.MODE_CBC, iv)
-        return unpad(cipher.decrypt(ct), AES.block_size).decode()
+        return unpad(cipher.decrypt(ct), AES.block_size)
+    
+    def _chunk_nonce(self, prefix, index):
+        """Nonce của chunk thứ index: prefix ngẫu nhiên (8 bytes) + counter (4 bytes)"""
+        return prefix + struct.pack('>I', index)
+    
+    def _encrypted_length(self, plaintext_length):
+        """Độ dài payload sau khi mã hóa chunked AES-GCM"""
+        num_chunks = max(1, -(-plaintext_length // self.STREAM_CHUNK_SIZE))
+        return self.ENCRYPTION_PREAMBLE.size + plaintext_length + num_chunks * self.ENCRYPTION_TAG_SIZE
+    
+    def _max_plaintext_length(self, payload_length):
+        """Độ dài plaintext lớn nhất vừa với payload_length bytes sau khi mã hóa (nghịch đảo _encrypted_length)"""
+        available = payload_length - self.ENCRYPTION_PREAMBLE.size
+        frame_size = self.STREAM_CHUNK_SIZE + self.ENCRYPTION_TAG_SIZE
+        full_frames, remainder = divmod(max(available, 0), frame_size)
+        return full_frames * self.STREAM_CHUNK_SIZE + max(remainder - self.ENCRYPTION_TAG_SIZE, 0)
+    
+    def _encrypt_chunks(self, data):
+        """
+        Mã hóa payload bằng AES-GCM theo từng chunk (generator)
+        
+        Key sinh bằng PBKDF2 với salt ngẫu nhiên. Mỗi chunk có nonce riêng
+        (prefix + counter) và associated data đánh dấu chunk cuối, nên không
+        thể đổi thứ tự, lặp lại hay cắt bớt chunk mà không bị phát hiện.
+        
+        Yields:
+            bytes: Preamble, sau đó từng chunk ciphertext + tag
+        """
+        salt = get_random_bytes(16)
+        prefix = get_random_bytes(8)
+        key = _derive_key(self.password, salt, self.KDF_ITERATIONS)
+        yield self.ENCRYPTION_PREAMBLE.pack(salt, prefix, self.STREAM_CHUNK_SIZE)
+        
+        view = memoryview(data)
+        num_chunks = max(1, -(-len(data) // self.STREAM_CHUNK_SIZE))
+        for index in range(num_chunks):
+            chunk = view[index * self.STREAM_CHUNK_SIZE:(index + 1) * self.STREAM_CHUNK_SIZE]
+            cipher = AES.new(key, AES.MODE_GCM, nonce=self._chunk_nonce(prefix, index))
+            cipher.update(b'\x01' if index == num_chunks - 1 else b'\x00')
+            ciphertext, tag = cipher.encrypt_and_digest(chunk)
+            yield ciphertext + tag
+    
+    def _decrypt_chunks(self, read_bytes, length):
+        """
+        Đọc và giải mã từng chunk AES-GCM ngay từ ảnh (streaming)
+        
+        Mỗi chunk được xác thực ngay sau khi đọc nên sai password sẽ bị
+        phát hiện ở chunk đầu tiên thay vì sau khi decode toàn bộ ảnh.
+        
+        Args:
+            read_bytes: Hàm read_bytes(offset, size) đọc bytes của payload
+            length: Độ dài payload (bytes) trong header
+        
+        Returns:
+            tuple (plaintext, crc): plaintext và CRC32 của payload đã đọc
+        """
+        preamble_size = self.ENCRYPTION_PREAMBLE.size
+        if length < preamble_size + self.ENCRYPTION_TAG_SIZE:
+            raise ValueError("Encrypted payload is corrupted")
+        
+        preamble = read_bytes(0, preamble_size)
+        crc = zlib.crc32(preamble)
+        salt, prefix, chunk_size = self.ENCRYPTION_PREAMBLE.unpack(preamble)
+        if chunk_size == 0:
+            raise ValueError("Encrypted payload is corrupted")
+        key = _derive_key(self.password, salt, self.KDF_ITERATIONS)
+        
+        frame_size = chunk_size + self.ENCRYPTION_TAG_SIZE
+        offset = preamble_size
+        index = 0
+        plaintext = []
+        
+        while offset < length:
+            size = min(frame_size, length - offset)
+            if size < self.ENCRYPTION_TAG_SIZE:
+                raise ValueError("Encrypted payload is corrupted")
+            
+            frame = read_bytes(offset, size)
+            crc = zlib.crc32(frame, crc)
+            offset += size
+            
+            cipher = AES.new(key, AES.MODE_GCM, nonce=self._chunk_nonce(prefix, index))
+            cipher.update(b'\x01' if offset >= length else b'\x00')
+            try:
+                plaintext.append(cipher.decrypt_and_verify(
+                    frame[:-self.ENCRYPTION_TAG_SIZE], frame[-self.ENCRYPTION_TAG_SIZE:]
+                ))
+            except ValueError:
+                raise ValueError("Wrong password or corrupted data")
+            index += 1
+        
+        return b''.join(plaintext), crc
+    
+    def _compress_payload(self, data):
+        """
+        Nén payload bằng zlib và LZMA, giữ bản nhỏ nhất (kể cả không nén)
+        
+        Returns:
+            tuple (data, compression): dữ liệu và mã thuật toán nén
+        """
+        candidates = [
+            (data, self.COMPRESSION_NONE),
+            (zlib.compress(data, 9), self.COMPRESSION_ZLIB),
+            (lzma.compress(data, preset=9 | lzma.PRESET_EXTREME), self.COMPRESSION_LZMA),
+        ]
+        return min(candidates, key=lambda candidate: len(candidate[0]))
+    
+    def _decompress_payload(self, data, compression):
+        """Giải nén payload theo mã thuật toán nén trong header"""
+        if compression == self.COMPRESSION_ZLIB:
+            return zlib.decompress(data)
+        if compression == self.COMPRESSION_LZMA:
+            return lzma.decompress(data)
+        if compression != self.COMPRESSION_NONE:
+            raise ValueError(f"Unknown compression method: {compression}")
+        return data
     
     def _text_to_binary(self, text):
         """Chuyển text sang chuỗi binary"""
@@ -73,48 +377,397 @@ class LSB_Stego:
         chars = [binary[i:i+8] for i in range(0, len(binary), 8)]
         return ''.join(chr(int(char, 2)) for char in chars)
     
+    def _text_to_bytes(self, text):
+        """Chuyển text sang bytes (mỗi ký tự 1 byte như _text_to_binary, dùng cho định dạng cũ)"""
+        return text.encode('latin-1')
+    
+    def _bytes_to_bits(self, data):
+        """Chuyển bytes sang mảng bits uint8 (MSB trước) bằng np.unpackbits"""
+        return np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+    
+    def _bits_to_bytes(self, bits):
+        """Chuyển mảng bits uint8 (MSB trước) về bytes bằng np.packbits"""
+        return np.packbits(bits).tobytes()
+    
+    def _sample_order(self, total_positions, pseudorandom=None):
+        """
+        Thứ tự các samples dùng để nhúng
+        
+        Args:
+            total_positions: Số samples của ảnh
+            pseudorandom: Dùng thứ tự pseudorandom (mặc định theo self.use_pseudorandom)
+        
+        Returns:
+            Hàm order(start, stop) trả về slice (tuần tự) hoặc mảng vị trí
+            (pseudorandom) của các samples thứ [start, stop)
+        """
+        if pseudorandom is None:
+            pseudorandom = self.use_pseudorandom
+        if pseudorandom:
+            return self._get_permutation(total_positions).positions
+        return slice
+    
+    def _stream_capacity(self, total_positions, k):
+        """Số bits tối đa: header ở 1 bit/sample, payload ở k bits/sample"""
+        if total_positions <= self.HEADER_BITS:
+            return total_positions
+        return self.HEADER_BITS + (total_positions - self.HEADER_BITS) * k
+    
+    def _embed_header_bits(self, flat_image, order, bits):
+        """Nhúng header vào LSB của HEADER_BITS samples đầu tiên theo thứ tự samples"""
+        positions = order(0, len(bits))
+        flat_image[positions] = (flat_image[positions] & 0xFE) | bits
+    
+    def _embed_symbols(self, flat_image, order, first_symbol, bits, k=1):
+        """
+        Nhúng bits payload dạng symbols k bits (BIT-PLANE ENGINE)
+        
+        Bits được gom thành các symbol k bits (MSB trước) và thay k bits thấp
+        của mỗi sample, sau đó áp dụng OPAP khi k > 1. Ghi trực tiếp (in-place)
+        lên view phẳng của ảnh và chỉ chạm vào các samples cần thiết nên chi
+        phí tỉ lệ với kích thước payload.
+        
+        Args:
+            flat_image: View uint8 1 chiều của ảnh (H*W*3)
+            order: Hàm order(start, stop) từ _sample_order
+            first_symbol: Chỉ số symbol đầu tiên trong vùng payload
+            bits: Mảng bits uint8 (0/1), symbol cuối được pad 0
+            k: Số bits/sample cho phần payload
+        """
+        if len(bits) == 0:
+            return
+        
+        # Gom bits thành symbols k bits (pad 0 cho symbol cuối)
+        num_symbols = -(-len(bits) // k)
+        padded = np.zeros(num_symbols * k, dtype=np.uint8)
+        padded[:len(bits)] = bits
+        weights = (1 << np.arange(k - 1, -1, -1)).astype(np.uint8)
+        symbols = (padded.reshape(-1, k) * weights).sum(axis=1, dtype=np.uint8)
+        
+        start = self.HEADER_BITS + first_symbol
+        positions = order(start, start + num_symbols)
+        original = flat_image[positions]
+        mask = np.uint8((0xFF << k) & 0xFF)
+        stego = (original & mask) | symbols
+        
+        if k > 1:
+            stego = self._optimal_pixel_adjustment(original, stego, k)
+        
+        flat_image[positions] = stego
+    
+    def _embed_stream(self, flat_image, chunks, order=None, capacity_index=None, k=1):
+        """
+        Nhúng lần lượt từng chunk bytes vào vùng payload (ngay sau header)
+        
+        Mỗi chunk được chuyển sang bits và ghi ngay nên bộ nhớ trung gian
+        (mảng bits, mảng vị trí) chỉ tỉ lệ với kích thước chunk. Với k-bit,
+        các bits lẻ cuối chunk được giữ lại để ghép vào symbol đầu chunk sau.
+        
+        Args:
+            flat_image: View uint8 1 chiều của ảnh
+            chunks: Iterable các chunk bytes
+            order: Hàm order từ _sample_order (standard/pseudorandom)
+            capacity_index: Capacity map (adaptive)
+            k: Số bits/sample (standard/pseudorandom)
+        
+        Returns:
+            tuple (length, crc): tổng số bytes đã nhúng và CRC32 của chúng
+        """
+        length = 0
+        crc = 0
+        position = self.HEADER_BITS if capacity_index is not None else 0
+        carry = np.zeros(0, dtype=np.uint8)
+        
+        for chunk in chunks:
+            length += len(chunk)
+            crc = zlib.crc32(chunk, crc)
+            bits = self._bytes_to_bits(chunk)
+            
+            if capacity_index is not None:
+                self._embed_bits_adaptive(flat_image, bits, capacity_index, start=position)
+                position += len(bits)
+                continue
+            
+            if len(carry):
+                bits = np.concatenate([carry, bits])
+            usable = len(bits) - len(bits) % k
+            carry = bits[usable:]
+            self._embed_symbols(flat_image, order, position, bits[:usable], k)
+            position += usable // k
+        
+        if capacity_index is None:
+            self._embed_symbols(flat_image, order, position, carry, k)
+        
+        return length, crc
+    
+    def _read_bits_kbit(self, flat_image, order, start, stop, k=1):
+        """
+        Đọc các bits thứ [start, stop) theo thứ tự samples (gather vectorized)
+        
+        Args:
+            flat_image: View uint8 1 chiều của ảnh
+            order: Hàm order(start, stop) từ _sample_order
+            start, stop: Khoảng bits cần đọc
+            k: Số bits/sample của phần payload
+        """
+        chunks = []
+        
+        # Phần header: 1 bit/sample
+        if start < self.HEADER_BITS:
+            header_stop = min(stop, self.HEADER_BITS)
+            chunks.append(flat_image[order(start, header_stop)] & 1)
+            start = header_stop
+        
+        # Phần payload: k bits/sample
+        if start < stop:
+            first = (start - self.HEADER_BITS) // k
+            last = -(-(stop - self.HEADER_BITS) // k)
+            positions = order(self.HEADER_BITS + first, self.HEADER_BITS + last)
+            values = flat_image[positions] & np.uint8((1 << k) - 1)
+            bits = np.unpackbits(values[:, None], axis=1)[:, 8 - k:].reshape(-1)
+            offset = start - self.HEADER_BITS - first * k
+            chunks.append(bits[offset:offset + stop - start])
+        
+        if not chunks:
+            return np.zeros(0, dtype=np.uint8)
+        return np.concatenate(chunks)
+    
+    def _decode_delimited(self, read_bits, total_bits):
+        """
+        Tìm DELIMITER trong luồng bits, đọc từng đoạn tăng dần (x2)
+        
+        Chỉ đọc thêm bits khi chưa thấy DELIMITER nên tổng chi phí
+        tỉ lệ với độ dài message thay vì kích thước ảnh.
+        
+        Args:
+            read_bits: Hàm read_bits(start, stop) trả về mảng bits
+            total_bits: Tổng số bits có thể đọc
+        
+        Returns:
+            bytes: Nội dung trước DELIMITER
+        """
+        delimiter = self._text_to_bytes(self.DELIMITER)
+        data = b''
+        bits_read = 0
+        chunk_bits = 8 * 1024
+        
+        while bits_read < total_bits:
+            stop = min(total_bits, bits_read + chunk_bits)
+            stop -= (stop - bits_read) % 8
+            if stop <= bits_read:
+                break
+            
+            search_from = max(0, len(data) - len(delimiter) + 1)
+            data += self._bits_to_bytes(read_bits(bits_read, stop))
+            bits_read = stop
+            
+            end = data.find(delimiter, search_from)
+            if end != -1:
+                return data[:end]
+            
+            chunk_bits *= 2
+        
+        raise ValueError("No hidden message found or image corrupted")
+    
+    def _mode_flags(self, is_binary=False, compression=COMPRESSION_NONE):
+        """Tính mode flags cho header từ cấu hình hiện tại"""
+        flags = 0
+        if self.use_encryption:
+            flags |= self.FLAG_ENCRYPTED
+        if self.use_adaptive:
+            flags |= self.FLAG_ADAPTIVE
+        if self.use_pseudorandom:
+            flags |= self.FLAG_PSEUDORANDOM
+        if is_binary:
+            flags |= self.FLAG_BINARY
+        flags |= (self.bits_per_channel - 1) << self.FLAG_BITS_SHIFT
+        flags |= compression << self.FLAG_COMPRESSION_SHIFT
+        return flags
+    
+    def _flags_bits_per_channel(self, flags):
+        """Đọc k (bits/kênh) từ mode flags"""
+        return ((flags >> self.FLAG_BITS_SHIFT) & 0x03) + 1
+    
+    def _pack_header(self, length, crc, flags):
+        """Tạo header nhị phân (magic, version, flags, length, CRC32) cho payload"""
+        return self.HEADER_STRUCT.pack(
+            self.HEADER_MAGIC, self.HEADER_VERSION, flags, length, crc
+        )
+    
+    def _unpack_header(self, header_bytes):
+        """
+        Đọc header nhị phân
+        
+        Returns:
+            tuple (version, flags, length, crc) hoặc None nếu không phải header hợp lệ
+        """
+        magic, version, flags, length, crc = self.HEADER_STRUCT.unpack(header_bytes)
+        if magic != self.HEADER_MAGIC or version not in self.SUPPORTED_HEADER_VERSIONS:
+            return None
+        return version, flags, length, crc
+    
+    def _read_header(self, read_bits, capacity_bits):
+        """
+        Đọc header ở HEADER_BITS bits đầu tiên
+        
+        Returns:
+            tuple (version, flags, length, crc) hoặc None nếu không có header hợp lệ
+        """
+        if capacity_bits(1) < self.HEADER_BITS:
+            return None
+        return self._unpack_header(self._bits_to_bytes(read_bits(0, self.HEADER_BITS)))
+    
+    def _read_payload(self, read_bits, capacity_bits, header):
+        """
+        Đọc đúng length bytes payload ngay sau header rồi dừng
+        
+        Args:
+            read_bits: Hàm read_bits(start, stop, k=1) trả về mảng bits
+            capacity_bits: Hàm capacity_bits(k) trả về tổng số bits có thể đọc
+            header: Kết quả của _read_header
+        
+        Returns:
+            bytes: Payload; với version 3, payload mã hóa đã được giải mã từng chunk
+        """
+        version, flags, length, crc = header
+        k = self._flags_bits_per_channel(flags)
+        payload_end = self.HEADER_BITS + length * 8
+        if payload_end > capacity_bits(k):
+            raise ValueError("Corrupted header: payload length exceeds image capacity")
+        
+        def read_bytes(offset, size):
+            start = self.HEADER_BITS + offset * 8
+            return self._bits_to_bytes(read_bits(start, start + size * 8, k))
+        
+        if version >= 3 and flags & self.FLAG_ENCRYPTED:
+            # Giải mã + xác thực từng chunk ngay khi đọc
+            if not self.use_encryption:
+                raise ValueError("Hidden message is encrypted. Password is required")
+            payload, payload_crc = self._decrypt_chunks(read_bytes, length)
+        else:
+            # Đọc theo chunk để giới hạn bộ nhớ trung gian
+            chunks = []
+            payload_crc = 0
+            for offset in range(0, length, self.STREAM_CHUNK_SIZE):
+                chunk = read_bytes(offset, min(self.STREAM_CHUNK_SIZE, length - offset))
+                payload_crc = zlib.crc32(chunk, payload_crc)
+                chunks.append(chunk)
+            payload = b''.join(chunks)
+        
+        if payload_crc != crc:
+            raise ValueError("CRC mismatch: hidden message is corrupted")
+        return payload
+    
+    def _decode_payload(self, read_bits, capacity_bits, legacy_read_bits=None):
+        """
+        Đọc payload: header trước, sau đó đúng length bytes rồi dừng
+        
+        Nếu không tìm thấy header hợp lệ thì fallback sang định dạng cũ
+        (<<<END_OF_MESSAGE>>>) để ảnh stego cũ vẫn giải được.
+        
+        Args:
+            read_bits: Hàm read_bits(start, stop, k=1) trả về mảng bits
+            capacity_bits: Hàm capacity_bits(k) trả về tổng số bits có thể đọc
+            legacy_read_bits: Hàm đọc bits theo thứ tự của định dạng cũ
+                (mặc định giống read_bits)
+        
+        Returns:
+            tuple (payload bytes, version, flags); version = flags = None với định dạng cũ.
+            Với version 3, payload mã hóa đã được giải mã từng chunk.
+        """
+        header = self._read_header(read_bits, capacity_bits)
+        if header is not None:
+            version, flags, _, _ = header
+            return self._read_payload(read_bits, capacity_bits, header), version, flags
+        
+        # Legacy format
+        return self._decode_delimited(legacy_read_bits or read_bits, capacity_bits(1)), None, None
+    
+    def _open_payload(self, payload, version, flags):
+        """
+        Giải mã / giải nén payload đã đọc từ ảnh
+        
+        Args:
+            payload: Bytes đọc được (sau header hoặc trước delimiter)
+            version: Version của header (None = định dạng cũ)
+            flags: Mode flags trong header (None = định dạng cũ)
+        
+        Returns:
+            str (text UTF-8) hoặc bytes (file đính kèm)
+        """
+        if version is None or version == 1:
+            # Định dạng cũ: text latin-1, ciphertext lưu dạng hex
+            encrypted = self.use_encryption if flags is None else bool(flags & self.FLAG_ENCRYPTED)
+            if encrypted and not self.use_encryption:
+                raise ValueError("Hidden message is encrypted. Password is required")
+            
+            message = payload.decode('latin-1')
+            if encrypted:
+                message = self._decrypt_message(bytes.fromhex(message)).decode()
+            return message
+        
+        if version == 2 and flags & self.FLAG_ENCRYPTED:
+            if not self.use_encryption:
+                raise ValueError("Hidden message is encrypted. Password is required")
+            payload = self._decrypt_message(payload)
+        
+        payload = self._decompress_payload(payload, flags >> self.FLAG_COMPRESSION_SHIFT)
+        
+        if flags & self.FLAG_BINARY:
+            return payload
+        return payload.decode('utf-8')
+    
     def _optimal_pixel_adjustment(self, original_pixel, stego_pixel, k=1):
         """
         Optimal Pixel Adjustment Process (OPAP) - CHUẨN PAPER CHAN & CHENG 2004
         
         Thuật toán OPAP để cải thiện PSNR của stego image:
         - Nếu embedding k bits làm pixel thay đổi quá nhiều
-        - Điều chỉnh pixel để minimize distortion
+        - Điều chỉnh pixel ±2^k để minimize distortion (giữ nguyên k bits thấp)
+        
+        Chạy trên toàn bộ mảng (vectorized), chỉ điều chỉnh khi kết quả vẫn
+        nằm trong [0, 255] để không làm sai các bits đã nhúng.
         
         Args:
-            original_pixel: Giá trị pixel gốc (0-255)
-            stego_pixel: Giá trị pixel sau khi nhúng LSB
+            original_pixel: Giá trị pixel gốc (0-255), scalar hoặc mảng
+            stego_pixel: Giá trị pixel sau khi nhúng LSB, scalar hoặc mảng
             k: Số bits đã nhúng (default=1)
         
         Returns:
-            adjusted_pixel: Pixel đã được điều chỉnh tối ưu
+            adjusted_pixel: Pixel đã được điều chỉnh tối ưu (uint8)
         """
         l = 2 ** k  # 2^k
         
-        # Tính difference (ép kiểu sang int để tránh overflow)
-        diff = int(stego_pixel) - int(original_pixel)
+        # Tính difference (int16 để tránh overflow)
+        original = np.asarray(original_pixel, dtype=np.int16)
+        adjusted = np.array(stego_pixel, dtype=np.int16)
+        diff = adjusted - original
         
-        # OPAP adjustment theo paper
-        if diff > l / 2:
-            # Nếu tăng quá nhiều, giảm xuống
-            adjusted = stego_pixel - l
-        elif diff < -l / 2:
-            # Nếu giảm quá nhiều, tăng lên
-            adjusted = stego_pixel + l
-        else:
-            # Trong khoảng chấp nhận được, giữ nguyên
-            adjusted = stego_pixel
+        # Nếu tăng quá nhiều, giảm xuống
+        adjusted -= np.where((diff > l // 2) & (adjusted >= l), l, 0).astype(np.int16)
+        # Nếu giảm quá nhiều, tăng lên
+        adjusted += np.where((diff < -(l // 2)) & (adjusted < 256 - l), l, 0).astype(np.int16)
         
-        # Clip về range [0, 255]
-        return np.clip(adjusted, 0, 255)
+        return adjusted.astype(np.uint8)
     
-    def _detect_edges(self, image):
+    def _detect_edges(self, image, ignore_bits=2):
         """
         Phát hiện edges để Adaptive LSB (CHUẨN HỌC THUẬT)
         
+        Edge map được tính trên các bit plane cao (bỏ qua ignore_bits bits thấp).
+        Adaptive LSB chỉ thay đổi 2 bits thấp nên edge map của ảnh gốc và ảnh
+        stego luôn giống nhau, extract không bị lệch vị trí.
+        
+        Args:
+            image: Ảnh BGR hoặc grayscale
+            ignore_bits: Số bits thấp bỏ qua (0 = hành vi cũ, tính trên ảnh đầy đủ)
+        
         Returns:
             edge_map: Ma trận boolean, True = edge (có thể nhúng nhiều bits)
         """
+        if ignore_bits:
+            image = image & np.uint8((0xFF << ignore_bits) & 0xFF)
+        
         # Chuyển sang grayscale
         if len(image.shape) == 3:
             gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -130,150 +783,485 @@ class LSB_Stego:
         
         return edges_dilated > 0
     
-    def _generate_pseudorandom_positions(self, total_positions, message_length):
+    def _edge_analysis(self, image):
         """
-        Tạo vị trí ngẫu nhiên để nhúng (CHUẨN HỌC THUẬT)
+        Edge map của Adaptive LSB, dùng lại kết quả đã cache nếu có
+        
+        Key cache = BLAKE2b của các bit plane cao + shape ảnh. Adaptive LSB
+        chỉ thay đổi 2 bits thấp nên ảnh stego có cùng key với ảnh cover.
+        
+        Returns:
+            tuple (edge_map, edge_pixels): ma trận boolean (H, W) và số pixel edge
+        """
+        upper_planes = np.ascontiguousarray(image) & np.uint8(0xFC)
+        key = hashlib.blake2b(upper_planes.data, digest_size=16)
+        key.update(repr(image.shape).encode())
+        key = key.hexdigest()
+        
+        entry = edge_map_cache.get(key)
+        if entry is not None:
+            packed, shape, edge_pixels = entry
+            edge_map = np.unpackbits(packed, count=shape[0] * shape[1]).reshape(shape).view(bool)
+            return edge_map, edge_pixels
+        
+        edge_map = self._detect_edges(upper_planes, ignore_bits=0)
+        edge_pixels = int(np.count_nonzero(edge_map))
+        edge_map_cache.put(key, (np.packbits(edge_map), edge_map.shape, edge_pixels))
+        return edge_map, edge_pixels
+    
+    def _capacity_index(self, edge_map, channels=3):
+        """
+        Tạo capacity map và chỉ số capacity tích lũy cho Adaptive LSB
+        
+        Mỗi pixel edge mang 2 bits/kênh, pixel smooth mang 1 bit/kênh.
+        Thứ tự bits trong 1 pixel giống định dạng cũ: lần lượt từng kênh,
+        trong mỗi kênh LSB trước rồi đến bit thứ 2.
+        
+        Args:
+            edge_map: Ma trận boolean (H, W)
+            channels: Số kênh màu
+        
+        Returns:
+            tuple (bits_per_sample, cumulative): bits/kênh của từng pixel (H*W)
+            và tổng bits tích lũy đến hết mỗi pixel
+        """
+        bits_per_sample = np.where(edge_map.reshape(-1), 2, 1).astype(np.uint8)
+        cumulative = np.cumsum(bits_per_sample * channels, dtype=np.int64)
+        return bits_per_sample, cumulative
+    
+    def _adaptive_slots(self, capacity_index, start, stop, channels=3):
+        """
+        Tìm vị trí (sample, bit plane) của các bits thứ [start, stop)
+        
+        Dùng np.searchsorted trên capacity tích lũy nên có thể nhảy thẳng
+        đến bits cần đọc/ghi mà không duyệt các pixel phía trước.
+        
+        Returns:
+            tuple (samples, planes): chỉ số sample trên ảnh phẳng và bit plane
+        """
+        bits_per_sample, cumulative = capacity_index
+        bit_indices = np.arange(start, stop, dtype=np.int64)
+        
+        pixels = np.searchsorted(cumulative, bit_indices, side='right')
+        per_sample = bits_per_sample[pixels].astype(np.int64)
+        offsets = bit_indices - (cumulative[pixels] - per_sample * channels)
+        
+        samples = pixels * channels + offsets // per_sample
+        planes = (offsets % per_sample).astype(np.uint8)
+        return samples, planes
+    
+    def _embed_bits_adaptive(self, flat_image, bits, capacity_index, start=0):
+        """
+        Nhúng bits vào vị trí [start, start + len(bits)) theo capacity map
+        (scatter vectorized theo từng bit plane)
+        
+        Mỗi bit plane được ghi riêng nên không có chỉ số trùng lặp trong
+        một lần gán fancy-index.
+        """
+        samples, planes = self._adaptive_slots(capacity_index, start, start + len(bits))
+        for plane in (0, 1):
+            selected = planes == plane
+            idx = samples[selected]
+            mask = np.uint8(~(1 << plane) & 0xFF)
+            flat_image[idx] = (flat_image[idx] & mask) | (bits[selected] << plane)
+    
+    def _read_bits_adaptive(self, flat_image, capacity_index, start, stop):
+        """Đọc các bits thứ [start, stop) theo capacity map (gather vectorized)"""
+        stop = min(stop, int(capacity_index[1][-1]))
+        start = min(start, stop)
+        samples, planes = self._adaptive_slots(capacity_index, start, stop)
+        return (flat_image[samples] >> planes) & 1
+    
+    def _get_permutation(self, total_positions):
+        """
+        Lấy hoán vị có khóa cho ảnh có total_positions samples
         
         Theo paper: LSB Pseudorandom Algorithm using Skew Tent Map (2019)
+        Hoán vị được tính lười (lazy) nên chỉ tốn O(payload) thời gian và bộ nhớ.
+        """
+        if total_positions not in self._permutations:
+            self._permutations[total_positions] = KeyedPermutation(total_positions, self.seed)
+        return self._permutations[total_positions]
+    
+    def _generate_pseudorandom_positions(self, total_positions, message_length):
+        """
+        Tạo vị trí ngẫu nhiên để nhúng
         
         Returns:
             positions: Array các vị trí để nhúng message
         """
-        np.random.seed(self.seed)
+        return self._get_permutation(total_positions).positions(0, message_length)
+    
+    def _generate_legacy_positions(self, total_positions):
+        """
+        Thứ tự vị trí của định dạng cũ (xáo trộn toàn bộ np.arange bằng seed)
         
-        # Tạo permutation ngẫu nhiên
+        Chỉ dùng khi extract ảnh stego cũ. Dùng RandomState riêng (cùng dãy số
+        với np.random.seed) thay vì thay đổi trạng thái global.
+        """
         all_positions = np.arange(total_positions)
-        np.random.shuffle(all_positions)
-        
-        # Lấy số lượng positions cần thiết
-        return all_positions[:message_length]
+        np.random.RandomState(self.seed).shuffle(all_positions)
+        return all_positions
     
-    def embed(self, cover_image_path, secret_message, output_path):
+    def _embed_image(self, image, secret_message):
         """
-        Nhúng thông điệp vào ảnh
+        Nhúng thông điệp trực tiếp vào ảnh đã decode (ghi in-place)
         
         Args:
-            cover_image_path: Đường dẫn ảnh gốc
-            secret_message: Thông điệp cần giấu
-            output_path: Đường dẫn lưu ảnh stego
+            image: Ảnh BGR uint8 (sẽ bị thay đổi)
+            secret_message: Thông điệp cần giấu (str = text UTF-8, bytes = file)
         
         Returns:
             dict: Thông tin về quá trình nhúng
         """
-        # Đọc ảnh
-        image = cv2.imread(cover_image_path)
-        if image is None:
-            raise ValueError(f"Cannot read image: {cover_image_path}")
+        k = self.bits_per_channel
+        
+        # Payload dạng raw bytes: text -> UTF-8, file giữ nguyên
+        is_binary = isinstance(secret_message, (bytes, bytearray))
+        payload = bytes(secret_message) if is_binary else secret_message.encode('utf-8')
+        
+        # Nén trước khi mã hóa (ciphertext không nén được)
+        compression = self.COMPRESSION_NONE
+        if self.use_compression:
+            payload, compression = self._compress_payload(payload)
         
-        # Mã hóa message nếu cần
+        # Mã hóa message nếu cần: chunked AES-GCM, ciphertext nhúng trực tiếp dạng bytes
         if self.use_encryption:
-            encrypted = self._encrypt_message(secret_message)
-            message_to_hide = encrypted.hex()  # Convert bytes to hex string
+            payload_length = self._encrypted_length(len(payload))
+            chunks = self._encrypt_chunks(payload)
         else:
-            message_to_hide = secret_message
+            payload_length = len(payload)
+            view = memoryview(payload)
+            chunks = (view[i:i + self.STREAM_CHUNK_SIZE] for i in range(0, len(payload), self.STREAM_CHUNK_SIZE))
         
-        # Thêm delimiter
-        message_to_hide += self.DELIMITER
-        
-        # Chuyển sang binary
-        binary_message = self._text_to_binary(message_to_hide)
-        message_length = len(binary_message)
+        message_length = self.HEADER_BITS + payload_length * 8
         
         # Kiểm tra capacity
-        image_capacity = image.shape[0] * image.shape[1] * 3  # 3 channels
+        flat_image = image.reshape(-1)
+        total_positions = flat_image.size
+        if self.use_adaptive:
+            capacity_index = self._capacity_index(self._edge_analysis(image)[0])
+            image_capacity = int(capacity_index[1][-1])
+        else:
+            image_capacity = self._stream_capacity(total_positions, k)
         if message_length > image_capacity:
             raise ValueError(f"Message too large. Max capacity: {image_capacity} bits, Message: {message_length} bits")
         
-        # Nhúng message vào LSB
-        stego_image = image.copy()
+        # Nhúng payload theo từng chunk, header (length, CRC) ghi sau cùng
+        flags = self._mode_flags(is_binary, compression)
         
         if self.use_adaptive:
             # ADAPTIVE LSB (CHUẨN HỌC THUẬT)
             # Nhúng nhiều bits ở vùng edge, ít bits ở vùng smooth
-            edge_map = self._detect_edges(image)
-            
-            data_index = 0
-            for i in range(image.shape[0]):
-                for j in range(image.shape[1]):
-                    for k in range(3):  # BGR channels
-                        if data_index >= message_length:
-                            break
-                        
-                        if edge_map[i, j]:
-                            # Vùng edge: có thể nhúng 2 bits (LSB và bit thứ 2)
-                            if data_index < message_length:
-                                bit1 = int(binary_message[data_index])
-                                stego_image[i, j, k] = (image[i, j, k] & 0xFE) | bit1
-                                data_index += 1
-                            
-                            if data_index < message_length:
-                                bit2 = int(binary_message[data_index])
-                                stego_image[i, j, k] = (stego_image[i, j, k] & 0xFD) | (bit2 << 1)
-                                data_index += 1
-                        else:
-                            # Vùng smooth: chỉ nhúng 1 bit (LSB)
-                            bit = int(binary_message[data_index])
-                            stego_image[i, j, k] = (image[i, j, k] & 0xFE) | bit
-                            data_index += 1
-                    
-                    if data_index >= message_length:
-                        break
-                if data_index >= message_length:
-                    break
-        
-        elif self.use_pseudorandom:
-            # PSEUDORANDOM LSB (CHUẨN HỌC THUẬT)
-            # Nhúng theo thứ tự ngẫu nhiên thay vì tuần tự
-            total_positions = image.shape[0] * image.shape[1] * 3
-            positions = self._generate_pseudorandom_positions(total_positions, message_length)
-            
-            flat_image = stego_image.flatten()
-            
-            for idx, pos in enumerate(positions):
-                if idx < message_length:
-                    bit = int(binary_message[idx])
-                    flat_image[pos] = (flat_image[pos] & 0xFE) | bit
-            
-            stego_image = flat_image.reshape(image.shape)
+            length, crc = self._embed_stream(flat_image, chunks, capacity_index=capacity_index)
+            header_bits = self._bytes_to_bits(self._pack_header(length, crc, flags))
+            self._embed_bits_adaptive(flat_image, header_bits, capacity_index)
+            samples_used = (int(np.searchsorted(capacity_index[1], message_length)) + 1) * 3
         
         else:
-            # STANDARD LSB WITH OPAP (CHUẨN PAPER CHAN & CHENG 2004)
-            data_index = 0
-            for i in range(image.shape[0]):
-                for j in range(image.shape[1]):
-                    for k in range(3):  # BGR channels
-                        if data_index < message_length:
-                            original_value = image[i, j, k]
-                            
-                            # Thay LSB bằng bit của message
-                            stego_value = (original_value & 0xFE) | int(binary_message[data_index])
-                            
-                            # KHÔNG dùng OPAP cho LSB đơn giản (k=1) vì có thể làm sai LSB
-                            # OPAP chỉ hữu ích khi nhúng nhiều bits (k > 1)
-                            stego_image[i, j, k] = stego_value
-                            data_index += 1
-                        else:
-                            break
-                    if data_index >= message_length:
-                        break
-                if data_index >= message_length:
-                    break
+            # STANDARD / PSEUDORANDOM LSB (BIT-PLANE ENGINE)
+            # Pseudorandom: nhúng theo thứ tự hoán vị có khóa thay vì tuần tự
+            # OPAP chỉ áp dụng khi nhúng nhiều bits (k > 1), k=1 có thể làm sai LSB
+            order = self._sample_order(total_positions)
+            length, crc = self._embed_stream(flat_image, chunks, order=order, k=k)
+            header_bits = self._bytes_to_bits(self._pack_header(length, crc, flags))
+            self._embed_header_bits(flat_image, order, header_bits)
+            samples_used = self.HEADER_BITS + -(-payload_length * 8 // k)
         
-        # Lưu ảnh stego (dùng PNG để tránh mất dữ liệu do compression)
-        cv2.imwrite(output_path, stego_image)
+        if self.use_adaptive:
+            algorithm = 'Adaptive-LSB'
+        else:
+            algorithm = 'Pseudorandom-LSB' if self.use_pseudorandom else 'Standard-LSB'
+            if k > 1:
+                algorithm += f' ({k}-bit OPAP)'
         
         return {
             'success': True,
             'message_length': len(secret_message),
+            'payload_bytes': payload_length,
+            'is_file': is_binary,
+            'compression': self.COMPRESSION_NAMES[compression],
             'bits_used': message_length,
+            'samples_used': samples_used,
             'capacity': image_capacity,
             'usage_percent': (message_length / image_capacity) * 100,
             'encrypted': self.use_encryption,
-            'algorithm': 'Adaptive-LSB' if self.use_adaptive else ('Pseudorandom-LSB' if self.use_pseudorandom else 'Standard-LSB'),
+            'algorithm': algorithm,
             'adaptive': self.use_adaptive,
-            'pseudorandom': self.use_pseudorandom
+            'pseudorandom': self.use_pseudorandom,
+            'bits_per_channel': k
         }
     
+    def embed(self, cover_image_path, secret_message, output_path):
+        """
+        Nhúng thông điệp vào ảnh
+        
+        Args:
+            cover_image_path: Đường dẫn ảnh gốc
+            secret_message: Thông điệp cần giấu (str = text UTF-8, bytes = file đính kèm)
+            output_path: Đường dẫn lưu ảnh stego
+        
+        Returns:
+            dict: Thông tin về quá trình nhúng
+        """
+        # Đọc ảnh
+        image = cv2.imread(cover_image_path)
+        if image is None:
+            raise ValueError(f"Cannot read image: {cover_image_path}")
+        
+        # Nhúng message vào LSB (ghi trực tiếp lên ảnh đã đọc, không copy)
+        result = self._embed_image(image, secret_message)
+        
+        # Lưu ảnh stego (dùng PNG để tránh mất dữ liệu do compression)
+        cv2.imwrite(output_path, image)
+        
+        return result
+    
+    def embed_array(self, image, secret_message):
+        """
+        Nhúng thông điệp vào ảnh đã decode, hoàn toàn trong bộ nhớ
+        
+        Args:
+            image: Ảnh cover BGR uint8 (không bị thay đổi)
+            secret_message: Thông điệp cần giấu (str = text UTF-8, bytes = file đính kèm)
+        
+        Returns:
+            tuple (stego_image, result): ảnh stego (bản sao) và dict như embed
+        """
+        if image is None:
+            raise ValueError("Cannot read image")
+        
+        stego_image = np.array(image, dtype=np.uint8, copy=True)
+        result = self._embed_image(stego_image, secret_message)
+        return stego_image, result
+    
+    def embed_bytes(self, cover_data, secret_message):
+        """
+        Nhúng thông điệp vào ảnh đã mã hóa (bytes của file upload): decode 1 lần, encode 1 lần
+        
+        Ảnh stego luôn được mã hóa PNG (định dạng mất dữ liệu sẽ xóa LSB).
+        
+        Returns:
+            tuple (png_bytes, result)
+        """
+        stego_image, result = self.embed_array(load_image(cover_data), secret_message)
+        return encode_image(stego_image, '.png'), result
+    
+    def compare_bits_per_channel(self, cover_image_path, secret_message, k_values=(1, 2, 3, 4)):
+        """
+        So sánh PSNR và capacity của k-bit LSB cho từng k
+        
+        Nhúng thử message (trong bộ nhớ, không ghi file) với từng k để chọn
+        trade-off giữa chất lượng ảnh và capacity cho từng loại workload.
+        
+        Args:
+            cover_image_path: Đường dẫn ảnh gốc (hoặc bytes / ảnh đã decode)
+            secret_message: Thông điệp cần giấu
+            k_values: Các giá trị k cần so sánh
+        
+        Returns:
+            list[dict]: Mỗi phần tử gồm k, capacity, bits_used, samples_used, psnr
+                (psnr = None nếu message không vừa với k đó)
+        """
+        if self.use_adaptive:
+            raise ValueError("k-bit comparison is not available for Adaptive LSB")
+        
+        image = load_image(cover_image_path)
+        if image is None:
+            raise ValueError("Cannot read image")
+        
+        report = []
+        for k in k_values:
+            stego = LSB_Stego(
+                use_encryption=self.use_encryption,
+                password=self.password,
+                use_pseudorandom=self.use_pseudorandom,
+                seed=self.seed,
+                bits_per_channel=k,
+                use_compression=self.use_compression
+            )
+            stego_image = image.copy()
+            entry = {
+                'bits_per_channel': k,
+                'capacity': stego._stream_capacity(image.size, k),
+                'bits_used': None,
+                'samples_used': None,
+                'psnr': None
+            }
+            try:
+                result = stego._embed_image(stego_image, secret_message)
+            except ValueError:
+                report.append(entry)
+                continue
+            
+            entry['bits_used'] = result['bits_used']
+            entry['samples_used'] = result['samples_used']
+            entry['psnr'] = float(calculate_psnr(image, stego_image))
+            report.append(entry)
+        
+        return report
+    
+    def _capacity_entry(self, capacity_bits, payload_bytes=None):
+        """Capacity của 1 mode: bits, số bytes payload tối đa (đã trừ header / overhead mã hóa)"""
+        max_bytes = max(capacity_bits - self.HEADER_BITS, 0) // 8
+        if self.use_encryption:
+            max_bytes = self._max_plaintext_length(max_bytes)
+        entry = {'capacity_bits': int(capacity_bits), 'max_bytes': int(max_bytes)}
+        if payload_bytes is not None:
+            entry['fits'] = payload_bytes <= max_bytes
+        return entry
+    
+    def _estimate_psnr(self, k, total_positions, payload_bytes=None):
+        """
+        PSNR ước lượng của k-bit LSB (không nhúng thử)
+        
+        Bits message xem như ngẫu nhiên: k = 1 đổi LSB với xác suất 1/2 (MSE 0.5
+        mỗi sample); k > 1 dùng OPAP nên sai số phân bố đều trên 2^k giá trị
+        quanh 0, MSE = (4^k + 2) / 12 mỗi sample. Header (1 bit/sample) tính
+        như k = 1. payload_bytes = None: dùng toàn bộ capacity.
+        
+        Returns:
+            float PSNR (dB), None nếu payload không vừa
+        """
+        header_samples = min(self.HEADER_BITS, total_positions)
+        payload_samples = total_positions - header_samples
+        if payload_bytes is not None:
+            payload_length = self._encrypted_length(payload_bytes) if self.use_encryption else payload_bytes
+            needed = -(-payload_length * 8 // k)
+            if needed > payload_samples:
+                return None
+            payload_samples = needed
+        
+        sample_mse = 0.5 if k == 1 else (4 ** k + 2) / 12
+        mse = (header_samples * 0.5 + payload_samples * sample_mse) / total_positions
+        return float(10 * np.log10(255.0 ** 2 / mse)) if mse > 0 else float('inf')
+    
+    def analyze_capacity(self, image_path, include_adaptive=True, payload_bytes=None):
+        """
+        Capacity preflight: capacity của từng mode trước khi nhúng
+        
+        Capacity Standard / k-bit chỉ phụ thuộc kích thước ảnh nên được tính
+        từ header ảnh (không decode pixels). Capacity Adaptive cần edge map,
+        được tính 1 lần rồi cache theo content hash, embed sau đó trên cùng
+        ảnh dùng lại kết quả thay vì chạy lại Canny.
+        
+        Args:
+            image_path: Đường dẫn ảnh cover (hoặc bytes của file ảnh / ảnh đã decode)
+            include_adaptive: Có phân tích edge cho Adaptive LSB không
+            payload_bytes: Kích thước message/file dự định nhúng (bytes, trước nén)
+        
+        Returns:
+            dict: Kích thước ảnh và capacity từng mode; max_bytes đã trừ header
+                và overhead mã hóa (nếu use_encryption), fits nếu có payload_bytes.
+                Mỗi k trong bits_per_channel kèm psnr_full (PSNR ước lượng khi dùng
+                hết capacity) và psnr_payload (khi nhúng payload_bytes) để chọn k
+        """
+        # Bytes của file upload: PIL đọc header trong bộ nhớ (không ghi file tạm)
+        if isinstance(image_path, np.ndarray):
+            height, width = image_path.shape[:2]
+        else:
+            in_memory = isinstance(image_path, (bytes, bytearray, memoryview))
+            try:
+                with Image.open(io.BytesIO(image_path) if in_memory else image_path) as header:
+                    width, height = header.size
+            except (OSError, ValueError):
+                raise ValueError("Cannot read image" if in_memory else f"Cannot read image: {image_path}")
+        
+        # cv2.imread luôn trả về ảnh BGR 3 kênh
+        total_positions = width * height * 3
+        
+        report = {
+            'width': width,
+            'height': height,
+            'samples': total_positions,
+            'header_bits': self.HEADER_BITS,
+            'encrypted': self.use_encryption,
+            'standard': self._capacity_entry(self._stream_capacity(total_positions, 1), payload_bytes),
+            'bits_per_channel': [
+                dict(
+                    bits_per_channel=k,
+                    **self._capacity_entry(self._stream_capacity(total_positions, k), payload_bytes),
+                    psnr_full=self._estimate_psnr(k, total_positions),
+                    psnr_payload=self._estimate_psnr(k, total_positions, payload_bytes) if payload_bytes is not None else None
+                )
+                for k in range(1, self.MAX_BITS_PER_CHANNEL + 1)
+            ],
+            'adaptive': None
+        }
+        
+        if include_adaptive:
+            image = load_image(image_path)
+            if image is None:
+                raise ValueError("Cannot read image")
+            
+            edge_map, edge_pixels = self._edge_analysis(image)
+            # Edge pixel: 2 bits/kênh, smooth pixel: 1 bit/kênh
+            capacity_bits = (edge_map.size + edge_pixels) * 3
+            report['adaptive'] = dict(
+                edge_ratio=edge_pixels / edge_map.size,
+                **self._capacity_entry(capacity_bits, payload_bytes)
+            )
+        
+        return report
+    
+    def _build_readers(self, image, flat_image, adaptive, pseudorandom):
+        """
+        Tạo các hàm đọc bits cho 1 mode
+        
+        Args:
+            image: Ảnh stego đã decode (dùng cho edge map của Adaptive LSB)
+            flat_image: Mảng 1 chiều chứa các bit planes thấp của ảnh
+            adaptive: Mode Adaptive LSB
+            pseudorandom: Mode Pseudorandom LSB
+        
+        Returns:
+            tuple (read_bits, capacity_bits, legacy_read_bits)
+        """
+        total_positions = flat_image.size
+        legacy_read_bits = None
+        
+        if adaptive:
+            # ADAPTIVE LSB EXTRACTION
+            # Edge map trên bit plane cao: giống hệt edge map lúc embed
+            # Tính lười (lần đọc đầu tiên) để không chạy Canny khi không cần
+            capacity_index = []
+            
+            def get_capacity_index():
+                if not capacity_index:
+                    capacity_index.append(self._capacity_index(self._edge_analysis(image)[0]))
+                return capacity_index[0]
+            
+            read_bits = lambda start, stop, k=1: self._read_bits_adaptive(flat_image, get_capacity_index(), start, stop)
+            capacity_bits = lambda k: int(get_capacity_index()[1][-1])
+            
+            # Định dạng cũ: edge map tính trên toàn bộ ảnh stego
+            legacy_index = []
+            
+            def legacy_read_bits(start, stop, k=1):
+                if not legacy_index:
+                    legacy_index.append(self._capacity_index(self._detect_edges(image, ignore_bits=0)))
+                return self._read_bits_adaptive(flat_image, legacy_index[0], start, stop)
+            
+            return read_bits, capacity_bits, legacy_read_bits
+        
+        if pseudorandom:
+            # Định dạng cũ: thứ tự xáo trộn toàn bộ ảnh
+            legacy_positions = []
+            
+            def legacy_read_bits(start, stop, k=1):
+                if not legacy_positions:
+                    legacy_positions.append(self._generate_legacy_positions(total_positions))
+                return flat_image[legacy_positions[0][start:stop]] & 1
+        
+        # STANDARD / PSEUDORANDOM LSB EXTRACTION (BIT-PLANE ENGINE)
+        # Pseudorandom: tạo lại cùng positions với cùng seed, chỉ cho các bits cần đọc
+        # k (bits/kênh) được đọc từ header
+        order = self._sample_order(total_positions, pseudorandom)
+        read_bits = lambda start, stop, k=1: self._read_bits_kbit(flat_image, order, start, stop, k)
+        capacity_bits = lambda k: self._stream_capacity(total_positions, k)
+        
+        return read_bits, capacity_bits, legacy_read_bits
+    
     def extract(self, stego_image_path):
         """
         Trích xuất thông điệp từ ảnh stego
@@ -282,70 +1270,133 @@ class LSB_Stego:
             stego_image_path: Đường dẫn ảnh stego
         
         Returns:
-            str: Thông điệp đã giấu
+            str (text) hoặc bytes (file đính kèm): Thông điệp đã giấu
         """
         # Đọc ảnh
         image = cv2.imread(stego_image_path)
         if image is None:
             raise ValueError(f"Cannot read image: {stego_image_path}")
         
-        # Trích xuất LSB
-        binary_message = ""
+        return self.extract_array(image)
+    
+    def extract_bytes(self, stego_data):
+        """Trích xuất thông điệp từ bytes của ảnh stego (decode trong bộ nhớ), giống extract"""
+        image = load_image(stego_data)
+        if image is None:
+            raise ValueError("Cannot read image")
+        return self.extract_array(image)
+    
+    def extract_array(self, image):
+        """
+        Trích xuất thông điệp từ ảnh stego đã decode
+        
+        Args:
+            image: Ảnh stego BGR uint8
         
-        if self.use_adaptive:
-            # ADAPTIVE LSB EXTRACTION
-            edge_map = self._detect_edges(image)
+        Returns:
+            str (text) hoặc bytes (file đính kèm): Thông điệp đã giấu
+        """
+        read_bits, capacity_bits, legacy_read_bits = self._build_readers(
+            image, image.reshape(-1), self.use_adaptive, self.use_pseudorandom
+        )
+        
+        # Đọc header rồi đúng số bits của payload (fallback: đọc đến delimiter)
+        payload, version, flags = self._decode_payload(read_bits, capacity_bits, legacy_read_bits)
+        
+        # Giải mã / giải nén nếu cần
+        return self._open_payload(payload, version, flags)
+    
+    def extract_auto(self, stego_image_path):
+        """
+        Tự động dò mode và trích xuất thông điệp trong 1 lần decode ảnh
+        
+        Ảnh chỉ được đọc 1 lần và các bit planes thấp được tách 1 lần, sau đó
+        dùng chung cho mọi mode (standard/k-bit, pseudorandom, adaptive).
+        Lượt 1 chỉ đọc header (112 bits) của từng mode; header cho biết luôn
+        k và payload có mã hóa hay không nên không phải thử lại với/không
+        giải mã. Chỉ khi không mode nào có header mới quét định dạng cũ.
+        
+        Args:
+            stego_image_path: Đường dẫn ảnh stego
+        
+        Returns:
+            dict: message (str hoặc bytes), mode, format, bits_per_channel, encrypted
+        """
+        image = cv2.imread(stego_image_path)
+        if image is None:
+            raise ValueError(f"Cannot read image: {stego_image_path}")
+        
+        return self.extract_auto_array(image)
+    
+    def extract_auto_array(self, image):
+        """
+        Tự động dò mode và trích xuất thông điệp từ ảnh stego đã decode (xem extract_auto)
+        
+        Args:
+            image: Ảnh stego BGR uint8
+        
+        Returns:
+            dict: Như extract_auto
+        """
+        # Tách các bit planes thấp 1 lần (đủ cho k <= 4), dùng chung cho mọi mode
+        low_bits = image.reshape(-1) & np.uint8((1 << self.MAX_BITS_PER_CHANNEL) - 1)
+        
+        modes = {
+            'Standard-LSB': (False, False),
+            'Pseudorandom-LSB': (False, True),
+            'Adaptive-LSB': (True, False),
+        }
+        mode_flags = {
+            'Standard-LSB': 0,
+            'Pseudorandom-LSB': self.FLAG_PSEUDORANDOM,
+            'Adaptive-LSB': self.FLAG_ADAPTIVE,
+        }
+        readers = {
+            mode: self._build_readers(image, low_bits, adaptive, pseudorandom)
+            for mode, (adaptive, pseudorandom) in modes.items()
+        }
+        
+        # Lượt 1: định dạng có header
+        # Header chỉ hợp lệ khi mode flags khớp với mode đang thử (các mode có
+        # thể dùng chung vài samples đầu, ví dụ adaptive ở vùng smooth)
+        for mode, (read_bits, capacity_bits, _) in readers.items():
+            header = self._read_header(read_bits, capacity_bits)
+            if header is None:
+                continue
             
-            for i in range(image.shape[0]):
-                for j in range(image.shape[1]):
-                    for k in range(3):
-                        if edge_map[i, j]:
-                            # Vùng edge: trích xuất 2 bits
-                            bit1 = image[i, j, k] & 1
-                            bit2 = (image[i, j, k] >> 1) & 1
-                            binary_message += str(bit1)
-                            binary_message += str(bit2)
-                        else:
-                            # Vùng smooth: trích xuất 1 bit
-                            binary_message += str(image[i, j, k] & 1)
-        
-        elif self.use_pseudorandom:
-            # PSEUDORANDOM LSB EXTRACTION
-            total_positions = image.shape[0] * image.shape[1] * 3
-            # Tạo lại cùng positions với cùng seed
-            positions = self._generate_pseudorandom_positions(total_positions, total_positions)
+            version, flags, _, _ = header
+            if flags & (self.FLAG_ADAPTIVE | self.FLAG_PSEUDORANDOM) != mode_flags[mode]:
+                continue
+            payload = self._read_payload(read_bits, capacity_bits, header)
+            return {
+                'message': self._open_payload(payload, version, flags),
+                'mode': mode,
+                'format': f'v{version}',
+                'bits_per_channel': self._flags_bits_per_channel(flags),
+                'encrypted': bool(flags & self.FLAG_ENCRYPTED)
+            }
+        
+        # Lượt 2: định dạng cũ (delimiter)
+        for mode, (read_bits, capacity_bits, legacy_read_bits) in readers.items():
+            try:
+                payload = self._decode_delimited(legacy_read_bits or read_bits, capacity_bits(1))
+            except ValueError:
+                continue
             
-            flat_image = image.flatten()
+            try:
+                message = self._open_payload(payload, None, None)
+                encrypted = self.use_encryption
+            except ValueError:
+                # Không phải ciphertext hex hợp lệ: thông điệp không mã hóa
+                message = payload.decode('latin-1')
+                encrypted = False
             
-            for pos in positions:
-                binary_message += str(flat_image[pos] & 1)
-        
-        else:
-            # STANDARD LSB EXTRACTION
-            for i in range(image.shape[0]):
-                for j in range(image.shape[1]):
-                    for k in range(3):
-                        binary_message += str(image[i, j, k] & 1)
-        
-        # Chuyển binary sang text
-        all_bytes = [binary_message[i:i+8] for i in range(0, len(binary_message), 8)]
-        decoded_message = ""
-        
-        for byte in all_bytes:
-            if len(byte) == 8:
-                decoded_message += chr(int(byte, 2))
-                if decoded_message.endswith(self.DELIMITER):
-                    break
-        
-        # Loại bỏ delimiter
-        if self.DELIMITER in decoded_message:
-            decoded_message = decoded_message.replace(self.DELIMITER, "")
-        else:
-            raise ValueError("No hidden message found or image corrupted")
-        
-        # Giải mã nếu cần
-        if self.use_encryption:
-            encrypted_bytes = bytes.fromhex(decoded_message)
-            decoded_message = self._decrypt_message(encrypted_bytes)
+            return {
+                'message': message,
+                'mode': mode,
+                'format': 'legacy',
+                'bits_per_channel': 1,
+                'encrypted': encrypted
+            }
         
-        return decoded_message
+        raise ValueError("No hidden message found or image corrupted")
@@ -1,16 +1,102 @@
 """
-Utility functions: Arnold Cat Map, Quality Metrics (PSNR, MSE, SSIM, NC)
+Utility functions: Arnold Cat Map, Quality Metrics (fused PSNR / MSE / SSIM, NC), Memory-mapped / reduced image I/O,
+shared process pool
 """
 
+import io
+import os
+import tempfile
+import threading
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import islice
+
 import numpy as np
 import cv2
-from skimage.metrics import structural_similarity as ssim
+from PIL import Image
+
+try:
+    import tifffile
+except ImportError:  # tifffile là tùy chọn: chỉ cần cho TIFF memory-mapped
+    tifffile = None
+
+
+# Số bảng hoán vị Arnold (N, iterations) giữ trong cache (LRU)
+ARNOLD_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=ARNOLD_CACHE_SIZE)
+def arnold_period(N):
+    """
+    Chu kỳ của Arnold Cat Map trên lưới NxN
+    
+    Ma trận [[1,1],[1,2]] mod N có bậc hữu hạn (<= 3N): sau đúng chu kỳ lần
+    lặp ảnh trở về ban đầu.
+    """
+    a, b, c, d = 1, 1, 1, 2
+    period = 1
+    while (a % N, b % N, c % N, d % N) != (1 % N, 0, 0, 1 % N):
+        a, b, c, d = (a + c) % N, (b + d) % N, (a + 2 * c) % N, (b + 2 * d) % N
+        period += 1
+    return period
+
+
+def _arnold_step(N):
+    """
+    Hoán vị 1 lần lặp Arnold dưới dạng chỉ số phẳng (gather)
+    
+    scrambled.flat[i] = image.flat[step[i]]: pixel đích (x', y') lấy từ pixel
+    nguồn [x, y] = [[2,-1],[-1,1]] * [x', y'] mod N
+    """
+    x, y = np.indices((N, N))
+    src_x = (2 * x - y) % N
+    src_y = (y - x) % N
+    return (src_x * N + src_y).ravel()
+
+
+@lru_cache(maxsize=ARNOLD_CACHE_SIZE)
+def arnold_permutation(N, iterations):
+    """
+    Bảng hoán vị phẳng của `iterations` lần lặp Arnold trên ảnh NxN
+    
+    Số lần lặp được rút gọn theo chu kỳ (số âm = biến đổi ngược), rồi lũy
+    thừa hoán vị bằng bình phương liên tiếp: O(N^2 log k) thay vì O(N^2 k).
+    
+    Returns:
+        Mảng chỉ số (N*N,) chỉ đọc, dùng làm gather: image.flat[perm]
+    """
+    k = iterations % arnold_period(N)
+    
+    result = np.arange(N * N)
+    step = _arnold_step(N)
+    while k:
+        if k & 1:
+            result = result[step]
+        step = step[step]
+        k >>= 1
+    
+    result.setflags(write=False)
+    return result
+
+
+def _apply_arnold(image, iterations):
+    """Áp dụng hoán vị Arnold (iterations < 0: biến đổi ngược) cho ảnh NxN (có thể nhiều kênh)"""
+    N = image.shape[0]
+    if image.ndim < 2 or image.shape[0] != image.shape[1]:
+        raise ValueError("Arnold Cat Map yêu cầu ảnh vuông (NxN)")
+    
+    perm = arnold_permutation(N, iterations)
+    return image.reshape(N * N, *image.shape[2:])[perm].reshape(image.shape)
 
 
 def arnold_cat_map(image, iterations=10):
     """
     Xáo trộn ảnh sử dụng Arnold Cat Map
     
+    Arnold transform: [x', y'] = [[1,1],[1,2]] * [x, y] mod N, thực hiện bằng
+    1 phép gather với bảng hoán vị đã cache.
+    
     Args:
         image: Ảnh đầu vào (numpy array, phải là ảnh vuông)
         iterations: Số lần lặp xáo trộn
@@ -18,29 +104,15 @@ def arnold_cat_map(image, iterations=10):
     Returns:
         Ảnh đã xáo trộn
     """
-    N = image.shape[0]
-    if image.shape[0] != image.shape[1]:
-        raise ValueError("Arnold Cat Map yêu cầu ảnh vuông (NxN)")
-    
-    scrambled = image.copy()
-    
-    for _ in range(iterations):
-        temp = np.zeros_like(scrambled)
-        for x in range(N):
-            for y in range(N):
-                # Arnold transform: [x', y'] = [[1,1],[1,2]] * [x, y] mod N
-                new_x = (x + y) % N
-                new_y = (x + 2 * y) % N
-                temp[new_x, new_y] = scrambled[x, y]
-        scrambled = temp
-    
-    return scrambled
+    return _apply_arnold(image, iterations)
 
 
 def inverse_arnold_cat_map(image, iterations=10):
     """
     Khôi phục ảnh từ Arnold Cat Map
     
+    Inverse Arnold: [x', y'] = [[2,-1],[-1,1]] * [x, y] mod N
+    
     Args:
         image: Ảnh đã xáo trộn
         iterations: Số lần lặp (phải giống với lúc mã hóa)
@@ -48,28 +120,162 @@ def inverse_arnold_cat_map(image, iterations=10):
     Returns:
         Ảnh gốc
     """
-    N = image.shape[0]
-    if image.shape[0] != image.shape[1]:
-        raise ValueError("Arnold Cat Map yêu cầu ảnh vuông (NxN)")
+    return _apply_arnold(image, -iterations)
+
+
+# Các quality metrics có thể chọn theo request (thứ tự trong kết quả)
+QUALITY_METRICS = ('psnr', 'ssim', 'mse')
+
+# Cửa sổ SSIM (giống skimage mặc định: cửa sổ đều 7x7, sample covariance):
+# tính SSIM theo dải hàng cần thêm SSIM_PAD hàng hai bên
+SSIM_WINDOW = 7
+SSIM_PAD = (SSIM_WINDOW - 1) // 2
+SSIM_K1 = 0.01
+SSIM_K2 = 0.03
+
+# Fast SSIM: chỉ tính SSIM map trên các dải SSIM_FAST_ROWS hàng cách đều,
+# lấy 1 / round(cạnh ngắn / SSIM_FAST_SIZE) số hàng của ảnh
+SSIM_FAST_SIZE = 256
+SSIM_FAST_ROWS = 16
+
+
+def parse_metrics(metrics):
+    """
+    Chuẩn hóa danh sách metrics cần tính
+    
+    Args:
+        metrics: Chuỗi 'psnr,ssim' hoặc iterable tên metrics (None = tất cả)
+    
+    Returns:
+        tuple: Tên metrics theo thứ tự QUALITY_METRICS
+    """
+    if metrics is None:
+        return QUALITY_METRICS
+    if isinstance(metrics, str):
+        metrics = [name.strip().lower() for name in metrics.split(',') if name.strip()]
+    
+    unknown = set(metrics) - set(QUALITY_METRICS)
+    if unknown:
+        raise ValueError(f"Unknown metrics: {', '.join(sorted(unknown))} (expected {', '.join(QUALITY_METRICS)})")
+    return tuple(name for name in QUALITY_METRICS if name in metrics)
+
+
+def _squared_error(original, modified):
+    """Tổng bình phương sai khác (1 lần duyệt, không tạo ảnh hiệu float64 với ảnh uint8)"""
+    if original.dtype == np.uint8 and modified.dtype == np.uint8:
+        return cv2.norm(np.ascontiguousarray(original), np.ascontiguousarray(modified), cv2.NORM_L2SQR)
+    return float(np.sum((original.astype(np.float64) - modified.astype(np.float64)) ** 2))
+
+
+def _psnr_from_mse(mse, max_pixel=255.0):
+    """PSNR (dB) từ MSE"""
+    if mse == 0:
+        return float('inf')
+    return 20 * np.log10(max_pixel / np.sqrt(mse))
+
+
+def _gray(image):
+    """Ảnh grayscale (ảnh màu BGR được chuyển, ảnh xám giữ nguyên)"""
+    if image.ndim == 3:
+        return cv2.cvtColor(np.ascontiguousarray(image), cv2.COLOR_BGR2GRAY)
+    return image
+
+
+def _ssim_map(original_gray, modified_gray, data_range):
+    """
+    SSIM map float32 (cùng công thức với skimage structural_similarity mặc định)
+    
+    Các trung bình cục bộ dùng box filter 7x7 tách được (cv2.boxFilter: tổng
+    theo hàng rồi theo cột) trên float32. Ảnh được trừ 128 trước khi lọc để
+    E[x^2] - E[x]^2 không mất độ chính xác của float32.
+    """
+    x = original_gray.astype(np.float32) - 128
+    y = modified_gray.astype(np.float32) - 128
+    
+    def mean(image):
+        return cv2.boxFilter(image, -1, (SSIM_WINDOW, SSIM_WINDOW), normalize=True, borderType=cv2.BORDER_REFLECT)
+    
+    ux, uy = mean(x), mean(y)
+    cov_norm = np.float32(SSIM_WINDOW ** 2 / (SSIM_WINDOW ** 2 - 1))
+    vx = cov_norm * (mean(x * x) - ux * ux)
+    vy = cov_norm * (mean(y * y) - uy * uy)
+    vxy = cov_norm * (mean(x * y) - ux * uy)
+    
+    # Độ sáng trung bình đã bị trừ 128: cộng lại khi tính thành phần luminance
+    ux += 128
+    uy += 128
+    c1 = np.float32((SSIM_K1 * data_range) ** 2)
+    c2 = np.float32((SSIM_K2 * data_range) ** 2)
+    return ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux * ux + uy * uy + c1) * (vx + vy + c2))
+
+
+def _ssim_fast_factor(height, width):
+    """Tỉ lệ lấy mẫu hàng của fast SSIM: max(1, round(cạnh ngắn / SSIM_FAST_SIZE))"""
+    return max(1, int(round(min(height, width) / SSIM_FAST_SIZE)))
+
+
+def _ssim_mean(original_gray, modified_gray, data_range, fast=False):
+    """
+    Trung bình SSIM map (bỏ SSIM_PAD pixels ở biên như skimage)
     
-    descrambled = image.copy()
+    fast: chỉ tính trên các dải hàng cách đều (cửa sổ lấy mẫu, độ phân giải
+    đầy đủ) thay vì thu nhỏ ảnh - thu nhỏ đổi thang đo của SSIM và đánh giá
+    thấp các thay đổi tần số thấp như watermark trên sub-band LL.
+    """
+    height, width = original_gray.shape[:2]
+    factor = _ssim_fast_factor(height, width) if fast else 1
+    if factor == 1:
+        ssim_map = _ssim_map(original_gray, modified_gray, data_range)
+        return float(ssim_map[SSIM_PAD:-SSIM_PAD, SSIM_PAD:-SSIM_PAD].mean(dtype=np.float64))
+    
+    total, count = 0.0, 0
+    for y0 in range(SSIM_PAD, height - SSIM_PAD, SSIM_FAST_ROWS * factor):
+        part_sum, part_count = calculate_ssim_rows(original_gray, modified_gray, y0, y0 + SSIM_FAST_ROWS, data_range)
+        total += part_sum
+        count += part_count
+    return total / count
+
+
+def calculate_quality_metrics(original, modified, metrics=QUALITY_METRICS, fast_ssim=False, max_pixel=255.0):
+    """
+    Tính các quality metrics được chọn trong 1 lần (FUSED METRICS ENGINE)
+    
+    MSE và PSNR dùng chung 1 lần duyệt tổng bình phương sai khác; SSIM chỉ
+    được tính (grayscale, float32) nếu được chọn.
+    
+    Args:
+        original: Ảnh gốc
+        modified: Ảnh đã chỉnh sửa
+        metrics: Các metrics cần tính (xem parse_metrics)
+        fast_ssim: SSIM ước lượng trên các dải hàng lấy mẫu (xem _ssim_mean), nhanh hơn nhiều với ảnh lớn
+        max_pixel: Giá trị pixel tối đa (255 cho ảnh 8-bit)
+    
+    Returns:
+        dict: {tên metric: giá trị} theo thứ tự QUALITY_METRICS
+    """
+    metrics = parse_metrics(metrics)
+    report = {}
+    
+    mse = None
+    if 'mse' in metrics or 'psnr' in metrics:
+        mse = _squared_error(original, modified) / original.size
     
-    for _ in range(iterations):
-        temp = np.zeros_like(descrambled)
-        for x in range(N):
-            for y in range(N):
-                # Inverse Arnold: [x', y'] = [[2,-1],[-1,1]] * [x, y] mod N
-                new_x = (2 * x - y) % N
-                new_y = (-x + y) % N
-                temp[new_x, new_y] = descrambled[x, y]
-        descrambled = temp
+    for name in metrics:
+        if name == 'psnr':
+            report['psnr'] = _psnr_from_mse(mse, max_pixel)
+        elif name == 'ssim':
+            modified_gray = _gray(modified)
+            data_range = int(modified_gray.max()) - int(modified_gray.min())
+            report['ssim'] = _ssim_mean(_gray(original), modified_gray, data_range, fast_ssim)
+        else:
+            report['mse'] = mse
     
-    return descrambled
+    return report
 
 
 def calculate_mse(original, modified):
     """Tính Mean Squared Error"""
-    return np.mean((original.astype(float) - modified.astype(float)) ** 2)
+    return _squared_error(original, modified) / original.size
 
 
 def calculate_psnr(original, modified, max_pixel=255.0):
@@ -84,28 +290,48 @@ def calculate_psnr(original, modified, max_pixel=255.0):
     Returns:
         PSNR value (dB). Giá trị càng cao càng tốt (>30dB là tốt)
     """
-    mse = calculate_mse(original, modified)
-    if mse == 0:
-        return float('inf')
-    return 20 * np.log10(max_pixel / np.sqrt(mse))
+    return _psnr_from_mse(calculate_mse(original, modified), max_pixel)
 
 
-def calculate_ssim(original, modified):
+def calculate_ssim(original, modified, fast=False):
     """
     Tính Structural Similarity Index
     
+    Args:
+        fast: Chỉ tính trên các dải hàng lấy mẫu (fast SSIM)
+    
     Returns:
         SSIM value (0-1). Giá trị càng gần 1 càng tốt
     """
-    # Chuyển sang grayscale nếu là ảnh màu
-    if len(original.shape) == 3:
-        original_gray = cv2.cvtColor(original, cv2.COLOR_BGR2GRAY)
-        modified_gray = cv2.cvtColor(modified, cv2.COLOR_BGR2GRAY)
-    else:
-        original_gray = original
-        modified_gray = modified
+    return calculate_quality_metrics(original, modified, ('ssim',), fast_ssim=fast)['ssim']
+
+
+def calculate_ssim_rows(original, modified, y0, y1, data_range):
+    """
+    Tổng SSIM map của dải hàng [y0, y1) (giống calculate_ssim trên toàn ảnh)
     
-    return ssim(original_gray, modified_gray, data_range=modified_gray.max() - modified_gray.min())
+    Dải được lấy dư SSIM_PAD hàng mỗi bên để cửa sổ SSIM giống hệt khi tính
+    trên toàn ảnh; tổng các dải chia cho tổng số pixels = calculate_ssim.
+    
+    Args:
+        original, modified: Ảnh BGR hoặc grayscale toàn ảnh (có thể là memmap / shared memory)
+        y0, y1: Dải hàng
+        data_range: Data range của toàn ảnh modified (grayscale max - min)
+    
+    Returns:
+        tuple (tổng SSIM, số pixels) của phần dải nằm trong vùng SSIM của toàn ảnh
+    """
+    height, width = original.shape[:2]
+    lo, hi = max(0, y0 - SSIM_PAD), min(height, y1 + SSIM_PAD)
+    if min(y1, height - SSIM_PAD) <= max(y0, SSIM_PAD):
+        return 0.0, 0
+    
+    ssim_map = _ssim_map(_gray(original[lo:hi]), _gray(modified[lo:hi]), data_range)
+    
+    # Bỏ SSIM_PAD pixels ở biên ảnh khi lấy trung bình (như calculate_ssim)
+    rows = slice(max(y0, SSIM_PAD) - lo, min(y1, height - SSIM_PAD) - lo)
+    window = ssim_map[rows, SSIM_PAD:width - SSIM_PAD]
+    return float(window.sum(dtype=np.float64)), window.size
 
 
 def calculate_nc(original_watermark, extracted_watermark):
@@ -132,6 +358,10 @@ def resize_to_square(image, size):
     return cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
 
 
+# Các loại tấn công của apply_attack
+ATTACK_TYPES = ('jpeg_compression', 'gaussian_noise', 'crop', 'rotate')
+
+
 def apply_attack(image, attack_type, **params):
     """
     Mô phỏng các tấn công vào ảnh để test độ bền của watermark
@@ -155,8 +385,9 @@ def apply_attack(image, attack_type, **params):
     elif attack_type == 'gaussian_noise':
         mean = params.get('mean', 0)
         std = params.get('std', 25)
-        noise = np.random.normal(mean, std, attacked.shape).astype(np.uint8)
-        attacked = cv2.add(attacked, noise)
+        # Cộng nhiễu trên float rồi clip (ép nhiễu âm về uint8 sẽ bị tràn thành ~255)
+        noise = np.random.normal(mean, std, attacked.shape)
+        attacked = np.clip(attacked + noise, 0, 255).astype(np.uint8)
     
     elif attack_type == 'crop':
         crop_percent = params.get('crop_percent', 0.2)
@@ -174,3 +405,276 @@ def apply_attack(image, attack_type, **params):
         attacked = cv2.warpAffine(attacked, matrix, (w, h))
     
     return attacked
+
+
+def decode_image(data, flags=cv2.IMREAD_COLOR):
+    """
+    Decode ảnh từ bytes đã mã hóa (PNG, JPEG, ...) trong bộ nhớ
+    
+    Args:
+        data: bytes / bytearray / memoryview của file ảnh
+        flags: Cờ cv2.imdecode (mặc định BGR 8-bit)
+    
+    Returns:
+        Mảng ảnh
+    
+    Raises:
+        ValueError: Dữ liệu rỗng hoặc không phải ảnh
+    """
+    buffer = np.frombuffer(data, dtype=np.uint8) if data is not None else None
+    image = cv2.imdecode(buffer, flags) if buffer is not None and buffer.size else None
+    if image is None:
+        raise ValueError("Cannot decode image")
+    return image
+
+
+def encode_image(image, image_format='.png', params=None):
+    """
+    Mã hóa ảnh thành bytes trong bộ nhớ (không ghi file)
+    
+    Args:
+        image: Mảng ảnh (BGR / grayscale)
+        image_format: Phần mở rộng định dạng ('.png', '.jpg', '.webp', ...)
+        params: Tham số cv2.imencode (ví dụ [cv2.IMWRITE_JPEG_QUALITY, 90])
+    
+    Returns:
+        bytes: Nội dung file ảnh
+    """
+    ok, encoded = cv2.imencode(image_format, image, params or [])
+    if not ok:
+        raise ValueError(f"Cannot encode image as {image_format}")
+    return encoded.tobytes()
+
+
+def load_image(source, flags=cv2.IMREAD_COLOR):
+    """
+    Lấy ảnh đã decode từ đường dẫn, bytes đã mã hóa hoặc mảng có sẵn
+    
+    Mảng được trả nguyên (không copy); đường dẫn đọc bằng cv2.imread, bytes
+    decode bằng cv2.imdecode.
+    
+    Returns:
+        Mảng ảnh, hoặc None nếu không đọc / decode được (giống cv2.imread)
+    """
+    if isinstance(source, np.ndarray):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        try:
+            return decode_image(source, flags)
+        except ValueError:
+            return None
+    return cv2.imread(source, flags)
+
+
+def _is_bgr_image(image):
+    """Mảng ảnh màu 8-bit (H, W, 3)"""
+    return image.ndim == 3 and image.shape[2] == 3 and image.dtype == np.uint8
+
+
+def open_image_memmap(path):
+    """
+    Mở ảnh BGR uint8 dạng memory-mapped nếu định dạng cho phép
+    
+    - .npy: np.load(mmap_mode='r'), mảng BGR (H, W, 3) như cv2
+    - .tif / .tiff không nén (cần tifffile): dữ liệu RGB, trả về view BGR
+    - Định dạng khác (PNG, JPEG, TIFF nén...): decode toàn bộ bằng cv2.imread
+    
+    Chỉ các vùng được đọc tới mới được nạp vào bộ nhớ.
+    
+    Returns:
+        Mảng BGR (có thể là view chỉ đọc của memmap) hoặc None nếu không đọc được
+    """
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == '.npy':
+            image = np.load(path, mmap_mode='r', allow_pickle=False)
+            return image if _is_bgr_image(image) else None
+        if extension in ('.tif', '.tiff') and tifffile is not None:
+            image = tifffile.memmap(path, mode='r')
+            if _is_bgr_image(image):
+                return image[:, :, ::-1]
+    except (OSError, ValueError):
+        # TIFF nén / không memory-map được -> decode bằng cv2
+        pass
+    return cv2.imread(path)
+
+
+def inspect_image(path):
+    """
+    Đọc kích thước ảnh từ header (không decode pixel)
+    
+    Dùng để validate ảnh rất lớn trước khi nhúng theo tile: .npy / TIFF không
+    nén được map thẳng từ file, định dạng khác chỉ đọc header bằng PIL.
+    
+    Returns:
+        tuple (height, width, memory_mapped) hoặc None nếu không đọc được.
+        memory_mapped = False nghĩa là open_image_memmap sẽ phải decode cả ảnh.
+    """
+    extension = os.path.splitext(path)[1].lower()
+    try:
+        if extension == '.npy':
+            image = np.load(path, mmap_mode='r', allow_pickle=False)
+            return (image.shape[0], image.shape[1], True) if _is_bgr_image(image) else None
+        if extension in ('.tif', '.tiff') and tifffile is not None:
+            try:
+                image = tifffile.memmap(path, mode='r')
+                if _is_bgr_image(image):
+                    return image.shape[0], image.shape[1], True
+            except (OSError, ValueError):
+                # TIFF nén -> chỉ đọc header
+                pass
+        with Image.open(path) as header:
+            width, height = header.size
+        return height, width, False
+    except (OSError, ValueError):
+        return None
+
+
+def read_luma_reduced(source):
+    """
+    Decode ảnh ở 1/2 độ phân giải, grayscale (cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    
+    Grayscale dùng cùng hệ số với kênh Y của YCrCb, và mỗi pixel là trung
+    bình khối 2x2 nên ảnh thu được xấp xỉ LL của Haar DWT / 2. JPEG được
+    decode thẳng ở 1/2 kích thước (IDCT thu nhỏ của libjpeg), không tạo ảnh
+    màu độ phân giải đầy đủ. Kích thước gốc đọc từ header ảnh.
+    
+    Returns:
+        tuple (luma uint8 (H/2, W/2), (H, W)), hoặc None nếu không đọc được /
+        kích thước lẻ (ảnh thu nhỏ khi đó không thẳng hàng với lưới 2x2)
+    
+    Args:
+        source: Đường dẫn ảnh hoặc bytes của file ảnh (decode trong bộ nhớ)
+    """
+    in_memory = isinstance(source, (bytes, bytearray, memoryview))
+    try:
+        with Image.open(io.BytesIO(source) if in_memory else source) as header:
+            width, height = header.size
+    except (OSError, ValueError):
+        return None
+    
+    if height % 2 or width % 2:
+        return None
+    
+    if in_memory:
+        luma = cv2.imdecode(np.frombuffer(source, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    else:
+        luma = cv2.imread(source, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+    if luma is None or luma.shape != (height // 2, width // 2):
+        return None
+    return luma, (height, width)
+
+
+def create_image_memmap(path, shape):
+    """
+    Tạo ảnh đích BGR uint8 memory-mapped để ghi từng tile
+    
+    - .npy: file .npy memory-mapped
+    - .tif / .tiff (cần tifffile): TIFF không nén memory-mapped (RGB)
+    - Định dạng khác: file tạm memory-mapped, encode bằng cv2.imwrite khi hoàn tất
+    
+    Args:
+        path: Đường dẫn ảnh đích
+        shape: (H, W, 3)
+    
+    Returns:
+        tuple (image, finalize): mảng BGR ghi được và hàm hoàn tất (flush / encode)
+    """
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        image = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=tuple(shape))
+        return image, image.flush
+    if extension in ('.tif', '.tiff') and tifffile is not None:
+        image = tifffile.memmap(path, shape=tuple(shape), dtype=np.uint8, photometric='rgb')
+        return image[:, :, ::-1], image.flush
+    
+    fd, temp_path = tempfile.mkstemp(suffix='.raw')
+    os.close(fd)
+    image = np.memmap(temp_path, dtype=np.uint8, mode='w+', shape=tuple(shape))
+    
+    def finalize():
+        try:
+            if not cv2.imwrite(path, image):
+                raise ValueError(f"Cannot write image: {path}")
+        finally:
+            os.remove(temp_path)
+    
+    return image, finalize
+
+
+# Process pool dùng chung (nhúng song song, robustness benchmark, sharding): tạo 1 lần với
+# số CPU, không bao giờ shutdown khi còn dùng được; mỗi lần gọi tự giới hạn song song (process_map)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def process_pool_size():
+    """Số processes của pool dùng chung (số CPU)"""
+    return os.cpu_count() or 1
+
+
+def shared_process_pool():
+    """
+    Process pool dùng chung (process_pool_size() processes), tạo lần đầu cần
+    
+    Pool không bị shutdown khi có lần gọi khác cần nhiều workers hơn: các
+    thread khác có thể đang submit vào pool. Chỉ pool bị hỏng mới bị bỏ
+    (discard_process_pool).
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=process_pool_size())
+        return _pool
+
+
+def discard_process_pool(pool):
+    """Bỏ pool bị hỏng (BrokenProcessPool: worker chết) để lần gọi sau tạo pool mới"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def process_map(function, tasks, max_workers):
+    """
+    Chạy function trên từng task trong process pool dùng chung, tối đa max_workers tasks cùng lúc
+    
+    Các lần gọi đồng thời (nhiều request) chia sẻ cùng processes; mỗi lần gọi
+    chỉ giữ tối đa max_workers tasks trong pool để không chiếm hết hàng đợi.
+    max_workers <= 1 hoặc chỉ 1 task: chạy tuần tự trong process hiện tại.
+    
+    Args:
+        function: Hàm cấp module (pickle được)
+        tasks: Iterable các tham số (mỗi task 1 tham số)
+        max_workers: Số tasks chạy song song tối đa của lần gọi này
+    
+    Returns:
+        list: Kết quả theo thứ tự tasks
+    """
+    tasks = list(tasks)
+    if max_workers <= 1 or len(tasks) <= 1:
+        return [function(task) for task in tasks]
+    
+    pool = shared_process_pool()
+    results = [None] * len(tasks)
+    pending = {}
+    queued = iter(enumerate(tasks))
+    try:
+        for index, task in islice(queued, max_workers):
+            pending[pool.submit(function, task)] = index
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[pending.pop(future)] = future.result()
+                for index, task in islice(queued, 1):
+                    pending[pool.submit(function, task)] = index
+    except BrokenProcessPool:
+        discard_process_pool(pool)
+        raise
+    finally:
+        # Lỗi ở 1 task: hủy các tasks chưa chạy của lần gọi này
+        for future in pending:
+            future.cancel()
+    return results
@@ -7,10 +7,9 @@ Chuẩn học thuật theo:
 """
 
 import cv2
-import os
-import tempfile
 import numpy as np
 from app.core.watermarking import DWT_DCT_SVD_Watermark
+from app.core.reference import WatermarkReference
 from tqdm import tqdm
 
 
@@ -103,7 +102,8 @@ class VideoWatermark:
         print(f"Total scene changes detected: {len(scene_change_frames)}")
         return scene_change_frames
     
-    def embed(self, video_path, watermark_path, output_path, progress_callback=None):
+    def embed(self, video_path, watermark_path, output_path, progress_callback=None, with_reference=False,
+              frame_metrics=False):
         """
         Nhúng watermark vào video với Scene Change Detection (CHUẨN HỌC THUẬT)
         
@@ -118,10 +118,19 @@ class VideoWatermark:
             watermark_path: Đường dẫn ảnh watermark
             output_path: Đường dẫn lưu video đã watermark
             progress_callback: Hàm callback để báo tiến độ (optional)
+            with_reference: Tạo bản ghi tham chiếu (S[0] gốc của các frames đã
+                nhúng) để trích xuất không cần video gốc
+            frame_metrics: Tính PSNR / SSIM của từng key frame (trung bình trong
+                'quality_metrics'); mặc định bỏ qua để nhúng nhanh
         
         Returns:
-            dict: Thông tin về quá trình nhúng
+            dict: Thông tin về quá trình nhúng (kèm 'reference' nếu with_reference)
         """
+        # Watermark đọc 1 lần; watermark đã chuẩn bị và bố cục blocks tính 1 lần cho mọi frame
+        watermark = cv2.imread(watermark_path)
+        if watermark is None:
+            raise ValueError(f"Cannot read watermark: {watermark_path}")
+        
         # Mở video
         cap = cv2.VideoCapture(video_path)
         if not cap.isOpened():
@@ -139,11 +148,12 @@ class VideoWatermark:
             # Thêm periodic frames để đảm bảo coverage
             periodic_frames = list(range(0, total_frames, self.frame_skip))
             # Merge và loại bỏ duplicates
-            key_frames = sorted(list(set(scene_frames + periodic_frames)))
+            key_frames = set(scene_frames + periodic_frames)
+            scene_frames = set(scene_frames)
             print(f"Key frames to watermark: {len(key_frames)} out of {total_frames}")
         else:
             # Fallback: chỉ dùng periodic frames
-            key_frames = list(range(0, total_frames, self.frame_skip))
+            key_frames = set(range(0, total_frames, self.frame_skip))
         
         # Reset video capture
         cap.release()
@@ -153,13 +163,12 @@ class VideoWatermark:
         fourcc = cv2.VideoWriter_fourcc(*'mp4v')
         out = cv2.VideoWriter(output_path, fourcc, fps, (width, height))
         
-        # Tạo thư mục tạm để lưu frames
-        temp_dir = tempfile.mkdtemp()
-        
         frame_count = 0
         watermarked_count = 0
         scene_changes_used = 0
-        watermark_size_result = None  # Lưu watermark size từ frame đầu tiên
+        plan = None  # Watermark + bố cục blocks, tính từ frame đầu tiên được nhúng
+        reference_frames = {}  # frame number -> S[0] gốc (bản ghi tham chiếu)
+        quality_sums = {}
         
         print(f"Processing video: {total_frames} frames, {fps} FPS")
         print(f"Scene detection: {'Enabled' if self.use_scene_detection else 'Disabled'}")
@@ -169,33 +178,27 @@ class VideoWatermark:
             if not ret:
                 break
             
-            # Nhúng watermark vào key frames
+            # Nhúng watermark vào key frames (trực tiếp trên frame đã decode, không qua file tạm)
             if frame_count in key_frames:
-                # Lưu frame tạm
-                temp_frame_path = os.path.join(temp_dir, f"frame_{frame_count}.png")
-                temp_watermarked_path = os.path.join(temp_dir, f"watermarked_{frame_count}.png")
-                
-                cv2.imwrite(temp_frame_path, frame)
-                
-                # Nhúng watermark
                 try:
-                    embed_result = self.watermarker.embed(temp_frame_path, watermark_path, temp_watermarked_path)
-                    
-                    # Lưu watermark_size từ frame đầu tiên
-                    if watermarked_count == 0 and 'watermark_size' in embed_result:
-                        watermark_size_result = embed_result['watermark_size']
+                    if plan is None:
+                        plan = self.watermarker.plan_frames(watermark, *frame.shape[:2])
                     
-                    watermarked_frame = cv2.imread(temp_watermarked_path)
+                    watermarked_frame, original_s0, quality = self.watermarker.embed_frame(
+                        frame, plan, with_metrics=frame_metrics
+                    )
                     out.write(watermarked_frame)
                     watermarked_count += 1
                     
+                    if with_reference:
+                        reference_frames[frame_count] = original_s0
+                    if quality is not None:
+                        for name, value in quality.items():
+                            quality_sums[name] = quality_sums.get(name, 0.0) + value
+                    
                     # Check if this is a scene change frame
                     if self.use_scene_detection and frame_count in scene_frames:
                         scene_changes_used += 1
-                    
-                    # Xóa file tạm
-                    os.remove(temp_frame_path)
-                    os.remove(temp_watermarked_path)
                 except Exception as e:
                     print(f"Error watermarking frame {frame_count}: {e}")
                     out.write(frame)
@@ -217,13 +220,7 @@ class VideoWatermark:
         cap.release()
         out.release()
         
-        # Xóa thư mục tạm
-        try:
-            os.rmdir(temp_dir)
-        except:
-            pass
-        
-        return {
+        result = {
             'success': True,
             'total_frames': total_frames,
             'watermarked_frames': watermarked_count,
@@ -234,53 +231,83 @@ class VideoWatermark:
             'frame_skip': self.frame_skip,
             'scene_detection_enabled': self.use_scene_detection,
             'efficiency_improvement': f"{(1 - watermarked_count/total_frames) * 100:.1f}% fewer frames processed",
-            'watermark_size': watermark_size_result  # Thêm watermark size
+            'watermark_size': f"{plan['watermark_size']}x{plan['watermark_size']}" if plan else None
         }
+        
+        if frame_metrics and watermarked_count:
+            result['quality_metrics'] = {name: float(total / watermarked_count) for name, total in quality_sums.items()}
+        
+        if with_reference:
+            result['reference'] = None
+            # Chỉ khi watermark được nhúng đủ (giống bản ghi của ảnh tĩnh)
+            if plan is not None and plan['complete'] and reference_frames:
+                watermarker = self.watermarker
+                result['reference'] = WatermarkReference(
+                    block_size=watermarker.block_size,
+                    alpha=watermarker.alpha,
+                    arnold_iterations=watermarker.arnold_iterations,
+                    use_dwt=watermarker.use_dwt,
+                    wavelet=watermarker.wavelet if watermarker.use_dwt else None,
+                    watermark_size=plan['watermark_size'],
+                    height=plan['shape'][0],
+                    width=plan['shape'][1],
+                    frames=reference_frames,
+                    is_video=True
+                )
+        
+        return result
     
-    def extract_from_frame(self, video_path, original_video_path, frame_number, watermark_size):
+    def extract_from_frame(self, video_path, original_video_path, frame_number, watermark_size, reference=None):
         """
         Trích xuất watermark từ một frame cụ thể
         
         Args:
             video_path: Video đã watermark
-            original_video_path: Video gốc
+            original_video_path: Video gốc (không cần nếu có reference)
             frame_number: Số thứ tự frame cần trích xuất
-            watermark_size: Kích thước watermark
+            watermark_size: Kích thước watermark (bỏ qua nếu có reference)
+            reference: WatermarkReference tạo lúc nhúng, thay cho video gốc
         
         Returns:
             numpy array: Watermark đã trích xuất
         """
         # Mở video
         cap_watermarked = cv2.VideoCapture(video_path)
-        cap_original = cv2.VideoCapture(original_video_path)
         
         # Nhảy đến frame cần trích xuất
         cap_watermarked.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        cap_original.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        
         ret1, watermarked_frame = cap_watermarked.read()
-        ret2, original_frame = cap_original.read()
-        
         cap_watermarked.release()
-        cap_original.release()
+        
+        # Video gốc chỉ cần khi không có bản ghi tham chiếu
+        ret2, original_frame = True, None
+        if reference is None:
+            cap_original = cv2.VideoCapture(original_video_path)
+            cap_original.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+            ret2, original_frame = cap_original.read()
+            cap_original.release()
         
         if not ret1 or not ret2:
             raise ValueError(f"Cannot read frame {frame_number}")
         
-        # Lưu frames tạm
-        temp_dir = tempfile.mkdtemp()
-        watermarked_path = os.path.join(temp_dir, "watermarked.png")
-        original_path = os.path.join(temp_dir, "original.png")
-        
-        cv2.imwrite(watermarked_path, watermarked_frame)
-        cv2.imwrite(original_path, original_frame)
-        
-        # Trích xuất watermark
-        extracted = self.watermarker.extract(watermarked_path, original_path, watermark_size)
+        return self.extract_frame_array(watermarked_frame, original_frame, frame_number, watermark_size, reference)
+    
+    def extract_frame_array(self, watermarked_frame, original_frame=None, frame_number=0, watermark_size=None,
+                            reference=None):
+        """
+        Trích xuất watermark từ frame đã decode (không ghi frame ra file tạm)
         
-        # Xóa files tạm
-        os.remove(watermarked_path)
-        os.remove(original_path)
-        os.rmdir(temp_dir)
+        Args:
+            watermarked_frame: Frame đã watermark (BGR uint8)
+            original_frame: Frame gốc tương ứng (không cần nếu có reference)
+            frame_number: Số thứ tự frame (để lấy S[0] gốc trong reference)
+            watermark_size: Kích thước watermark (bỏ qua nếu có reference)
+            reference: WatermarkReference tạo lúc nhúng, thay cho video gốc
         
-        return extracted
+        Returns:
+            numpy array: Watermark đã trích xuất
+        """
+        if reference is not None:
+            return reference.watermarker().extract_array(watermarked_frame, reference=reference,
+                                                         frame_number=frame_number)
+        return self.watermarker.extract_array(watermarked_frame, original_frame, watermark_size)
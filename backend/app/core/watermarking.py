@@ -5,11 +5,156 @@ Chuẩn học thuật theo:
 - Exploring DWT–SVD–DCT for JPEG Robustness (2014)
 """
 
+import os
+import hashlib
+import tempfile
+import threading
 import numpy as np
 import cv2
 import pywt
 from scipy.fftpack import dct, idct
-from app.core.utils import arnold_cat_map, inverse_arnold_cat_map, calculate_psnr, calculate_ssim, calculate_mse
+from collections import OrderedDict
+from functools import lru_cache
+from app.core.reference import WatermarkReference
+from app.core.utils import arnold_cat_map, inverse_arnold_cat_map, calculate_quality_metrics, calculate_ssim, \
+    calculate_nc, apply_attack, open_image_memmap, create_image_memmap, read_luma_reduced, parse_metrics, QUALITY_METRICS, \
+    decode_image, encode_image, load_image, _psnr_from_mse
+
+
+# Sai khác NC tối đa giữa reduced_decode và decode đầy đủ (trích xuất mù QIM,
+# ảnh chưa bị tấn công / tấn công nhẹ), xem DWT_DCT_SVD_Watermark.extract
+REDUCED_DECODE_NC_TOLERANCE = 0.02
+
+
+@lru_cache(maxsize=8)
+def _dct_matrix(size):
+    """
+    Ma trận cơ sở DCT-II trực chuẩn (size x size, float32)
+    
+    DCT 2D của block X (norm='ortho') = C @ X @ C.T, IDCT = C.T @ Y @ C
+    """
+    n = np.arange(size)
+    basis = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size)) * np.sqrt(2.0 / size)
+    basis[0] /= np.sqrt(2.0)
+    basis = basis.astype(np.float32)
+    basis.flags.writeable = False
+    return basis
+
+
+class _ReducedLuma:
+    """Ảnh decode ở 1/2 độ phân giải (grayscale ~ kênh Y) kèm kích thước gốc, dùng cho trích xuất Haar"""
+    
+    def __init__(self, luma, size):
+        self.luma = luma
+        self.shape = (size[0], size[1], 3)
+
+
+class PreparedWatermarkCache:
+    """
+    LRU cache watermark đã chuẩn bị (binary + Arnold scrambling) theo content hash
+    
+    Key là (hash nội dung pixel của watermark, kích thước, số lần Arnold): cùng
+    1 logo dùng cho nhiều ảnh host chỉ phải grayscale / resize / threshold /
+    xáo trộn 1 lần. Tầng đĩa (tùy chọn) lưu các bits dạng .npy để dùng lại
+    giữa các process / lần khởi động. An toàn khi dùng từ nhiều thread.
+    """
+    
+    def __init__(self, maxsize=64, disk_dir=None):
+        """
+        Args:
+            maxsize: Số entries tối đa trong bộ nhớ
+            disk_dir: Thư mục của tầng đĩa (None = chỉ dùng bộ nhớ)
+        """
+        self.maxsize = maxsize
+        self.disk_dir = disk_dir
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def content_key(watermark, target_size, arnold_iterations):
+        """Key của watermark: BLAKE2b của pixels + shape, kích thước, số lần Arnold"""
+        digest = hashlib.blake2b(np.ascontiguousarray(watermark).data, digest_size=16)
+        digest.update(repr(watermark.shape).encode('ascii'))
+        return digest.hexdigest(), int(target_size), int(arnold_iterations)
+    
+    def _disk_path(self, key):
+        """Đường dẫn file .npy của entry trên tầng đĩa"""
+        return os.path.join(self.disk_dir, '{}_{}_{}.npy'.format(*key))
+    
+    def get(self, key):
+        """Lấy watermark đã chuẩn bị (uint8 0/1, chỉ đọc) hoặc None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        
+        if self.disk_dir:
+            try:
+                entry = np.load(self._disk_path(key), allow_pickle=False)
+            except (OSError, ValueError):
+                entry = None
+            if entry is not None and entry.shape == (key[1], key[1]):
+                entry.setflags(write=False)
+                with self._lock:
+                    self.disk_hits += 1
+                self._store(key, entry)
+                return entry
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def _store(self, key, entry):
+        """Lưu entry vào bộ nhớ (LRU)"""
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+    
+    def put(self, key, entry):
+        """Thêm entry (bộ nhớ + đĩa), loại entry ít dùng nhất khi vượt maxsize"""
+        entry = np.ascontiguousarray(entry, dtype=np.uint8)
+        entry.setflags(write=False)
+        self._store(key, entry)
+        
+        if self.disk_dir:
+            # Ghi file tạm rồi rename để process khác không đọc phải file ghi dở
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+                fd, temp_path = tempfile.mkstemp(dir=self.disk_dir, suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, entry, allow_pickle=False)
+                os.replace(temp_path, self._disk_path(key))
+            except OSError:
+                pass
+        return entry
+    
+    def clear(self):
+        """Xóa cache trong bộ nhớ và bộ đếm (không xóa tầng đĩa)"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+    
+    def stats(self):
+        """Thống kê cache: số entries, hits (bộ nhớ / đĩa), misses"""
+        with self._lock:
+            return {
+                'entries': len(self._entries), 'maxsize': self.maxsize, 'disk_dir': self.disk_dir,
+                'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses
+            }
+
+
+# Cache dùng chung cho mọi instance (ảnh tĩnh, video, fan-out); tầng đĩa bật qua biến môi trường
+WATERMARK_CACHE_DIR_ENV = "WATERMARK_CACHE_DIR"
+prepared_watermark_cache = PreparedWatermarkCache(disk_dir=os.getenv(WATERMARK_CACHE_DIR_ENV) or None)
 
 
 class DWT_DCT_SVD_Watermark:
@@ -31,7 +176,11 @@ class DWT_DCT_SVD_Watermark:
     - Tốt hơn 46% so với DCT-only
     """
     
-    def __init__(self, block_size=8, alpha=0.1, arnold_iterations=10, use_dwt=True, wavelet='haar'):
+    # Trích xuất không cần ảnh gốc (QIM)
+    BLIND = False
+    
+    def __init__(self, block_size=8, alpha=0.1, arnold_iterations=10, use_dwt=True, wavelet='haar',
+                 metrics=QUALITY_METRICS, fast_ssim=False):
         """
         Args:
             block_size: Kích thước block cho DCT (8x8 chuẩn JPEG)
@@ -39,12 +188,16 @@ class DWT_DCT_SVD_Watermark:
             arnold_iterations: Số lần xáo trộn Arnold Cat Map
             use_dwt: Sử dụng DWT layer (True = DWT-DCT-SVD, False = DCT-SVD)
             wavelet: Loại wavelet ('haar', 'db1', 'db2', etc.)
+            metrics: Quality metrics tính sau khi nhúng ('psnr', 'ssim', 'mse'; xem parse_metrics)
+            fast_ssim: SSIM ước lượng trên các dải hàng lấy mẫu (nhúng toàn ảnh / tiled)
         """
         self.block_size = block_size
         self.alpha = alpha
         self.arnold_iterations = arnold_iterations
         self.use_dwt = use_dwt
         self.wavelet = wavelet
+        self.metrics = parse_metrics(metrics)
+        self.fast_ssim = fast_ssim
     
     def _dct2(self, block):
         """2D DCT Transform"""
@@ -85,6 +238,132 @@ class DWT_DCT_SVD_Watermark:
         
         return dct_block_modified
     
+    def _to_blocks(self, band, num_blocks):
+        """
+        Tách num_blocks block đầu tiên (theo hàng) của band thành tensor (n, B, B)
+        
+        Returns:
+            tuple (blocks, rows): tensor blocks và số hàng block đã dùng
+        """
+        b = self.block_size
+        blocks_w = band.shape[1] // b
+        rows = -(-num_blocks // blocks_w)
+        strip = band[:rows * b, :blocks_w * b]
+        blocks = strip.reshape(rows, b, blocks_w, b).swapaxes(1, 2).reshape(-1, b, b)
+        return blocks[:num_blocks], rows
+    
+    def _from_blocks(self, band, blocks, rows):
+        """Ghi tensor blocks (n, B, B) trở lại band (in-place), theo đúng thứ tự của _to_blocks"""
+        b = self.block_size
+        blocks_w = band.shape[1] // b
+        strip = band[:rows * b, :blocks_w * b].reshape(rows, b, blocks_w, b).swapaxes(1, 2).reshape(-1, b, b)
+        strip[:len(blocks)] = blocks
+        band[:rows * b, :blocks_w * b] = strip.reshape(rows, blocks_w, b, b).swapaxes(1, 2).reshape(rows * b, blocks_w * b)
+    
+    def _top_singular_triplets(self, matrices, squarings=6, tolerance=1e-4):
+        """
+        Singular triplet lớn nhất (u0, S0, v0) của tensor ma trận (n, B, B)
+        
+        Chỉ S[0] được dùng để nhúng nên không cần SVD đầy đủ: lũy thừa
+        M = A^T A bằng bình phương liên tiếp (M^(2^squarings), chuẩn hóa mỗi
+        bước để float32 không tràn) cho v0, rồi S0 = |A v0|, u0 = A v0 / S0.
+        Blocks chưa hội tụ (S0 ~ S1) được tính lại bằng np.linalg.svd.
+        
+        Returns:
+            tuple (u0, s0, v0): (n, B), (n,), (n, B)
+        """
+        tiny = np.float32(1e-30)
+        gram = np.swapaxes(matrices, 1, 2) @ matrices
+        for _ in range(squarings):
+            gram = gram / (np.abs(gram).max(axis=(1, 2), keepdims=True) + tiny)
+            gram = gram @ gram
+        
+        # Cột có norm lớn nhất của M^(2^k) ~ hướng v0
+        column = np.argmax(np.einsum('nij,nij->nj', gram, gram), axis=1)
+        v0 = np.take_along_axis(gram, column[:, None, None], axis=2)[:, :, 0]
+        v0 /= np.linalg.norm(v0, axis=1, keepdims=True) + tiny
+        
+        projected = np.einsum('nij,nj->ni', matrices, v0)
+        s0 = np.linalg.norm(projected, axis=1)
+        u0 = projected / (s0[:, None] + tiny)
+        
+        # Kiểm tra hội tụ: A^T u0 = S0 v0
+        residual = np.linalg.norm(np.einsum('nji,nj->ni', matrices, u0) - s0[:, None] * v0, axis=1)
+        unconverged = np.flatnonzero(residual > tolerance * np.maximum(s0, 1))
+        if len(unconverged):
+            U, S, Vt = np.linalg.svd(matrices[unconverged], full_matrices=False)
+            u0[unconverged] = U[:, :, 0]
+            s0[unconverged] = S[:, 0]
+            v0[unconverged] = Vt[:, 0, :]
+        
+        return u0, s0, v0
+    
+    def _modulate(self, s0, watermark_bits):
+        """
+        S[0] mới của từng block sau khi nhúng bit
+        
+        Theo paper: S'[0] = S[0] * (1 ± alpha)
+        """
+        sign = np.where(watermark_bits == 1, 1, -1).astype(np.float32)
+        return s0 * (1 + sign * np.float32(self.alpha))
+    
+    def _embed_blocks(self, band, watermark_bits):
+        """
+        Nhúng watermark vào band theo lô (BATCHED DCT-SVD ENGINE)
+        
+        Tương đương vòng lặp _dct2 -> _embed_svd -> _idct2 trên từng block
+        nhưng xử lý tất cả blocks cùng lúc, giữ float32:
+        1. Tách band thành tensor (n, 8, 8)
+        2. DCT = C @ X @ C.T bằng einsum với ma trận cơ sở DCT
+        3. SVD xếp chồng (stacked) trên toàn bộ tensor, chỉ lấy triplet lớn nhất
+        4. Chỉ S[0] thay đổi nên U * S' * V^T = DCT + dS0 * u0 * v0^T (rank-1),
+           và IDCT của phần thay đổi = dS0 * (C.T @ u0)(C.T @ v0)^T
+        5. Ghi tất cả blocks về band trong 1 lần
+        
+        Args:
+            band: Sub-band float32 (bị thay đổi in-place)
+            watermark_bits: Mảng bits watermark (0/1), 1 bit/block
+        
+        Returns:
+            Mảng float32 S[0] gốc của từng block (dùng cho bản ghi tham chiếu)
+        """
+        if len(watermark_bits) == 0:
+            return np.zeros(0, dtype=np.float32)
+        
+        blocks, rows = self._to_blocks(band, len(watermark_bits))
+        blocks, s0 = self._embed_block_tensor(blocks, watermark_bits)
+        
+        self._from_blocks(band, blocks, rows)
+        return s0
+    
+    def _embed_block_tensor(self, blocks, watermark_bits):
+        """
+        Nhúng 1 bit vào mỗi block của tensor (n, B, B) (bước 2-4 của _embed_blocks)
+        
+        Returns:
+            tuple (blocks, s0): tensor blocks đã nhúng và S[0] gốc của từng block
+        """
+        u0, s0, v0 = self._decompose_blocks(blocks)
+        return self._apply_rank1(blocks, u0, s0, v0, watermark_bits), s0
+    
+    def _decompose_blocks(self, blocks):
+        """
+        DCT + singular triplet lớn nhất của từng block trong tensor (n, B, B)
+        
+        Returns:
+            tuple (u0, s0, v0): u0 / v0 đã chuyển về miền không gian (C.T @ u0, C.T @ v0)
+        """
+        basis = _dct_matrix(self.block_size)
+        
+        dct_blocks = np.einsum('ij,njk,lk->nil', basis, blocks, basis, optimize=True)
+        u0, s0, v0 = self._top_singular_triplets(dct_blocks)
+        return u0 @ basis, s0, v0 @ basis
+    
+    def _apply_rank1(self, blocks, u0, s0, v0, watermark_bits):
+        """Blocks sau khi đổi S[0] theo bits: IDCT của thay đổi rank-1 = dS0 * (C.T u0)(C.T v0)^T"""
+        delta = self._modulate(s0, watermark_bits) - s0
+        return blocks + delta[:, None, None] * u0[:, :, None] * v0[:, None, :]
+    
     def _extract_svd(self, watermarked_dct_block, original_dct_block):
         """
         Trích xuất watermark từ singular values (CHUẨN HỌC THUẬT)
@@ -109,6 +388,101 @@ class DWT_DCT_SVD_Watermark:
         else:
             return 0
     
+    def _extraction_band(self, image, num_blocks):
+        """
+        Sub-band dùng để trích xuất, chỉ tính trên dải hàng chứa num_blocks block đầu
+        
+        Blocks được dùng theo hàng từ trên xuống nên chỉ cần kênh Y và DWT của
+        dải đầu ảnh. Dải được lấy dư thêm độ dài filter của wavelet để các hàng
+        LL cần dùng giống hệt DWT toàn ảnh.
+        
+        Args:
+            image: Ảnh BGR, hoặc _ReducedLuma (LL Haar = 2 x ảnh thu nhỏ, không cần DWT)
+            num_blocks: Số blocks cần trích xuất
+        
+        Returns:
+            Sub-band float32 (LL nếu dùng DWT, kênh Y nếu không)
+        """
+        width = image.shape[1]
+        if self.use_dwt:
+            filter_length = pywt.Wavelet(self.wavelet).dec_len
+            band_width = pywt.dwt_coeff_len(width, filter_length, 'symmetric')
+        else:
+            band_width = width
+        
+        band_rows = -(-num_blocks // max(band_width // self.block_size, 1)) * self.block_size
+        strip_rows = 2 * band_rows + filter_length if self.use_dwt else band_rows
+        
+        if isinstance(image, _ReducedLuma):
+            return image.luma[:band_rows].astype(np.float32) * 2
+        
+        strip_y = cv2.cvtColor(np.ascontiguousarray(image[:strip_rows]), cv2.COLOR_BGR2YCrCb)[:, :, 0].astype(np.float32)
+        if self.use_dwt:
+            return pywt.dwt2(strip_y, self.wavelet)[0]
+        return strip_y
+    
+    def _block_s0(self, band, num_blocks):
+        """
+        S[0] của num_blocks block đầu tiên (BATCHED EXTRACTION)
+        
+        DCT trực chuẩn (C @ X @ C.T) không đổi singular values nên S[0] của
+        block DCT được tính thẳng trên block không gian, và chỉ tính singular
+        value lớn nhất cho tất cả blocks cùng lúc thay vì SVD đầy đủ mỗi block.
+        """
+        available = (band.shape[0] // self.block_size) * (band.shape[1] // self.block_size)
+        if num_blocks > available:
+            raise ValueError(f"Image too small for watermark size: {available} blocks, {num_blocks} bits needed")
+        if num_blocks == 0:
+            return np.zeros(0, dtype=np.float32)
+        
+        blocks, _ = self._to_blocks(band.astype(np.float32, copy=False), num_blocks)
+        return self._top_singular_triplets(blocks)[1]
+    
+    def _extract_ratios(self, watermarked_band, original_s0):
+        """
+        Tỉ số S0_wm / S0_orig của từng block (tương đương _dct2 + _extract_svd)
+        
+        Args:
+            watermarked_band: Sub-band của ảnh đã watermark
+            original_s0: S[0] gốc (tính từ ảnh gốc hoặc lấy từ bản ghi tham chiếu)
+        
+        Returns:
+            Mảng float32: ratio > 1 -> bit 1, độ lệch khỏi 1 là độ tin cậy
+            (soft confidence) của bit
+        """
+        watermarked_s0 = self._block_s0(watermarked_band, len(original_s0))
+        return watermarked_s0 / np.maximum(original_s0, np.float32(1e-30))
+    
+    def _watermark_size(self, band_height, band_width):
+        """
+        Kích thước watermark theo số blocks của sub-band
+        
+        Watermark size = sqrt(số blocks / 2) để cân bằng giữa capacity và quality,
+        làm tròn lên bội số của 8 (chuẩn cho image processing), tối đa 64x64
+        """
+        num_blocks = (band_height // self.block_size) * (band_width // self.block_size)
+        watermark_size = int(np.sqrt(num_blocks // 2))
+        watermark_size = ((watermark_size + 7) // 8) * 8
+        return min(watermark_size, 64)
+    
+    def _band_shape(self, height, width):
+        """Kích thước sub-band dùng để nhúng của ảnh height x width"""
+        if not self.use_dwt:
+            return height, width
+        filter_length = pywt.Wavelet(self.wavelet).dec_len
+        return (pywt.dwt_coeff_len(height, filter_length, 'symmetric'),
+                pywt.dwt_coeff_len(width, filter_length, 'symmetric'))
+    
+    def _algorithm_name(self):
+        """Tên thuật toán trong kết quả"""
+        return 'DWT-DCT-SVD' if self.use_dwt else 'DCT-SVD'
+    
+    def _binary_watermark(self, watermark_gray, target_size):
+        """Resize watermark grayscale về kích thước vuông và threshold thành bits 0/1"""
+        watermark_resized = cv2.resize(watermark_gray, (target_size, target_size))
+        _, watermark_binary = cv2.threshold(watermark_resized, 127, 1, cv2.THRESH_BINARY)
+        return watermark_binary
+    
     def _prepare_watermark(self, watermark, target_size):
         """
         Chuẩn bị watermark: resize, grayscale, binary, Arnold scrambling
@@ -120,24 +494,27 @@ class DWT_DCT_SVD_Watermark:
         Returns:
             Watermark đã xử lý (binary, scrambled)
         """
-        # Chuyển sang grayscale
-        if len(watermark.shape) == 3:
-            watermark_gray = cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY)
-        else:
-            watermark_gray = watermark
-        
-        # Resize về kích thước vuông
-        watermark_resized = cv2.resize(watermark_gray, (target_size, target_size))
+        # Cùng logo, cùng kích thước, cùng số lần Arnold -> dùng lại kết quả đã cache
+        key = prepared_watermark_cache.content_key(watermark, target_size, self.arnold_iterations)
+        watermark_scrambled = prepared_watermark_cache.get(key)
         
-        # Binary threshold
-        _, watermark_binary = cv2.threshold(watermark_resized, 127, 1, cv2.THRESH_BINARY)
-        
-        # Arnold Cat Map scrambling
-        watermark_scrambled = arnold_cat_map(watermark_binary, self.arnold_iterations)
+        if watermark_scrambled is None:
+            # Chuyển sang grayscale
+            if len(watermark.shape) == 3:
+                watermark_gray = cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY)
+            else:
+                watermark_gray = watermark
+            
+            watermark_binary = self._binary_watermark(watermark_gray, target_size)
+            
+            # Arnold Cat Map scrambling
+            watermark_scrambled = prepared_watermark_cache.put(
+                key, arnold_cat_map(watermark_binary, self.arnold_iterations)
+            )
         
         return watermark_scrambled.astype(np.float32)
     
-    def embed(self, host_image_path, watermark_image_path, output_path):
+    def embed(self, host_image_path, watermark_image_path, output_path, with_reference=False):
         """
         Nhúng watermark vào ảnh gốc
         
@@ -145,9 +522,12 @@ class DWT_DCT_SVD_Watermark:
             host_image_path: Đường dẫn ảnh gốc
             watermark_image_path: Đường dẫn ảnh watermark
             output_path: Đường dẫn lưu ảnh đã watermark
+            with_reference: Tạo bản ghi tham chiếu (WatermarkReference) để
+                trích xuất không cần ảnh gốc
         
         Returns:
-            dict: Thông tin về quá trình nhúng
+            dict: Thông tin về quá trình nhúng (kèm 'reference' nếu with_reference,
+            None nếu ảnh quá nhỏ để trích xuất đủ watermark)
         """
         # Đọc ảnh
         host = cv2.imread(host_image_path)
@@ -156,6 +536,84 @@ class DWT_DCT_SVD_Watermark:
         if host is None or watermark is None:
             raise ValueError("Cannot read images")
         
+        watermarked_bgr, result = self._embed_image(host, watermark, with_reference)
+        
+        # Lưu ảnh
+        cv2.imwrite(output_path, watermarked_bgr)
+        
+        return result
+    
+    def embed_array(self, host, watermark, with_reference=False):
+        """
+        Nhúng watermark vào ảnh đã decode, hoàn toàn trong bộ nhớ
+        
+        Args:
+            host: Ảnh gốc BGR uint8 (không bị thay đổi)
+            watermark: Ảnh watermark (BGR hoặc grayscale)
+            with_reference: Tạo bản ghi tham chiếu (xem embed)
+        
+        Returns:
+            tuple (watermarked_bgr, result): ảnh đã watermark và dict như embed
+        """
+        if host is None or watermark is None:
+            raise ValueError("Cannot read images")
+        if host.ndim != 3 or host.shape[2] != 3 or host.dtype != np.uint8:
+            raise ValueError("Host image must be an 8-bit BGR array")
+        
+        return self._embed_image(host, watermark, with_reference)
+    
+    def embed_bytes(self, host_data, watermark_data, image_format='.png', with_reference=False):
+        """
+        Nhúng watermark vào ảnh đã mã hóa (bytes của file upload): decode 1 lần, encode 1 lần
+        
+        Args:
+            host_data: Bytes ảnh gốc (hoặc mảng đã decode)
+            watermark_data: Bytes ảnh watermark (hoặc mảng đã decode)
+            image_format: Định dạng ảnh kết quả (nên dùng định dạng không mất dữ liệu)
+            with_reference: Tạo bản ghi tham chiếu (xem embed)
+        
+        Returns:
+            tuple (bytes, result): file ảnh đã watermark và dict như embed
+        """
+        watermarked_bgr, result = self.embed_array(load_image(host_data), load_image(watermark_data), with_reference)
+        return encode_image(watermarked_bgr, image_format), result
+    
+    def _embed_image(self, host, watermark, with_reference=False):
+        """
+        Nhúng watermark vào ảnh đã decode (không đọc / ghi file)
+        
+        Args:
+            host: Ảnh gốc BGR uint8
+            watermark: Ảnh watermark (BGR hoặc grayscale)
+            with_reference: Tạo bản ghi tham chiếu (xem embed)
+        
+        Returns:
+            tuple (watermarked_bgr, result): ảnh đã watermark và dict thông tin
+        """
+        plan = self.plan_frames(watermark, *host.shape[:2])
+        watermarked_bgr, original_s0 = self._embed_full(host, plan['bits'])
+        
+        # Tính quality metrics (CHUẨN HỌC THUẬT): chỉ các metrics được chọn, 1 lần duyệt
+        quality = calculate_quality_metrics(host, watermarked_bgr, self.metrics, self.fast_ssim)
+        
+        result = self._embed_result(
+            plan['watermark_size'], len(plan['bits']), quality.get('psnr'), quality.get('ssim'), quality.get('mse')
+        )
+        
+        if with_reference:
+            result['reference'] = self._make_reference(
+                plan['watermark_size'], host.shape[:2], original_s0, plan['complete']
+            )
+        
+        return watermarked_bgr, result
+    
+    def _embed_full(self, host, watermark_bits):
+        """
+        Nhúng bits (theo thứ tự blocks) vào toàn ảnh: YCrCb -> DWT -> DCT-SVD -> IDWT -> BGR
+        
+        Returns:
+            tuple (watermarked_bgr, original_s0)
+        """
         # Chuyển host sang YCrCb (nhúng vào kênh Y - luminance)
         host_ycrcb = cv2.cvtColor(host, cv2.COLOR_BGR2YCrCb)
         host_y = host_ycrcb[:, :, 0].astype(np.float32)
@@ -171,50 +629,9 @@ class DWT_DCT_SVD_Watermark:
             selected_band = host_y
             LL = LH = HL = HH = None
         
-        # Tính kích thước watermark dựa trên số block
-        h, w = selected_band.shape
-        num_blocks_h = h // self.block_size
-        num_blocks_w = w // self.block_size
-        
-        # Watermark size = sqrt(số blocks / 2) để cân bằng giữa capacity và quality
-        watermark_size = int(np.sqrt(num_blocks_h * num_blocks_w // 2))
-        
-        # Làm tròn lên bội số của 8 (chuẩn cho image processing)
-        watermark_size = ((watermark_size + 7) // 8) * 8
-        
-        # Giới hạn tối đa 64x64
-        watermark_size = min(watermark_size, 64)
-        
-        # Chuẩn bị watermark
-        watermark_prepared = self._prepare_watermark(watermark, watermark_size)
-        watermark_flat = watermark_prepared.flatten()
-        
-        # Nhúng watermark vào các block DCT-SVD
-        watermarked_band = selected_band.copy()
-        watermark_idx = 0
-        
-        for i in range(0, h - self.block_size + 1, self.block_size):
-            for j in range(0, w - self.block_size + 1, self.block_size):
-                if watermark_idx >= len(watermark_flat):
-                    break
-                
-                # Lấy block
-                block = selected_band[i:i+self.block_size, j:j+self.block_size]
-                
-                # DCT Transform
-                dct_block = self._dct2(block)
-                
-                # SVD Embedding (CHUẨN HỌC THUẬT)
-                dct_block_modified = self._embed_svd(dct_block, watermark_flat[watermark_idx])
-                
-                # IDCT Transform
-                watermarked_block = self._idct2(dct_block_modified)
-                watermarked_band[i:i+self.block_size, j:j+self.block_size] = watermarked_block
-                
-                watermark_idx += 1
-            
-            if watermark_idx >= len(watermark_flat):
-                break
+        # Nhúng watermark vào các block DCT-SVD (theo lô, thứ tự block theo hàng)
+        watermarked_band = selected_band.astype(np.float32, copy=True)
+        original_s0 = self._embed_blocks(watermarked_band, watermark_bits)
         
         # IDWT Layer (CHUẨN HỌC THUẬT)
         if self.use_dwt:
@@ -232,98 +649,576 @@ class DWT_DCT_SVD_Watermark:
         
         # Ghép lại với Cr, Cb
         host_ycrcb[:, :, 0] = watermarked_y
-        watermarked_bgr = cv2.cvtColor(host_ycrcb, cv2.COLOR_YCrCb2BGR)
+        return cv2.cvtColor(host_ycrcb, cv2.COLOR_YCrCb2BGR), original_s0
+    
+    def plan_frames(self, watermark, height, width):
+        """
+        Chuẩn bị nhúng cho các frames cùng kích thước (video): watermark (resize,
+        binary, Arnold) và bố cục blocks chỉ tính 1 lần cho mọi frame
         
-        # Lưu ảnh
-        cv2.imwrite(output_path, watermarked_bgr)
+        Args:
+            watermark: Ảnh watermark (BGR hoặc grayscale)
+            height, width: Kích thước frame
+        
+        Returns:
+            dict: shape, watermark_size, bits (bits đã xáo trộn của các blocks được
+            nhúng), complete (đủ blocks cho toàn bộ watermark), strip ((hàng ghi,
+            hàng biến đổi) của dải đầu frame chứa các blocks, None = toàn frame)
+        """
+        b = self.block_size
+        band_h, band_w = self._band_shape(height, width)
+        watermark_size = self._watermark_size(band_h, band_w)
+        watermark_flat = self._prepare_watermark(watermark, watermark_size).flatten()
+        num_bits = min(len(watermark_flat), (band_h // b) * (band_w // b))
         
-        # Tính quality metrics (CHUẨN HỌC THUẬT)
-        psnr = calculate_psnr(host, watermarked_bgr)
-        ssim_val = calculate_ssim(host, watermarked_bgr)
-        mse = calculate_mse(host, watermarked_bgr)
+        # Chỉ dải hàng chứa các blocks được nhúng (kèm lề dài hơn filter) cần biến đổi,
+        # giống 1 dải của ParallelWatermark. Frame kích thước lẻ: embed resize sau IDWT
+        # nên biến đổi toàn frame để kết quả giống embed
+        strip = None
+        if not (self.use_dwt and (height % 2 or width % 2)):
+            scale, _, margin = self._tile_geometry()
+            rows = -(-num_bits // max(band_w // b, 1)) * b
+            written = height if rows >= band_h else scale * rows
+            region = height if rows + margin >= band_h else scale * (rows + margin)
+            strip = (written, region)
         
+        return {
+            'shape': (height, width),
+            'watermark_size': watermark_size,
+            'bits': watermark_flat[:num_bits],
+            'complete': num_bits == len(watermark_flat),
+            'strip': strip
+        }
+    
+    def embed_frame(self, frame, plan, with_metrics=False):
+        """
+        Nhúng watermark vào 1 frame đã decode theo plan_frames (không đọc / ghi file)
+        
+        Chỉ dải đầu frame chứa các blocks được nhúng được biến đổi: dải này giống
+        hệt embed_array, phần còn lại giữ nguyên pixels gốc (embed_array làm
+        tròn lại toàn frame qua YCrCb / IDWT), watermark trích xuất như nhau.
+        
+        Args:
+            frame: Frame BGR uint8 (không bị thay đổi)
+            plan: Kết quả của plan_frames cho kích thước frame này
+            with_metrics: Tính quality metrics (self.metrics) của frame
+        
+        Returns:
+            tuple (watermarked_frame, original_s0, quality): quality là dict
+            metrics nếu with_metrics, ngược lại None
+        """
+        if frame.shape[:2] != plan['shape']:
+            raise ValueError(
+                f"Frame size {frame.shape[1]}x{frame.shape[0]} does not match the plan "
+                f"({plan['shape'][1]}x{plan['shape'][0]})"
+            )
+        
+        bits = plan['bits']
+        if plan['strip'] is None:
+            watermarked, original_s0 = self._embed_full(frame, bits)
+        else:
+            written, region = plan['strip']
+            region_ycrcb, watermarked_y, bit_index, s0 = self._embed_tile(
+                frame[:region], (0, 0), plan['shape'], bits, len(bits)
+            )
+            watermarked = frame.copy()
+            watermarked[:written] = self._tile_bgr(region_ycrcb, watermarked_y, (slice(0, written), slice(None)))
+            original_s0 = np.zeros(len(bits), dtype=np.float32)
+            original_s0[bit_index] = s0
+        
+        quality = None
+        if with_metrics:
+            quality = calculate_quality_metrics(frame, watermarked, self.metrics, self.fast_ssim)
+        return watermarked, original_s0, quality
+    
+    def _embed_result(self, watermark_size, blocks_used, psnr, ssim_val, mse):
+        """Dict thông tin nhúng (chung cho embed, tiled, song song, fan-out), chỉ gồm metrics được chọn"""
+        values = {'psnr': psnr, 'ssim': ssim_val, 'mse': mse}
         return {
             'success': True,
             'watermark_size': f"{watermark_size}x{watermark_size}",
-            'blocks_used': watermark_idx,
+            'blocks_used': blocks_used,
             'alpha': self.alpha,
             'arnold_iterations': self.arnold_iterations,
-            'quality_metrics': {
-                'psnr': float(psnr),
-                'ssim': float(ssim_val),
-                'mse': float(mse)
-            },
-            'algorithm': 'DWT-DCT-SVD' if self.use_dwt else 'DCT-SVD',
+            'quality_metrics': {name: float(values[name]) for name in self.metrics},
+            'algorithm': self._algorithm_name(),
             'wavelet': self.wavelet if self.use_dwt else None
         }
     
-    def extract(self, watermarked_image_path, original_image_path, watermark_size):
+    def _make_reference(self, watermark_size, shape, original_s0, complete):
+        """
+        Bản ghi tham chiếu của 1 lần nhúng
+        
+        Returns:
+            WatermarkReference, hoặc None nếu watermark không được nhúng đủ
+            (complete=False) hoặc mode trích xuất mù
+        """
+        if not complete or self.BLIND:
+            return None
+        return WatermarkReference(
+            block_size=self.block_size,
+            alpha=self.alpha,
+            arnold_iterations=self.arnold_iterations,
+            use_dwt=self.use_dwt,
+            wavelet=self.wavelet if self.use_dwt else None,
+            watermark_size=watermark_size,
+            height=shape[0],
+            width=shape[1],
+            frames={0: original_s0}
+        )
+    
+    def _tile_geometry(self):
+        """
+        Tỉ lệ ảnh / sub-band, độ dài filter và lề của tile (theo sub-band)
+        
+        Lề là bội số của block size và dài hơn filter của wavelet để các blocks
+        được nhúng trong tile có hệ số sub-band đúng như DWT toàn ảnh, và các
+        pixels được ghi ra sau IDWT đúng như IDWT toàn ảnh.
+        """
+        if not self.use_dwt:
+            return 1, 0, 0
+        b = self.block_size
+        filter_length = pywt.Wavelet(self.wavelet).dec_len
+        return 2, filter_length, -(-(b + 2 * filter_length) // b) * b
+    
+    def _embed_tile(self, region, origin, image_shape, watermark_flat, num_bits):
+        """
+        Nhúng các payload blocks nằm trong 1 tile ảnh (đã kèm lề)
+        
+        Chỉ các blocks (theo lưới block của toàn ảnh) có hệ số sub-band đúng
+        như DWT toàn ảnh, tức là cách biên tile ít nhất độ dài filter, được nhúng.
+        
+        Args:
+            region: Vùng ảnh BGR uint8 của tile
+            origin: (hàng, cột) góc trên-trái của tile trong ảnh (bội số của 2 nếu dùng DWT)
+            image_shape: (H, W) của toàn ảnh
+            watermark_flat: Bits watermark đã xáo trộn (theo thứ tự blocks)
+            num_bits: Số blocks được nhúng trong toàn ảnh
+        
+        Returns:
+            tuple (region_ycrcb, watermarked_y, bit_index, s0): YCrCb của tile, kênh Y
+            đã nhúng (float, cùng kích thước tile), chỉ số các bits đã nhúng trong
+            tile và S[0] gốc tương ứng
+        """
+        b = self.block_size
+        scale, filter_length, _ = self._tile_geometry()
+        band_h, band_w = self._band_shape(*image_shape)
+        blocks_w = band_w // b
+        
+        region_ycrcb = cv2.cvtColor(region, cv2.COLOR_BGR2YCrCb)
+        region_y = region_ycrcb[:, :, 0].astype(np.float32)
+        
+        if self.use_dwt:
+            band, details = pywt.dwt2(region_y, self.wavelet)
+        else:
+            band, details = region_y, None
+        
+        # Khoảng blocks [lo, hi) trên mỗi trục có hệ số đúng như DWT toàn ảnh
+        block_ranges = []
+        for start, size, dimension, band_dimension in zip(origin, region.shape[:2], image_shape, (band_h, band_w)):
+            exact_lo = start // scale + filter_length if start > 0 else 0
+            exact_hi = (start + size) // scale - filter_length if start + size < dimension else band_dimension
+            block_ranges.append((-(-exact_lo // b), exact_hi // b))
+        (p_lo, p_hi), (q_lo, q_hi) = block_ranges
+        p_hi = min(p_hi, -(-num_bits // max(blocks_w, 1)))
+        q_hi = min(q_hi, blocks_w)
+        
+        bit_index = np.zeros(0, dtype=np.int64)
+        s0 = np.zeros(0, dtype=np.float32)
+        if p_hi > p_lo and q_hi > q_lo:
+            rows = slice(p_lo * b - origin[0] // scale, p_hi * b - origin[0] // scale)
+            columns = slice(q_lo * b - origin[1] // scale, q_hi * b - origin[1] // scale)
+            tile_blocks = band[rows, columns].reshape(p_hi - p_lo, b, q_hi - q_lo, b).swapaxes(1, 2)
+            
+            bit_index = np.arange(p_lo, p_hi)[:, None] * blocks_w + np.arange(q_lo, q_hi)[None, :]
+            used = bit_index < num_bits
+            bit_index = bit_index[used]
+            embedded, s0 = self._embed_block_tensor(tile_blocks[used], watermark_flat[bit_index])
+            tile_blocks[used] = embedded
+            band[rows, columns] = tile_blocks.swapaxes(1, 2).reshape((p_hi - p_lo) * b, (q_hi - q_lo) * b)
+        
+        if self.use_dwt:
+            watermarked_y = pywt.idwt2((band, details), self.wavelet)[:region.shape[0], :region.shape[1]]
+        else:
+            watermarked_y = band
+        
+        return region_ycrcb, watermarked_y, bit_index, s0
+    
+    def _tile_bgr(self, region_ycrcb, watermarked_y, written):
+        """Ghép kênh Y đã nhúng (clip, uint8) với Cr / Cb và chuyển về BGR trên vùng written"""
+        tile_ycrcb = region_ycrcb[written].copy()
+        tile_ycrcb[:, :, 0] = np.clip(watermarked_y[written], 0, 255).astype(np.uint8)
+        return cv2.cvtColor(tile_ycrcb, cv2.COLOR_YCrCb2BGR)
+    
+    def embed_tiled(self, host_image_path, watermark_image_path, output_path, tile_size=2048, with_reference=False):
+        """
+        Nhúng watermark theo tiles cho ảnh rất lớn (bộ nhớ không phụ thuộc kích thước ảnh)
+        
+        Các blocks chứa watermark chỉ nằm ở dải hàng đầu của sub-band nên chỉ
+        các tiles của dải ảnh tương ứng đi qua YCrCb -> DWT -> DCT-SVD -> IDWT.
+        Mỗi tile thẳng hàng với lưới DWT / block 8x8 và được lấy dư 1 lề (bội
+        số block size, lớn hơn độ dài filter) để DWT / IDWT trên tile cho đúng
+        giá trị như trên toàn ảnh. Phần còn lại của ảnh được copy nguyên vẹn
+        theo từng tile. Ảnh nguồn / đích được memory-map nếu định dạng cho
+        phép (.npy, TIFF không nén).
+        
+        Khác embed: pixels ngoài dải watermark giữ nguyên (không qua YCrCb),
+        ảnh kích thước lẻ được cắt thay vì resize sau IDWT.
+        
+        Args:
+            host_image_path, watermark_image_path, output_path, with_reference: Như embed
+            tile_size: Chiều rộng tile / kích thước tile khi copy (pixels)
+        
+        Returns:
+            dict: Như embed, thêm 'tiled', 'tile_size', 'tiles_watermarked'
+        """
+        host = open_image_memmap(host_image_path)
+        watermark = cv2.imread(watermark_image_path)
+        
+        if host is None or watermark is None:
+            raise ValueError("Cannot read images")
+        
+        height, width = host.shape[:2]
+        b = self.block_size
+        band_h, band_w = self._band_shape(height, width)
+        blocks_w = band_w // b
+        
+        watermark_size = self._watermark_size(band_h, band_w)
+        watermark_flat = self._prepare_watermark(watermark, watermark_size).flatten()
+        num_bits = min(len(watermark_flat), (band_h // b) * blocks_w)
+        band_rows = -(-num_bits // max(blocks_w, 1)) * b
+        
+        scale, filter_length, margin = self._tile_geometry()
+        
+        # Dải ảnh bị thay đổi [0, strip_rows) và dải được biến đổi (kèm lề) [0, region_rows)
+        strip_rows = min(height, scale * band_rows + 2 * filter_length) if num_bits else 0
+        region_rows = min(height, scale * (band_rows + margin))
+        tile_band = max(b, (tile_size // scale) // b * b)
+        
+        output, finalize = create_image_memmap(output_path, host.shape)
+        original_s0 = np.zeros(num_bits, dtype=np.float32)
+        squared_error = 0.0
+        ssim_weighted = 0.0
+        tiles = 0
+        
+        for c0 in range(0, band_w if strip_rows else 0, tile_band):
+            c1 = min(band_w, c0 + tile_band)
+            
+            # Cột ảnh được ghi [x0, x1) và cột ảnh được biến đổi [rx0, rx1)
+            x0, x1 = scale * c0, (width if c1 == band_w else scale * c1)
+            rx0 = max(0, scale * (c0 - margin))
+            rx1 = width if c1 + margin >= band_w else scale * (c1 + margin)
+            
+            region = np.ascontiguousarray(host[:region_rows, rx0:rx1])
+            region_ycrcb, watermarked_y, bit_index, s0 = self._embed_tile(
+                region, (0, rx0), (height, width), watermark_flat, num_bits
+            )
+            original_s0[bit_index] = s0
+            
+            # Chỉ ghi phần tile của dải bị thay đổi
+            written = (slice(0, strip_rows), slice(x0 - rx0, x1 - rx0))
+            tile_bgr = self._tile_bgr(region_ycrcb, watermarked_y, written)
+            output[:strip_rows, x0:x1] = tile_bgr
+            
+            tile_original = region[written]
+            squared_error += float(np.sum((tile_original.astype(np.float64) - tile_bgr) ** 2))
+            if 'ssim' in self.metrics and min(tile_bgr.shape[:2]) >= 7:
+                tile_ssim = calculate_ssim(tile_original, tile_bgr, fast=self.fast_ssim)
+                ssim_weighted += (tile_ssim - 1) * tile_bgr.shape[0] * tile_bgr.shape[1]
+            tiles += 1
+        
+        # Copy nguyên vẹn phần ảnh không chứa watermark theo từng tile (bộ nhớ không phụ thuộc chiều rộng ảnh)
+        for y0 in range(strip_rows, height, tile_size):
+            for x0 in range(0, width, tile_size):
+                output[y0:y0 + tile_size, x0:x0 + tile_size] = host[y0:y0 + tile_size, x0:x0 + tile_size]
+        finalize()
+        
+        # Quality metrics: phần ảnh ngoài dải không đổi (MSE = 0, SSIM = 1)
+        mse = squared_error / host.size
+        psnr = _psnr_from_mse(mse)
+        ssim_val = 1 + ssim_weighted / (height * width)
+        
+        result = self._embed_result(watermark_size, num_bits, psnr, ssim_val, mse)
+        result.update({'tiled': True, 'tile_size': tile_size, 'tiles_watermarked': tiles})
+        
+        if with_reference:
+            result['reference'] = self._make_reference(
+                watermark_size, (height, width), original_s0, num_bits == len(watermark_flat)
+            )
+        
+        return result
+    
+    def _supports_reduced_decode(self):
+        """LL của Haar là trung bình khối 2x2 (x2): trích xuất được từ ảnh decode 1/2 độ phân giải"""
+        return self.use_dwt and self.wavelet in ('haar', 'db1')
+    
+    def open_extraction_image(self, source, reduced_decode=False):
+        """
+        Mở ảnh để trích xuất (kết quả dùng cho extract_array)
+        
+        Decode 1/2 độ phân giải nếu reduced_decode và wavelet cho phép, nếu
+        không thì memory-mapped / đầy đủ. Kết quả luôn có .shape là kích thước
+        gốc (H, W, 3) để kiểm tra kích thước trước khi trích xuất.
+        
+        Args:
+            source: Đường dẫn, bytes của file ảnh hoặc mảng đã decode (trả nguyên)
+            reduced_decode: Như extract
+        """
+        if isinstance(source, np.ndarray):
+            return source
+        
+        if reduced_decode and self._supports_reduced_decode():
+            reduced = read_luma_reduced(source)
+            if reduced is not None:
+                return _ReducedLuma(*reduced)
+        
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            return decode_image(source)
+        
+        image = open_image_memmap(source)
+        if image is None:
+            raise ValueError("Cannot read images")
+        return image
+    
+    def _check_reference(self, reference, shape):
+        """Kiểm tra cấu hình và kích thước ảnh khớp với bản ghi tham chiếu"""
+        settings = (self.block_size, self.use_dwt, self.wavelet if self.use_dwt else None, self.arnold_iterations)
+        expected = (reference.block_size, reference.use_dwt, reference.wavelet, reference.arnold_iterations)
+        if settings != expected:
+            raise ValueError("Watermark settings do not match the reference (use reference.watermarker())")
+        if shape[:2] != (reference.height, reference.width):
+            raise ValueError(
+                f"Image size {shape[1]}x{shape[0]} does not match the reference ({reference.width}x{reference.height})"
+            )
+    
+    def extract(self, watermarked_image_path, original_image_path=None, watermark_size=None, return_confidence=False,
+                reference=None, frame_number=0, reduced_decode=False):
         """
         Trích xuất watermark từ ảnh đã nhúng
         
         Args:
             watermarked_image_path: Đường dẫn ảnh đã watermark
-            original_image_path: Đường dẫn ảnh gốc (cần để so sánh)
-            watermark_size: Kích thước watermark (phải biết trước)
+            original_image_path: Đường dẫn ảnh gốc (cần để so sánh, nếu không có reference)
+            watermark_size: Kích thước watermark (phải biết trước, nếu không có reference)
+            return_confidence: Trả thêm soft confidence của từng bit
+            reference: WatermarkReference thay cho ảnh gốc (S[0] gốc đã lưu lúc nhúng)
+            frame_number: Frame trong reference (video), ảnh tĩnh là 0
+            reduced_decode: Decode thẳng ảnh grayscale 1/2 độ phân giải (chỉ Haar,
+                ảnh kích thước chẵn; trường hợp khác dùng cách đọc thông thường).
+                Không giống hệt decode đầy đủ: ảnh 1/2 bị làm tròn uint8 (LL lệch
+                tới 1 mức) nên các bits có S[0] sát ngưỡng quyết định có thể đảo.
+                Với ảnh gốc / reference (so sánh tỉ lệ S[0]) thường không bit nào
+                đổi; trích xuất mù QIM đảo vài bits (đo được 1-18 bits, < 0.5% số
+                bits), NC lệch <= REDUCED_DECODE_NC_TOLERANCE so với decode đầy đủ.
+                Khi tấn công mạnh (NC gần mức ngẫu nhiên) không có giới hạn này.
         
         Returns:
             numpy array: Watermark đã trích xuất
+            (nếu return_confidence: tuple (watermark, ratios) với ratios là
+            ma trận S0_wm / S0_orig float32 cùng vị trí với watermark)
         """
-        # Đọc ảnh
-        watermarked = cv2.imread(watermarked_image_path)
-        original = cv2.imread(original_image_path)
+        # Đọc ảnh (memory-mapped nếu được: chỉ dải đầu ảnh được dùng khi trích xuất;
+        # reduced_decode: LL Haar lấy thẳng từ ảnh decode 1/2 độ phân giải)
+        watermarked = self.open_extraction_image(watermarked_image_path, reduced_decode)
+        
+        original = None
+        if reference is None and original_image_path is not None:
+            original = self.open_extraction_image(original_image_path, reduced_decode)
         
-        if watermarked is None or original is None:
+        return self._extract_image(watermarked, original, watermark_size, return_confidence, reference, frame_number)
+    
+    def extract_array(self, watermarked, original=None, watermark_size=None, return_confidence=False,
+                      reference=None, frame_number=0):
+        """
+        Trích xuất watermark từ ảnh đã decode, hoàn toàn trong bộ nhớ
+        
+        Args:
+            watermarked: Ảnh đã watermark BGR uint8 (hoặc kết quả của open_extraction_image)
+            original: Ảnh gốc BGR uint8 (cần nếu không có reference), như watermarked
+            watermark_size, return_confidence, reference, frame_number: Như extract
+        
+        Returns:
+            Như extract
+        """
+        if watermarked is None:
             raise ValueError("Cannot read images")
         
-        # Chuyển sang kênh Y
-        watermarked_y = cv2.cvtColor(watermarked, cv2.COLOR_BGR2YCrCb)[:, :, 0].astype(np.float32)
-        original_y = cv2.cvtColor(original, cv2.COLOR_BGR2YCrCb)[:, :, 0].astype(np.float32)
+        return self._extract_image(watermarked, original, watermark_size, return_confidence, reference, frame_number)
+    
+    def extract_bytes(self, watermarked_data, original_data=None, watermark_size=None, return_confidence=False,
+                      reference=None, frame_number=0, reduced_decode=False):
+        """
+        Trích xuất watermark từ ảnh đã mã hóa (bytes của file upload), không qua file tạm
         
-        # DWT Layer (CHUẨN HỌC THUẬT)
-        if self.use_dwt:
-            coeffs_wm = pywt.dwt2(watermarked_y, self.wavelet)
-            coeffs_orig = pywt.dwt2(original_y, self.wavelet)
-            LL_wm, (LH_wm, HL_wm, HH_wm) = coeffs_wm
-            LL_orig, (LH_orig, HL_orig, HH_orig) = coeffs_orig
-            selected_band_wm = LL_wm
-            selected_band_orig = LL_orig
+        Args:
+            watermarked_data: Bytes ảnh đã watermark
+            original_data: Bytes ảnh gốc (cần nếu không có reference)
+            watermark_size, return_confidence, reference, frame_number, reduced_decode: Như extract
+                (reduced_decode decode thẳng từ bytes ở 1/2 độ phân giải)
+        
+        Returns:
+            Như extract
+        """
+        return self.extract(watermarked_data, original_data, watermark_size, return_confidence,
+                            reference, frame_number, reduced_decode)
+    
+    def _extract_image(self, watermarked, original=None, watermark_size=None, return_confidence=False,
+                       reference=None, frame_number=0):
+        """Trích xuất watermark từ ảnh đã decode (tham số giống extract)"""
+        if reference is not None:
+            # S[0] gốc lấy từ bản ghi tham chiếu, không cần decode ảnh gốc
+            self._check_reference(reference, watermarked.shape)
+            watermark_size = reference.watermark_size
+            original_s0 = reference.original_s0(frame_number)
         else:
-            selected_band_wm = watermarked_y
-            selected_band_orig = original_y
-        
-        h, w = selected_band_wm.shape
-        
-        # Trích xuất watermark bits
-        extracted_bits = []
-        
-        for i in range(0, h - self.block_size + 1, self.block_size):
-            for j in range(0, w - self.block_size + 1, self.block_size):
-                if len(extracted_bits) >= watermark_size * watermark_size:
-                    break
-                
-                # DCT của cả 2 blocks
-                watermarked_block = selected_band_wm[i:i+self.block_size, j:j+self.block_size]
-                original_block = selected_band_orig[i:i+self.block_size, j:j+self.block_size]
-                
-                dct_watermarked = self._dct2(watermarked_block)
-                dct_original = self._dct2(original_block)
-                
-                # SVD Extraction (CHUẨN HỌC THUẬT)
-                bit = self._extract_svd(dct_watermarked, dct_original)
-                extracted_bits.append(bit)
+            if original is None or watermark_size is None:
+                raise ValueError("Original image and watermark size are required without a reference")
             
-            if len(extracted_bits) >= watermark_size * watermark_size:
-                break
+            # Kênh Y + DWT Layer (CHUẨN HỌC THUẬT), chỉ trên dải chứa các blocks đã nhúng
+            original_s0 = self._block_s0(self._extraction_band(original, watermark_size ** 2), watermark_size ** 2)
         
-        # Reshape thành ảnh
-        extracted_watermark = np.array(extracted_bits[:watermark_size * watermark_size])
-        extracted_watermark = extracted_watermark.reshape(watermark_size, watermark_size)
+        # SVD Extraction (CHUẨN HỌC THUẬT): so sánh S0 của từng cặp blocks
+        selected_band_wm = self._extraction_band(watermarked, len(original_s0))
+        ratios = self._extract_ratios(selected_band_wm, original_s0)
+        
+        return self._descramble(ratios > 1, ratios, watermark_size, return_confidence)
+    
+    def _descramble(self, bits, soft, watermark_size, return_confidence=False):
+        """
+        Ghép bits thành ảnh watermark và giải xáo trộn Arnold
+        
+        Args:
+            bits: Mảng bits đã trích xuất (theo thứ tự blocks)
+            soft: Soft confidence tương ứng của từng bit
+        """
+        # Reshape thành ảnh (bits và soft confidence xếp chồng để giải xáo trộn 1 lần)
+        stacked = np.stack([bits.astype(np.float32), soft.astype(np.float32)], axis=-1)
+        stacked = stacked.reshape(watermark_size, watermark_size, 2)
         
         # Inverse Arnold Cat Map
-        extracted_watermark = inverse_arnold_cat_map(extracted_watermark, self.arnold_iterations)
+        stacked = inverse_arnold_cat_map(stacked, self.arnold_iterations)
         
         # Scale về 0-255 để hiển thị
-        extracted_watermark = (extracted_watermark * 255).astype(np.uint8)
+        extracted_watermark = (stacked[:, :, 0] * 255).astype(np.uint8)
+        
+        if return_confidence:
+            return extracted_watermark, stacked[:, :, 1]
         
         return extracted_watermark
+
+
+class DWT_DCT_SVD_QIM_Watermark(DWT_DCT_SVD_Watermark):
+    """
+    Thủy vân DWT-DCT-SVD mù (blind) bằng Quantization Index Modulation
+    
+    Thay vì S'[0] = S[0] * (1 ± alpha) (cần S[0] gốc khi trích xuất), S[0]
+    được lượng tử hóa về 1 trong 2 lưới xen kẽ bước delta:
+    - Bit 0: S'[0] = delta * round(S[0] / delta)
+    - Bit 1: S'[0] = delta * round((S[0] - delta/2) / delta) + delta/2
+    Khi trích xuất, bit là lưới gần S[0] nhất, nên chỉ cần ảnh đã watermark
+    (1 lần decode, 1 lần transform). Thay đổi tối đa của S[0] là delta/2.
+    """
+    
+    BLIND = True
+    
+    def __init__(self, block_size=8, quantization_step=120.0, arnold_iterations=10, use_dwt=True, wavelet='haar',
+                 metrics=QUALITY_METRICS, fast_ssim=False):
+        """
+        Args:
+            block_size: Kích thước block cho DCT (8x8 chuẩn JPEG)
+            quantization_step: Bước lượng tử delta của S[0] (càng lớn càng bền nhưng càng rõ)
+            arnold_iterations: Số lần xáo trộn Arnold Cat Map
+            use_dwt: Sử dụng DWT layer (True = DWT-DCT-SVD, False = DCT-SVD)
+            wavelet: Loại wavelet ('haar', 'db1', 'db2', etc.)
+            metrics, fast_ssim: Quality metrics sau khi nhúng (xem DWT_DCT_SVD_Watermark)
+        """
+        if quantization_step <= 0:
+            raise ValueError("quantization_step must be positive")
+        
+        super().__init__(block_size=block_size, alpha=None, arnold_iterations=arnold_iterations,
+                         use_dwt=use_dwt, wavelet=wavelet, metrics=metrics, fast_ssim=fast_ssim)
+        self.quantization_step = quantization_step
+    
+    def _modulate(self, s0, watermark_bits):
+        """Lượng tử hóa S[0] về lưới của bit (QIM)"""
+        step = np.float32(self.quantization_step)
+        offset = np.where(watermark_bits == 1, step / 2, 0).astype(np.float32)
+        return np.round((s0 - offset) / step) * step + offset
+    
+    def _algorithm_name(self):
+        """Tên thuật toán trong kết quả"""
+        return super()._algorithm_name() + '-QIM'
+    
+    def _embed_result(self, watermark_size, blocks_used, psnr, ssim_val, mse):
+        """Dict thông tin nhúng (xem DWT_DCT_SVD_Watermark._embed_result), kèm bước lượng tử"""
+        result = super()._embed_result(watermark_size, blocks_used, psnr, ssim_val, mse)
+        result['quantization_step'] = self.quantization_step
+        return result
+    
+    def _extract_image(self, watermarked, original=None, watermark_size=None, return_confidence=False,
+                       reference=None, frame_number=0):
+        """
+        Trích xuất mù: chỉ dùng ảnh đã watermark (original / reference bỏ qua)
+        
+        Soft confidence của từng bit trong [0, 1]: 1 = S[0] nằm đúng trên lưới
+        của bit, 0 = nằm trên biên quyết định giữa 2 lưới.
+        """
+        if watermark_size is None:
+            # Kích thước watermark suy ra từ kích thước ảnh giống lúc nhúng
+            watermark_size = self._watermark_size(*self._band_shape(*watermarked.shape[:2]))
+        
+        num_bits = watermark_size * watermark_size
+        s0 = self._block_s0(self._extraction_band(watermarked, num_bits), num_bits)
+        
+        # Vị trí của S[0] trong 1 bước lượng tử: lưới bit 0 ở 0, lưới bit 1 ở 0.5
+        fraction = np.mod(s0 / np.float32(self.quantization_step), 1)
+        distance_0 = np.minimum(fraction, 1 - fraction)
+        distance_1 = np.abs(fraction - 0.5)
+        
+        confidence = 2 * np.abs(distance_0 - distance_1)
+        return self._descramble(distance_1 < distance_0, confidence, watermark_size, return_confidence)
+
+
+def compare_watermark_modes(host_image_path, watermark_image_path, alpha=0.1, quantization_step=120.0,
+                            arnold_iterations=10, jpeg_quality=50):
+    """
+    So sánh chất lượng (PSNR / SSIM) và độ bền (NC) của 2 mode trên cùng ảnh
+    
+    Nhúng thử (trong bộ nhớ, không ghi file) bằng DWT-DCT-SVD (so sánh với
+    ảnh gốc) và DWT-DCT-SVD-QIM (mù), rồi trích xuất lại từ ảnh sạch và từ
+    ảnh đã nén JPEG.
+    
+    Args:
+        host_image_path, watermark_image_path: Đường dẫn, bytes của file ảnh hoặc ảnh đã decode
+    
+    Returns:
+        list[dict]: Mỗi phần tử gồm algorithm, blind, psnr, ssim, nc, nc_jpeg
+    """
+    host = load_image(host_image_path)
+    watermark = load_image(watermark_image_path)
+    if host is None or watermark is None:
+        raise ValueError("Cannot read images")
+    
+    watermark_gray = cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY) if len(watermark.shape) == 3 else watermark
+    
+    report = []
+    for watermarker in (
+        DWT_DCT_SVD_Watermark(alpha=alpha, arnold_iterations=arnold_iterations),
+        DWT_DCT_SVD_QIM_Watermark(quantization_step=quantization_step, arnold_iterations=arnold_iterations),
+    ):
+        watermarked, result = watermarker._embed_image(host.copy(), watermark)
+        watermark_size = int(result['watermark_size'].split('x')[0])
+        expected = watermarker._binary_watermark(watermark_gray, watermark_size) * 255
+        attacked = apply_attack(watermarked, 'jpeg_compression', quality=jpeg_quality)
+        
+        report.append({
+            'algorithm': result['algorithm'],
+            'blind': watermarker.BLIND,
+            'psnr': result['quality_metrics']['psnr'],
+            'ssim': result['quality_metrics']['ssim'],
+            'nc': float(calculate_nc(expected, watermarker._extract_image(watermarked, host, watermark_size))),
+            'nc_jpeg': float(calculate_nc(expected, watermarker._extract_image(attacked, host, watermark_size))),
+            'jpeg_quality': jpeg_quality
+        })
+    
+    return report
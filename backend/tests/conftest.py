@@ -0,0 +1,43 @@
+"""
+Fixtures chung cho tests của backend (ảnh tổng hợp, không cần file mẫu)
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Bản ghi tham chiếu cần khóa ký cố định (xem DEPLOY.md)
+os.environ.setdefault('WATERMARK_REFERENCE_KEY', 'test-reference-key')
+
+
+def make_host(height, width, seed=0):
+    """Ảnh host BGR uint8 có cấu trúc (gradient + nhiễu mịn), giống ảnh tự nhiên hơn nhiễu trắng"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    base = 128 + 60 * np.sin(x / 37.0) * np.cos(y / 23.0)
+    channels = [base + offset + rng.normal(0, 12, (height, width)) for offset in (-20, 0, 20)]
+    return np.clip(np.stack(channels, axis=2), 0, 255).astype(np.uint8)
+
+
+@pytest.fixture
+def host():
+    """Ảnh host 256x320"""
+    return make_host(256, 320)
+
+
+@pytest.fixture
+def host_factory():
+    """Tạo ảnh host kích thước tùy ý: host_factory(height, width, seed=0)"""
+    return make_host
+
+
+@pytest.fixture
+def watermark():
+    """Ảnh watermark BGR 64x64 (hình tròn và sọc)"""
+    y, x = np.mgrid[0:64, 0:64]
+    mark = (((x - 32) ** 2 + (y - 32) ** 2 < 400) ^ (x // 8 % 2 == 0)).astype(np.uint8) * 255
+    return np.repeat(mark[:, :, None], 3, axis=2)
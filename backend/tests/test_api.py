@@ -0,0 +1,163 @@
+"""
+API: /api/watermarking (embed tiled, chế độ loại trừ nhau, extract, fan-out, giới hạn workers)
+và capacity preflight của /api/steganography
+"""
+
+import base64
+import io
+import json
+import os
+import tempfile
+import zipfile
+
+import cv2
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+from app.api.watermarking import _cap_workers
+from app.core.utils import encode_image
+from app.main import app
+
+
+@pytest.fixture(scope='module')
+def client():
+    return TestClient(app)
+
+
+def _last_event(response):
+    """Sự kiện SSE cuối cùng (complete / error)"""
+    events = [json.loads(line[6:]) for line in response.text.splitlines() if line.startswith('data: ')]
+    return events[-1]
+
+
+def _decode_data_url(url):
+    """(mime type, bytes) của data URL base64"""
+    head, data = url.split(',', 1)
+    return head[5:].split(';')[0], base64.b64decode(data)
+
+
+def _embed(client, host_name, host_data, watermark, **form):
+    response = client.post('/api/watermarking/embed', data=form, files={
+        'host_image': (host_name, host_data),
+        'watermark_image': ('watermark.png', encode_image(watermark, '.png')),
+    })
+    return _last_event(response)
+
+
+def test_tiled_embed_streams_memory_mapped_npy(client, host, watermark):
+    buffer = io.BytesIO()
+    np.save(buffer, host)
+    event = _embed(client, 'host.npy', buffer.getvalue(), watermark, tiled='true')
+    
+    assert event['stage'] == 'complete'
+    result = event['result']
+    assert result['tiled'] and result['memory_mapped'] and 'warning' not in result
+    mime_type, data = _decode_data_url(result['watermarked_image'])
+    assert mime_type == 'application/octet-stream'
+    watermarked = np.load(io.BytesIO(data))
+    assert watermarked.shape == host.shape and not np.array_equal(watermarked, host)
+
+
+def test_tiled_embed_warns_when_host_cannot_be_memory_mapped(client, host, watermark):
+    event = _embed(client, 'host.png', encode_image(host, '.png'), watermark, tiled='true')
+    
+    assert event['stage'] == 'complete'
+    assert event['result']['memory_mapped'] is False and '.png' in event['result']['warning']
+    mime_type, data = _decode_data_url(event['result']['watermarked_image'])
+    assert mime_type == 'image/png'
+    assert cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR).shape == host.shape
+
+
+@pytest.mark.parametrize('host_name, host_data, form', [
+    ('host.tif', b'not an image', {'tiled': 'true'}),
+    ('host.png', None, {'tiled': 'true', 'compare_modes': 'true'}),
+])
+def test_tiled_embed_errors(client, host, watermark, host_name, host_data, form):
+    event = _embed(client, host_name, host_data or encode_image(host, '.png'), watermark, **form)
+    assert event['stage'] == 'error'
+
+
+@pytest.mark.parametrize('mode', [{'tiled': 'true'}, {'workers': '2'}])
+def test_target_quality_excludes_tiled_and_parallel(client, host, watermark, mode):
+    event = _embed(client, 'host.png', encode_image(host, '.png'), watermark, target_psnr='40', **mode)
+    assert event['stage'] == 'error' and 'target_psnr' in event['message']
+
+
+def test_target_psnr_picks_alpha(client, host, watermark):
+    event = _embed(client, 'host.png', encode_image(host, '.png'), watermark, target_psnr='40')
+    
+    assert event['stage'] == 'complete'
+    result = event['result']
+    assert result['alpha_search']['reached'] and 40.0 <= result['quality_metrics']['psnr'] <= 40.05
+
+
+def test_request_workers_are_capped_at_cpu_count(monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 4)
+    assert [_cap_workers(workers) for workers in (None, 0, 2, 64)] == [None, 1, 2, 4]
+
+
+def _extract(client, watermarked_data, watermark, files=(), **form):
+    response = client.post('/api/watermarking/extract', data=form, files={
+        'watermarked_image': ('watermarked.png', watermarked_data),
+        'original_watermark': ('watermark.png', encode_image(watermark, '.png')),
+        **dict(files),
+    })
+    return _last_event(response)
+
+
+@pytest.mark.parametrize('mode', ['original', 'reference', 'qim'])
+def test_extract_round_trip(client, host, watermark, mode):
+    algorithm = 'qim' if mode == 'qim' else 'svd'
+    embedded = _embed(client, 'host.png', encode_image(host, '.png'), watermark, algorithm=algorithm,
+                      with_reference=str(mode == 'reference').lower())
+    assert embedded['stage'] == 'complete'
+    result = embedded['result']
+    _, watermarked_data = _decode_data_url(result['watermarked_image'])
+    size = int(result['watermark_size'].split('x')[0])
+    
+    if mode == 'original':
+        files = {'original_image': ('host.png', encode_image(host, '.png'))}
+    elif mode == 'reference':
+        files = {'reference': ('reference.wmrf', _decode_data_url(result['reference'])[1])}
+    else:
+        files = {}
+    event = _extract(client, watermarked_data, watermark, files, algorithm=algorithm, watermark_size=str(size))
+    
+    assert event['stage'] == 'complete'
+    assert event['result']['size'] == size and event['result']['nc'] > 0.95
+    assert event['result']['confidence']['weak_bits'] < size * size // 20
+
+
+def test_extract_requires_original_or_reference(client, host, watermark):
+    event = _extract(client, encode_image(host, '.png'), watermark)
+    assert event['stage'] == 'error'
+
+
+def test_capacity_preflight_reads_upload_in_memory(client, host, monkeypatch):
+    # Không ghi file tạm: upload được đọc thẳng từ bộ nhớ
+    monkeypatch.setattr(tempfile, 'mkdtemp', None)
+    response = client.post('/api/steganography/capacity', data={'payload_bytes': '1000', 'measure_psnr': 'true'},
+                           files={'cover_image': ('cover.png', encode_image(host, '.png'))})
+    
+    assert response.status_code == 200
+    report = response.json()
+    assert (report['width'], report['height']) == (320, 256) and report['adaptive'] is not None
+    assert [entry['bits_per_channel'] for entry in report['measured']] == [1, 2, 3, 4]
+    
+    response = client.post('/api/steganography/capacity', files={'cover_image': ('cover.png', b'not an image')})
+    assert response.status_code == 400
+
+
+def test_fanout_zip_names_come_from_sanitized_filenames(client, host, watermark):
+    data = encode_image(watermark, '.png')
+    response = client.post('/api/watermarking/fanout', files=[
+        ('host_image', ('host.png', encode_image(host, '.png'))),
+        ('watermark_images', ('../alice.png', data)),
+        ('watermark_images', ('bob smith.png', data)),
+        ('watermark_images', ('alice.png', data)),
+    ])
+    
+    assert response.status_code == 200
+    names = zipfile.ZipFile(io.BytesIO(response.content)).namelist()
+    assert names == ['alice.png', 'bob_smith.png', 'alice_002.png', 'manifest.json']
@@ -0,0 +1,91 @@
+"""
+FingerprintFanout: nhiều watermark trên 1 ảnh gốc từ phân rã đã cache
+"""
+
+import io
+import json
+import zipfile
+
+import cv2
+import numpy as np
+import pytest
+
+from app.core.fingerprinting import FingerprintFanout
+from app.core.reference import WatermarkReference
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark
+
+
+@pytest.fixture
+def recipients(host_factory):
+    """3 watermark khác nhau (ảnh có cấu trúc, resize về kích thước watermark)"""
+    return [(f"user{seed}", host_factory(64, 64, seed=seed + 10)) for seed in range(3)]
+
+
+@pytest.mark.parametrize('watermarker_class, settings', [
+    (DWT_DCT_SVD_Watermark, {}),
+    (DWT_DCT_SVD_Watermark, {'wavelet': 'db2'}),
+    (DWT_DCT_SVD_Watermark, {'use_dwt': False}),
+    (DWT_DCT_SVD_QIM_Watermark, {}),
+])
+def test_fanout_embed_matches_embed_array(host, recipients, watermarker_class, settings):
+    fanout = FingerprintFanout(host, watermarker_class(**settings))
+    for _, watermark in recipients:
+        expected, expected_result = watermarker_class(**settings).embed_array(host, watermark)
+        watermarked, result = fanout.embed(watermark)
+        
+        assert np.array_equal(watermarked, expected)
+        assert result['quality_metrics'] == pytest.approx(expected_result['quality_metrics'])
+
+
+def test_fanout_zip_contains_each_recipient_and_shared_reference(host, recipients):
+    fanout = FingerprintFanout(host)
+    archive = zipfile.ZipFile(io.BytesIO(b''.join(fanout.stream_zip(recipients, include_reference=True))))
+    
+    assert sorted(archive.namelist()) == ['manifest.json', 'reference.wmrf', 'user0.png', 'user1.png', 'user2.png']
+    assert sorted(json.loads(archive.read('manifest.json'))) == ['user0', 'user1', 'user2']
+    
+    reference = WatermarkReference.from_bytes(archive.read('reference.wmrf'))
+    watermarker = reference.watermarker()
+    for recipient_id, watermark in recipients:
+        image = cv2.imdecode(np.frombuffer(archive.read(f"{recipient_id}.png"), np.uint8), cv2.IMREAD_COLOR)
+        assert np.array_equal(image, fanout.embed(watermark)[0])
+        # Bản ghi tham chiếu dùng chung trích xuất được watermark của từng người nhận
+        assert np.array_equal(watermarker.extract_array(image, reference=reference),
+                              watermarker.extract_array(image, host, watermark_size=reference.watermark_size))
+
+
+@pytest.mark.parametrize('target, metric, tolerance', [
+    ({'target_psnr': 40.0}, 'psnr', 0.05),
+    ({'target_ssim': 0.98}, 'ssim', 1e-4),
+])
+def test_search_alpha_reaches_target(host, watermark, target, metric, tolerance):
+    watermarked, result = FingerprintFanout(host).search_alpha(watermark, **target)
+    value = next(iter(target.values()))
+    
+    assert result['alpha_search']['reached']
+    assert value <= result['quality_metrics'][metric] <= value + tolerance
+    # Ảnh kết quả giống hệt nhúng thường với alpha đã chọn
+    expected, _ = DWT_DCT_SVD_Watermark(alpha=result['alpha']).embed_array(host, watermark)
+    assert np.array_equal(watermarked, expected)
+
+
+def test_search_alpha_reports_unreachable_target_and_rejects_qim(host, watermark):
+    _, result = FingerprintFanout(host).search_alpha(watermark, target_psnr=90.0)
+    assert not result['alpha_search']['reached'] and result['alpha'] == 0.001
+    
+    with pytest.raises(ValueError, match="QIM"):
+        FingerprintFanout(host, DWT_DCT_SVD_QIM_Watermark()).search_alpha(watermark, target_psnr=40.0)
+    with pytest.raises(ValueError, match="Exactly one"):
+        FingerprintFanout(host).search_alpha(watermark, target_psnr=40.0, target_ssim=0.98)
+
+
+def test_write_directory_keeps_files_inside_output_dir(host, watermark, tmp_path):
+    output_dir = tmp_path / 'out'
+    recipients = [('../escape', watermark), ('a/b', watermark), ('a_b', watermark), ('', watermark)]
+    manifest = FingerprintFanout(host).write_directory(recipients, str(output_dir))
+    
+    assert sorted(path.name for path in output_dir.iterdir()) == \
+        ['___escape.png', 'a_b.png', 'a_b_002.png', 'manifest.json', 'recipient_003.png']
+    assert not (tmp_path / 'escape.png').exists()
+    assert [manifest[recipient_id]['file'] for recipient_id, _ in recipients] == \
+        ['___escape.png', 'a_b.png', 'a_b_002.png', 'recipient_003.png']
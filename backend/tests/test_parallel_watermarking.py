@@ -0,0 +1,44 @@
+"""
+ParallelWatermark: nhúng song song theo dải hàng block, giống hệt embed_frame
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from app.core.parallel_watermarking import ParallelWatermark
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark
+
+
+@pytest.mark.parametrize('workers', [1, 3])
+@pytest.mark.parametrize('watermarker_class, settings, shape', [
+    (DWT_DCT_SVD_Watermark, {}, (480, 640)),
+    (DWT_DCT_SVD_Watermark, {'wavelet': 'db2'}, (384, 512)),
+    (DWT_DCT_SVD_Watermark, {'use_dwt': False}, (300, 400)),
+    (DWT_DCT_SVD_QIM_Watermark, {}, (480, 640)),
+])
+def test_parallel_embed_matches_embed_frame(host_factory, watermark, workers, watermarker_class, settings, shape):
+    host = host_factory(*shape)
+    watermarker = watermarker_class(**settings)
+    frame, original_s0, quality = watermarker.embed_frame(host, watermarker.plan_frames(watermark, *shape), True)
+    
+    parallel = ParallelWatermark(watermarker_class(**settings), max_workers=workers)
+    watermarked, result = parallel.embed_array(host, watermark, with_reference=True)
+    
+    assert np.array_equal(watermarked, frame)
+    # QIM trích xuất mù: không có bản ghi tham chiếu
+    if result['reference'] is not None:
+        np.testing.assert_allclose(result['reference'].original_s0(0), original_s0, rtol=1e-6)
+    assert result['quality_metrics']['psnr'] == pytest.approx(quality['psnr'])
+    assert result['quality_metrics']['ssim'] == pytest.approx(quality['ssim'], abs=1e-6)
+    assert result['workers'] == min(workers, os.cpu_count() or 1)
+
+
+def test_parallel_embed_odd_size_falls_back_to_embed_array(host_factory, watermark):
+    host = host_factory(301, 401)
+    expected, _ = DWT_DCT_SVD_Watermark().embed_array(host, watermark)
+    
+    watermarked, result = ParallelWatermark(max_workers=3).embed_array(host, watermark)
+    assert np.array_equal(watermarked, expected)
+    assert (result['workers'], result['row_bands']) == (1, 1)
@@ -0,0 +1,52 @@
+"""
+Trích xuất với reduced_decode (ảnh decode 1/2 độ phân giải) so với decode đầy đủ
+"""
+
+import cv2
+import pytest
+
+from app.core.utils import apply_attack, calculate_nc, encode_image
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark, REDUCED_DECODE_NC_TOLERANCE, \
+    _ReducedLuma
+
+
+def _expected(watermarker, watermark, size):
+    """Watermark nhị phân mong đợi (0 / 255)"""
+    return watermarker._binary_watermark(cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY), size) * 255
+
+
+@pytest.mark.parametrize('attack', [None, ('jpeg_compression', {'quality': 50}), ('gaussian_blur', {})])
+@pytest.mark.parametrize('image_format', ['.png', '.jpg'])
+def test_qim_reduced_decode_nc_parity(host, watermark, attack, image_format):
+    watermarker = DWT_DCT_SVD_QIM_Watermark()
+    watermarked, result = watermarker.embed_array(host, watermark)
+    if attack is not None:
+        watermarked = apply_attack(watermarked, attack[0], **attack[1])
+    data = encode_image(watermarked, image_format)
+    size = int(result['watermark_size'].split('x')[0])
+    
+    assert isinstance(watermarker.open_extraction_image(data, reduced_decode=True), _ReducedLuma)
+    full = watermarker.extract_bytes(data, watermark_size=size)
+    reduced = watermarker.extract_bytes(data, watermark_size=size, reduced_decode=True)
+    
+    expected = _expected(watermarker, watermark, size)
+    assert abs(calculate_nc(expected, full) - calculate_nc(expected, reduced)) <= REDUCED_DECODE_NC_TOLERANCE
+
+
+def test_svd_reduced_decode_with_reference(host, watermark):
+    watermarker = DWT_DCT_SVD_Watermark()
+    watermarked, result = watermarker.embed_array(host, watermark, with_reference=True)
+    reference = result['reference']
+    data = encode_image(apply_attack(watermarked, 'jpeg_compression', quality=50), '.jpg')
+    
+    full = watermarker.extract_bytes(data, reference=reference)
+    reduced = watermarker.extract_bytes(data, reference=reference, reduced_decode=True)
+    
+    expected = _expected(watermarker, watermark, reference.watermark_size)
+    assert abs(calculate_nc(expected, full) - calculate_nc(expected, reduced)) <= REDUCED_DECODE_NC_TOLERANCE
+
+
+def test_reduced_decode_falls_back_for_odd_size(host_factory):
+    watermarker = DWT_DCT_SVD_Watermark()
+    data = encode_image(host_factory(255, 320), '.png')
+    assert not isinstance(watermarker.open_extraction_image(data, reduced_decode=True), _ReducedLuma)
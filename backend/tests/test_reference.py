@@ -0,0 +1,56 @@
+"""
+WatermarkReference: bản ghi S[0] gốc có chữ ký HMAC thay cho ảnh gốc khi trích xuất
+"""
+
+import numpy as np
+import pytest
+
+from app.core.reference import REFERENCE_KEY_ENV, WatermarkReference
+from app.core.watermarking import DWT_DCT_SVD_Watermark
+
+
+@pytest.fixture
+def embedded(host, watermark):
+    """(ảnh đã watermark, bản ghi tham chiếu, kích thước watermark)"""
+    watermarked, result = DWT_DCT_SVD_Watermark(alpha=0.07).embed_array(host, watermark, with_reference=True)
+    reference = result['reference']
+    return watermarked, reference, reference.watermark_size
+
+
+def test_reference_bytes_round_trip(embedded):
+    _, reference, _ = embedded
+    restored = WatermarkReference.from_bytes(reference.to_bytes())
+    
+    assert (restored.alpha, restored.watermark_size, restored.height, restored.width, restored.wavelet) == \
+        (0.07, reference.watermark_size, reference.height, reference.width, 'haar')
+    assert np.array_equal(restored.original_s0(0), reference.original_s0(0))
+
+
+def test_reference_signature_rejects_tampering_and_other_keys(embedded, monkeypatch):
+    _, reference, _ = embedded
+    data = bytearray(reference.to_bytes())
+    data[40] ^= 0x01
+    with pytest.raises(ValueError, match="signature"):
+        WatermarkReference.from_bytes(bytes(data))
+    
+    signed = reference.to_bytes()
+    monkeypatch.setenv(REFERENCE_KEY_ENV, 'another-key')
+    with pytest.raises(ValueError, match="signature"):
+        WatermarkReference.from_bytes(signed)
+
+
+def test_reference_requires_signing_key(embedded, monkeypatch):
+    _, reference, _ = embedded
+    monkeypatch.delenv(REFERENCE_KEY_ENV)
+    with pytest.raises(ValueError, match=REFERENCE_KEY_ENV):
+        reference.to_bytes()
+
+
+def test_extraction_with_reference_matches_original(host, embedded):
+    watermarked, reference, size = embedded
+    restored = WatermarkReference.from_bytes(reference.to_bytes())
+    watermarker = restored.watermarker()
+    
+    with_reference = watermarker.extract_array(watermarked, reference=restored)
+    with_original = watermarker.extract_array(watermarked, host, watermark_size=size)
+    assert np.array_equal(with_reference, with_original)
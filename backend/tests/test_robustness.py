@@ -0,0 +1,52 @@
+"""
+Robustness benchmark: lưới alpha x tấn công, song song trên process pool dùng chung
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from app.core.robustness import parse_attacks, run_robustness_benchmark
+from app.core.utils import apply_attack, calculate_nc
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark
+
+ATTACKS = {
+    'jpeg_compression': [{'quality': 50}],
+    'gaussian_noise': [{'std': 5}],
+    'rotate': [{'angle': 2}],
+}
+
+
+def test_parallel_benchmark_matches_serial(host, watermark):
+    serial = run_robustness_benchmark(host, watermark, alphas=[0.05, 0.1], attacks=ATTACKS, max_workers=1, seed=3)
+    parallel = run_robustness_benchmark(host, watermark, alphas=[0.05, 0.1], attacks=ATTACKS, max_workers=3, seed=3)
+    
+    # Tấn công ngẫu nhiên được seed theo ô: kết quả không phụ thuộc số workers
+    assert parallel['nc'] == serial['nc'] and parallel['ber'] == serial['ber']
+    assert [row['quality_metrics'] for row in parallel['rows']] == [row['quality_metrics'] for row in serial['rows']]
+    assert [column['label'] for column in serial['attacks']] == \
+        ['none', 'jpeg_compression(quality=50)', 'gaussian_noise(std=5)', 'rotate(angle=2)']
+    assert all(row[0] == 1.0 for row in serial['nc']) and all(row[0] == 0.0 for row in serial['ber'])
+
+
+def test_benchmark_cell_matches_direct_pipeline(host, watermark):
+    report = run_robustness_benchmark(host, watermark, alphas=[0.1], attacks=ATTACKS, max_workers=1)
+    
+    watermarker = DWT_DCT_SVD_Watermark(alpha=0.1)
+    watermarked, result = watermarker.embed_array(host, watermark)
+    size = int(result['watermark_size'].split('x')[0])
+    extracted = watermarker.extract_array(apply_attack(watermarked, 'jpeg_compression', quality=50), host,
+                                          watermark_size=size)
+    expected = watermarker._binary_watermark(cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY), size) * 255
+    assert report['nc'][0][1] == pytest.approx(calculate_nc(expected, extracted))
+
+
+def test_benchmark_rejects_invalid_grid(host, watermark):
+    with pytest.raises(ValueError, match="Unknown attack"):
+        parse_attacks({'blur_everything': [{}]})
+    with pytest.raises(ValueError, match="Alpha is not used"):
+        run_robustness_benchmark(host, watermark, DWT_DCT_SVD_QIM_Watermark(), alphas=[0.1], max_workers=1)
+    
+    report = run_robustness_benchmark(host, watermark, DWT_DCT_SVD_QIM_Watermark(), attacks='{"crop": [{}]}',
+                                      max_workers=1)
+    assert np.shape(report['nc']) == (1, 2) and report['rows'][0]['alpha'] is None
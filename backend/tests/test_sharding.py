@@ -0,0 +1,75 @@
+"""
+ShardedStego: chia payload ra nhiều ảnh cover và khôi phục shard bằng parity
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+from app.core import sharding, utils
+from app.core.sharding import ShardedStego
+from app.core.utils import encode_image, process_pool_size
+
+
+class _CountingExecutor(ProcessPoolExecutor):
+    """ProcessPoolExecutor đếm số pool được tạo"""
+    created = 0
+    
+    def __init__(self, *args, **kwargs):
+        type(self).created += 1
+        super().__init__(*args, **kwargs)
+
+
+@pytest.fixture
+def covers(host_factory):
+    """4 ảnh cover PNG (bytes) khác nhau"""
+    return [encode_image(host_factory(128, 160, seed=seed), '.png') for seed in range(4)]
+
+
+def test_split_join_recovers_one_missing_shard_per_group():
+    sharded = ShardedStego(parity_shards=2)
+    payload = np.random.default_rng(0).bytes(1001)
+    shards = sharded.split(payload, 6)
+    
+    assert sharded.join(shards) == payload
+    assert sharded.join([None, shards[1], shards[2], None] + shards[4:]) == payload
+    with pytest.raises(ValueError, match="cannot be recovered"):
+        sharded.join([None, shards[1], None, shards[3]] + shards[4:])
+
+
+def test_join_rejects_shards_of_different_payloads():
+    sharded = ShardedStego()
+    first, second = sharded.split("một", 2), sharded.split("hai", 2)
+    with pytest.raises(ValueError, match="different payloads"):
+        sharded.join([first[0], second[1]])
+
+
+def test_sharded_stego_round_trip_with_lost_cover(covers):
+    sharded = ShardedStego(parity_shards=1, use_pseudorandom=True, max_workers=1)
+    message = "phân mảnh " * 300
+    stego_images, result = sharded.embed_bytes(covers, message)
+    
+    assert result['data_shards'] == 3 and len(stego_images) == 4
+    # Thứ tự bất kỳ, mất 1 ảnh chứa data shard
+    assert sharded.extract(stego_images[::-1]) == message
+    assert sharded.extract([stego_images[0], stego_images[2], stego_images[3]]) == message
+
+
+def test_parallel_sharding_uses_shared_pool(covers, monkeypatch):
+    assert ShardedStego(max_workers=64).max_workers == process_pool_size()
+    
+    # Giả lập máy 4 CPU: song song trong pool dùng chung, không tạo pool mới mỗi lần gọi
+    monkeypatch.setattr(utils, 'process_pool_size', lambda: 4)
+    monkeypatch.setattr(sharding, 'process_pool_size', lambda: 4)
+    monkeypatch.setattr(utils, 'ProcessPoolExecutor', _CountingExecutor)
+    monkeypatch.setattr(utils, '_pool', None)
+    sharded = ShardedStego(parity_shards=1)
+    assert sharded.max_workers == 4
+    
+    message = "chia sẻ pool " * 200
+    for _ in range(2):
+        stego_images, _ = sharded.embed_bytes(covers, message)
+        assert sharded.extract(stego_images) == message
+    assert _CountingExecutor.created == 1
+    utils.discard_process_pool(utils.shared_process_pool())
@@ -0,0 +1,258 @@
+"""
+LSB_Stego: round trip nhúng / trích xuất và định dạng payload
+"""
+
+import zlib
+
+import cv2
+import numpy as np
+import pytest
+
+from app.core.steganography import KeyedPermutation, LSB_Stego, edge_map_cache
+from app.core.utils import decode_image
+
+
+def test_standard_lsb_round_trip_changes_only_used_lsbs(host):
+    stego = LSB_Stego()
+    stego_image, result = stego.embed_array(host, "Xin chào, thông điệp bí mật!")
+    
+    assert stego.extract_array(stego_image) == "Xin chào, thông điệp bí mật!"
+    
+    diff = stego_image.astype(np.int16) - host
+    assert np.abs(diff).max() <= 1
+    assert not diff.reshape(-1)[result['samples_used']:].any()
+    assert result['algorithm'] == 'Standard-LSB'
+
+
+def test_header_records_version_flags_length_and_crc(host):
+    stego = LSB_Stego()
+    message = "header test"
+    stego_image, result = stego.embed_array(host, message)
+    
+    header_bits = stego_image.reshape(-1)[:LSB_Stego.HEADER_BITS] & 1
+    magic, version, flags, length, crc = LSB_Stego.HEADER_STRUCT.unpack(np.packbits(header_bits).tobytes())
+    assert (magic, version) == (LSB_Stego.HEADER_MAGIC, LSB_Stego.HEADER_VERSION)
+    assert flags == 0
+    assert length == result['payload_bytes'] == len(message.encode('utf-8'))
+    assert crc == zlib.crc32(message.encode('utf-8'))
+
+
+def test_extraction_stops_after_payload_and_checks_crc(host):
+    stego = LSB_Stego()
+    stego_image, result = stego.embed_array(host, "early stop")
+    flat = stego_image.reshape(-1)
+    
+    # Bits sau payload không được đọc
+    flat[result['samples_used']:] ^= 1
+    assert stego.extract_array(stego_image) == "early stop"
+    
+    # Sai 1 bit payload -> CRC mismatch
+    flat[LSB_Stego.HEADER_BITS] ^= 1
+    with pytest.raises(ValueError, match="CRC"):
+        stego.extract_array(stego_image)
+
+
+def test_legacy_delimiter_format_still_decodes(host):
+    stego = LSB_Stego()
+    legacy = stego._text_to_binary("legacy message" + LSB_Stego.DELIMITER)
+    bits = np.array([int(bit) for bit in legacy], dtype=np.uint8)
+    stego_image = host.copy()
+    flat = stego_image.reshape(-1)
+    flat[:len(bits)] = (flat[:len(bits)] & 0xFE) | bits
+    
+    assert stego.extract_array(stego_image) == "legacy message"
+    assert stego.extract_auto_array(stego_image)['format'] == 'legacy'
+
+
+@pytest.mark.parametrize('domain_size', [1, 2, 7, 1000, 3 * 97 * 61])
+def test_keyed_permutation_is_a_bijection(domain_size):
+    permutation = KeyedPermutation(domain_size, seed=1234)
+    positions = permutation(np.arange(domain_size))
+    
+    assert np.array_equal(np.sort(positions), np.arange(domain_size))
+    start = domain_size // 3
+    assert np.array_equal(permutation.positions(start, domain_size), positions[start:])
+
+
+def test_keyed_permutation_depends_on_seed():
+    assert not np.array_equal(KeyedPermutation(5000, seed=1)(np.arange(5000)),
+                              KeyedPermutation(5000, seed=2)(np.arange(5000)))
+
+
+def test_pseudorandom_round_trip_needs_the_seed(host):
+    stego_image, _ = LSB_Stego(use_pseudorandom=True, seed=7).embed_array(host, "keyed order")
+    
+    assert LSB_Stego(use_pseudorandom=True, seed=7).extract_array(stego_image) == "keyed order"
+    with pytest.raises(ValueError):
+        LSB_Stego(use_pseudorandom=True, seed=8).extract_array(stego_image)
+
+
+def test_adaptive_round_trip_keeps_edge_map_stable(host):
+    host = host.copy()
+    host[64:192, 80:240] = 250  # vùng edge
+    stego = LSB_Stego(use_adaptive=True)
+    message = "adaptive " * 200
+    stego_image, result = stego.embed_array(host, message)
+    
+    assert stego.extract_array(stego_image) == message
+    assert np.abs(stego_image.astype(np.int16) - host).max() <= 3
+    assert np.array_equal(stego._detect_edges(stego_image), stego._detect_edges(host))
+    
+    # Pixel edge mang 2 bits/kênh: capacity vượt 1 bit/sample
+    assert result['capacity'] > host.size
+
+
+@pytest.mark.parametrize('k', [1, 2, 3, 4])
+@pytest.mark.parametrize('pseudorandom', [False, True])
+def test_kbit_opap_round_trip(host, k, pseudorandom):
+    payload = np.random.default_rng(k).bytes(20000)
+    stego = LSB_Stego(bits_per_channel=k, use_pseudorandom=pseudorandom)
+    stego_image, result = stego.embed_array(host, payload)
+    
+    assert stego.extract_array(stego_image) == payload
+    assert LSB_Stego().extract_auto_array(stego_image)['bits_per_channel'] == k
+    # OPAP: sai số mỗi sample không vượt 2^(k-1)
+    assert np.abs(stego_image.astype(np.int16) - host).max() <= 2 ** (k - 1)
+
+
+@pytest.mark.parametrize('k', [1, 2, 3])
+def test_kbit_psnr_estimate_matches_measurement(host, k):
+    stego = LSB_Stego(bits_per_channel=k)
+    payload_bytes = host.size * k // 8 // 2
+    stego_image, _ = stego.embed_array(host, np.random.default_rng(0).bytes(payload_bytes))
+    
+    mse = np.mean((stego_image.astype(np.float64) - host) ** 2)
+    measured = 10 * np.log10(255.0 ** 2 / mse)
+    assert stego._estimate_psnr(k, host.size, payload_bytes) == pytest.approx(measured, abs=0.2)
+
+
+def test_binary_payload_round_trips_as_raw_bytes(host):
+    payload = bytes(range(256)) * 4
+    stego = LSB_Stego()
+    stego_image, result = stego.embed_array(host, payload)
+    
+    extracted = stego.extract_array(stego_image)
+    assert isinstance(extracted, bytes) and extracted == payload
+    assert result['is_file'] and result['payload_bytes'] == len(payload)
+
+
+@pytest.mark.parametrize('message', ["lặp lại " * 500, b"\x00\x01" * 3000])
+def test_compressed_payload_round_trip(host, message):
+    stego = LSB_Stego(use_compression=True)
+    stego_image, result = stego.embed_array(host, message)
+    
+    assert stego.extract_array(stego_image) == message
+    assert result['compression'] is not None
+    assert result['payload_bytes'] < len(message.encode('utf-8') if isinstance(message, str) else message)
+
+
+def _encrypted_stego(host, payload, password="mật khẩu", chunk_size=1024):
+    """Ảnh stego mã hóa AES-GCM với chunk nhỏ (nhiều chunks trên ảnh test)"""
+    stego = LSB_Stego(use_encryption=True, password=password)
+    stego.STREAM_CHUNK_SIZE = chunk_size
+    return stego.embed_array(host, payload)
+
+
+def test_chunked_aes_gcm_round_trip(host):
+    payload = np.random.default_rng(0).bytes(10 * 1024 + 17)
+    stego_image, result = _encrypted_stego(host, payload)
+    
+    chunks = -(-len(payload) // 1024)
+    assert result['payload_bytes'] == LSB_Stego.ENCRYPTION_PREAMBLE.size + len(payload) + chunks * 16
+    # Kích thước chunk đọc từ preamble, không phụ thuộc cấu hình của bên trích xuất
+    assert LSB_Stego(use_encryption=True, password="mật khẩu").extract_array(stego_image) == payload
+
+
+def test_chunked_aes_gcm_rejects_wrong_password_and_tampering(host):
+    stego_image, result = _encrypted_stego(host, "bí mật".encode("utf-8") * 500)
+    
+    with pytest.raises(ValueError):
+        LSB_Stego(use_encryption=True, password="sai").extract_array(stego_image)
+    with pytest.raises(ValueError, match="Password"):
+        LSB_Stego().extract_array(stego_image)
+    
+    # Đổi 1 bit ciphertext của chunk thứ 2
+    tampered = stego_image.copy()
+    tampered.reshape(-1)[LSB_Stego.HEADER_BITS + (LSB_Stego.ENCRYPTION_PREAMBLE.size + 1024 + 16 + 5) * 8] ^= 1
+    with pytest.raises(ValueError):
+        LSB_Stego(use_encryption=True, password="mật khẩu").extract_array(tampered)
+
+
+@pytest.mark.parametrize('config, mode, k', [
+    ({}, 'Standard-LSB', 1),
+    ({'bits_per_channel': 3}, 'Standard-LSB', 3),
+    ({'use_pseudorandom': True}, 'Pseudorandom-LSB', 1),
+    ({'use_adaptive': True}, 'Adaptive-LSB', 1),
+])
+def test_extract_auto_detects_mode(host, config, mode, k):
+    stego_image, _ = LSB_Stego(**config).embed_array(host, "dò mode")
+    
+    probe = LSB_Stego().extract_auto_array(stego_image)
+    assert (probe['message'], probe['mode'], probe['bits_per_channel'], probe['format']) == \
+        ("dò mode", mode, k, f'v{LSB_Stego.HEADER_VERSION}')
+    assert probe['encrypted'] is False
+
+
+def test_extract_auto_reports_encryption(host):
+    stego_image, _ = _encrypted_stego(host, "mã hóa")
+    probe = LSB_Stego(use_encryption=True, password="mật khẩu").extract_auto_array(stego_image)
+    assert probe['message'] == "mã hóa" and probe['encrypted']
+
+
+@pytest.mark.parametrize('config', [{}, {'bits_per_channel': 2}, {'use_encryption': True, 'password': 'pw'}])
+def test_capacity_preflight_max_bytes_is_exact(host, tmp_path, config):
+    cover = str(tmp_path / 'cover.png')
+    cv2.imwrite(cover, host)
+    stego = LSB_Stego(**config)
+    report = stego.analyze_capacity(cover, include_adaptive=False, payload_bytes=10)
+    
+    k = config.get('bits_per_channel', 1)
+    max_bytes = report['bits_per_channel'][k - 1]['max_bytes']
+    assert report['bits_per_channel'][k - 1]['fits']
+    stego.embed_array(host, bytes(max_bytes))
+    with pytest.raises(ValueError, match="too large"):
+        stego.embed_array(host, bytes(max_bytes + 1))
+
+
+def test_capacity_preflight_caches_adaptive_edge_analysis(host, tmp_path):
+    cover = str(tmp_path / 'cover.png')
+    cv2.imwrite(cover, host)
+    edge_map_cache.clear()
+    stego = LSB_Stego(use_adaptive=True)
+    
+    report = stego.analyze_capacity(cover)
+    assert edge_map_cache.stats()['misses'] == 1
+    stego_image, result = stego.embed_array(host, "dùng lại edge map")
+    assert result['capacity'] == report['adaptive']['capacity_bits']
+    stego.extract_array(stego_image)
+    assert edge_map_cache.stats() == {'entries': 1, 'maxsize': edge_map_cache.maxsize, 'hits': 2, 'misses': 1}
+
+
+def test_bytes_entry_points_match_path_methods(host, tmp_path):
+    cover, output = str(tmp_path / 'cover.png'), str(tmp_path / 'stego.png')
+    cv2.imwrite(cover, host)
+    stego = LSB_Stego(use_pseudorandom=True, bits_per_channel=2)
+    
+    result = stego.embed(cover, "bytes và path", output)
+    with open(cover, 'rb') as f:
+        stego_png, bytes_result = stego.embed_bytes(f.read(), "bytes và path")
+    with open(output, 'rb') as f:
+        assert np.array_equal(decode_image(stego_png), decode_image(f.read()))
+    assert {key: value for key, value in bytes_result.items() if key != 'output_path'} == \
+        {key: value for key, value in result.items() if key != 'output_path'}
+    
+    assert stego.extract_bytes(stego_png) == stego.extract(output) == "bytes và path"
+    assert stego.extract_auto(output)['message'] == "bytes và path"
+
+
+def test_capacity_preflight_accepts_bytes_and_arrays(host, tmp_path):
+    cover = str(tmp_path / 'cover.png')
+    cv2.imwrite(cover, host)
+    stego = LSB_Stego()
+    
+    from_path = stego.analyze_capacity(cover, payload_bytes=500)
+    with open(cover, 'rb') as f:
+        assert stego.analyze_capacity(f.read(), payload_bytes=500) == from_path
+    assert stego.analyze_capacity(host, payload_bytes=500) == from_path
+    with pytest.raises(ValueError, match="Cannot read image"):
+        stego.analyze_capacity(b'not an image')
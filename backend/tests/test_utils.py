@@ -0,0 +1,131 @@
+"""
+core/utils: Arnold Cat Map, fused quality metrics (so với skimage), process pool dùng chung, apply_attack
+"""
+
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+import pytest
+from skimage.metrics import mean_squared_error, peak_signal_noise_ratio, structural_similarity
+
+from app.core.utils import apply_attack, arnold_cat_map, arnold_period, calculate_quality_metrics, calculate_ssim, \
+    calculate_ssim_rows, inverse_arnold_cat_map, parse_metrics, process_map, shared_process_pool
+
+
+def _arnold_naive(image, iterations):
+    """Arnold Cat Map từng pixel (công thức gốc): [x', y'] = [[1,1],[1,2]] * [x, y] mod N"""
+    N = image.shape[0]
+    result = image.copy()
+    for _ in range(iterations):
+        scrambled = np.zeros_like(result)
+        for x in range(N):
+            for y in range(N):
+                scrambled[(x + y) % N, (x + 2 * y) % N] = result[x, y]
+        result = scrambled
+    return result
+
+
+@pytest.mark.parametrize('N', [1, 2, 5, 24, 32])
+def test_arnold_permutation_matches_naive_map(N):
+    image = np.random.default_rng(N).integers(0, 256, (N, N, 3), dtype=np.uint8)
+    assert np.array_equal(arnold_cat_map(image, 7), _arnold_naive(image, 7))
+
+
+@pytest.mark.parametrize('N', [2, 24, 32, 50])
+def test_arnold_period_and_inverse(N):
+    image = np.arange(N * N, dtype=np.int64).reshape(N, N)
+    period = arnold_period(N)
+    
+    assert np.array_equal(arnold_cat_map(image, period), image)
+    assert not np.array_equal(arnold_cat_map(image, 1), image)
+    assert np.array_equal(inverse_arnold_cat_map(arnold_cat_map(image, 10), 10), image)
+    # Số lần lặp được rút gọn theo chu kỳ
+    assert np.array_equal(arnold_cat_map(image, period * 1000 + 3), arnold_cat_map(image, 3))
+
+
+def test_arnold_rejects_non_square_image():
+    with pytest.raises(ValueError):
+        arnold_cat_map(np.zeros((4, 6), dtype=np.uint8))
+
+
+@pytest.fixture
+def noisy_pair(host_factory):
+    """(ảnh gốc 600x800, ảnh thêm nhiễu Gauss sigma 4)"""
+    original = host_factory(600, 800)
+    noise = np.random.default_rng(1).normal(0, 4, original.shape)
+    return original, np.clip(original + noise, 0, 255).astype(np.uint8)
+
+
+def test_fused_metrics_match_skimage(noisy_pair):
+    original, modified = noisy_pair
+    report = calculate_quality_metrics(original, modified)
+    
+    modified_gray = cv2.cvtColor(modified, cv2.COLOR_BGR2GRAY)
+    data_range = int(modified_gray.max()) - int(modified_gray.min())
+    expected_ssim = structural_similarity(cv2.cvtColor(original, cv2.COLOR_BGR2GRAY), modified_gray,
+                                          data_range=data_range)
+    
+    assert list(report) == ['psnr', 'ssim', 'mse']
+    assert report['mse'] == pytest.approx(mean_squared_error(original, modified))
+    assert report['psnr'] == pytest.approx(peak_signal_noise_ratio(original, modified))
+    assert report['ssim'] == pytest.approx(expected_ssim, abs=1e-6)
+
+
+def test_metric_selection(noisy_pair):
+    original, modified = noisy_pair
+    assert parse_metrics('SSIM, psnr') == ('psnr', 'ssim')
+    assert list(calculate_quality_metrics(original, modified, 'mse')) == ['mse']
+    assert calculate_quality_metrics(original, original, ('psnr',)) == {'psnr': float('inf')}
+    with pytest.raises(ValueError, match="Unknown metrics"):
+        parse_metrics('psnr,vmaf')
+
+
+def test_ssim_rows_sum_to_full_ssim(noisy_pair):
+    original, modified = noisy_pair
+    modified_gray = cv2.cvtColor(modified, cv2.COLOR_BGR2GRAY)
+    data_range = int(modified_gray.max()) - int(modified_gray.min())
+    parts = [calculate_ssim_rows(original, modified, y0, y0 + 77, data_range) for y0 in range(0, 600, 77)]
+    
+    total = sum(part[0] for part in parts) / sum(part[1] for part in parts)
+    assert total == pytest.approx(calculate_ssim(original, modified), abs=1e-6)
+
+
+def test_fast_ssim_estimates_full_ssim(host, noisy_pair):
+    # Ảnh nhỏ (cạnh ngắn < 1.5 * SSIM_FAST_SIZE): fast SSIM tính trên toàn ảnh
+    assert calculate_ssim(host, host // 2 * 2, fast=True) == calculate_ssim(host, host // 2 * 2)
+    
+    original, modified = noisy_pair
+    large_original = cv2.resize(original, (1600, 1200), interpolation=cv2.INTER_NEAREST)
+    large_modified = cv2.resize(modified, (1600, 1200), interpolation=cv2.INTER_NEAREST)
+    assert calculate_ssim(large_original, large_modified, fast=True) == \
+        pytest.approx(calculate_ssim(large_original, large_modified), abs=0.005)
+
+
+def test_process_map_keeps_order_and_shares_one_pool_between_callers():
+    expected = [math.factorial(n) for n in range(40)]
+    assert process_map(math.factorial, range(40), 1) == expected
+    pool = shared_process_pool()
+    
+    # Các lần gọi đồng thời với số workers khác nhau không shutdown pool của nhau
+    with ThreadPoolExecutor(max_workers=4) as threads:
+        results = list(threads.map(lambda workers: process_map(math.factorial, range(40), workers), [2, 3, 8, 16]))
+    assert results == [expected] * 4
+    assert shared_process_pool() is pool
+    
+    with pytest.raises(ValueError):
+        process_map(math.factorial, [3, -1, 4], 2)
+    assert process_map(math.factorial, [5, 6], 2) == [120, 720]
+
+
+def test_gaussian_noise_saturates_instead_of_wrapping():
+    np.random.seed(0)
+    black = apply_attack(np.zeros((64, 64, 3), dtype=np.uint8), 'gaussian_noise', std=25)
+    white = apply_attack(np.full((64, 64, 3), 255, dtype=np.uint8), 'gaussian_noise', std=25)
+    gray = apply_attack(np.full((64, 64, 3), 128, dtype=np.uint8), 'gaussian_noise', std=5)
+    
+    # Nhiễu âm trên pixel 0 (và nhiễu dương trên pixel 255) bị clip, không tràn sang đầu kia của uint8
+    assert black.dtype == np.uint8 and black.max() < 128 and np.mean(black == 0) > 0.4
+    assert white.min() > 128 and np.mean(white == 255) > 0.4
+    assert abs(float(gray.mean()) - 128) < 1 and gray.min() > 100 and gray.max() < 156
@@ -0,0 +1,36 @@
+"""
+VideoWatermark: key frames được nhúng trực tiếp trên frame đã decode (embed_frame)
+"""
+
+import cv2
+import numpy as np
+
+from app.core.video_proc import VideoWatermark
+
+
+def test_video_embed_uses_frame_plan(host_factory, watermark, tmp_path):
+    video_path, output_path = str(tmp_path / 'video.mp4'), str(tmp_path / 'watermarked.mp4')
+    watermark_path = str(tmp_path / 'watermark.png')
+    cv2.imwrite(watermark_path, watermark)
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'mp4v'), 10, (320, 256))
+    for index in range(12):
+        writer.write(host_factory(256, 320, seed=index % 2))
+    writer.release()
+    
+    video = VideoWatermark(frame_skip=5, use_scene_detection=False)
+    result = video.embed(video_path, watermark_path, output_path, with_reference=True, frame_metrics=True)
+    reference = result['reference']
+    
+    assert (result['watermarked_frames'], sorted(reference.frames)) == (3, [0, 5, 10])
+    assert set(result['quality_metrics']) == {'psnr', 'ssim', 'mse'}
+    
+    # S[0] gốc trong bản ghi tham chiếu = S[0] của frame đã decode (embed_frame)
+    capture = cv2.VideoCapture(video_path)
+    capture.set(cv2.CAP_PROP_POS_FRAMES, 5)
+    _, frame = capture.read()
+    capture.release()
+    watermarker = video.watermarker
+    _, original_s0, _ = watermarker.embed_frame(frame, watermarker.plan_frames(watermark, 256, 320))
+    np.testing.assert_allclose(reference.original_s0(5), original_s0, rtol=1e-6)
+    
+    assert 'quality_metrics' not in video.embed(video_path, watermark_path, output_path)
@@ -0,0 +1,212 @@
+"""
+DWT_DCT_SVD_Watermark: engine theo lô, trích xuất, QIM, cache và các đường nhúng song song / theo tile
+"""
+
+import cv2
+import numpy as np
+import pytest
+
+from app.core import watermarking
+from app.core.utils import apply_attack, calculate_nc, create_image_memmap, decode_image, encode_image, inspect_image, \
+    open_image_memmap, tifffile
+from app.core.watermarking import DWT_DCT_SVD_Watermark, DWT_DCT_SVD_QIM_Watermark, PreparedWatermarkCache
+
+
+def _expected_bits(watermarker, watermark, size):
+    """Watermark nhị phân mong đợi (0 / 255)"""
+    return watermarker._binary_watermark(cv2.cvtColor(watermark, cv2.COLOR_BGR2GRAY), size) * 255
+
+
+def test_batched_block_engine_matches_per_block_svd():
+    watermarker = DWT_DCT_SVD_Watermark(alpha=0.1)
+    rng = np.random.default_rng(0)
+    band = rng.uniform(0, 255, (64, 80)).astype(np.float32)
+    bits = rng.integers(0, 2, 70)
+    
+    batched = band.copy()
+    s0 = watermarker._embed_blocks(batched, bits)
+    
+    # Vòng lặp gốc: DCT -> SVD đầy đủ -> đổi S[0] -> IDCT trên từng block (float64)
+    expected = band.astype(np.float64)
+    expected_s0 = []
+    for index, bit in enumerate(bits):
+        rows, columns = divmod(index, 10)
+        block = expected[rows * 8:(rows + 1) * 8, columns * 8:(columns + 1) * 8]
+        dct_block = watermarker._dct2(block)
+        expected_s0.append(np.linalg.svd(dct_block, compute_uv=False)[0])
+        block[:] = watermarker._idct2(watermarker._embed_svd(dct_block, bit))
+    
+    np.testing.assert_allclose(s0, expected_s0, rtol=1e-4)
+    assert np.abs(batched - expected).max() < 0.05
+
+
+def test_top_singular_value_matches_full_svd():
+    watermarker = DWT_DCT_SVD_Watermark()
+    rng = np.random.default_rng(1)
+    blocks = rng.uniform(0, 255, (200, 8, 8)).astype(np.float32)
+    # Blocks có S0 ~ S1 (không hội tụ nhanh) phải được tính lại bằng SVD đầy đủ
+    blocks[:20] = np.eye(8, dtype=np.float32) * 100 + rng.normal(0, 1e-3, (20, 8, 8)).astype(np.float32)
+    
+    s0 = watermarker._block_s0(blocks.transpose(1, 0, 2).reshape(8, -1), len(blocks))
+    np.testing.assert_allclose(s0, np.linalg.svd(blocks.astype(np.float64), compute_uv=False)[:, 0], rtol=1e-4)
+
+
+def test_extraction_with_original_recovers_watermark(host, watermark):
+    watermarker = DWT_DCT_SVD_Watermark()
+    watermarked, result = watermarker.embed_array(host, watermark)
+    size = int(result['watermark_size'].split('x')[0])
+    
+    extracted, ratios = watermarker.extract_array(watermarked, host, watermark_size=size, return_confidence=True)
+    assert calculate_nc(_expected_bits(watermarker, watermark, size), extracted) == 1.0
+    assert np.array_equal(extracted > 127, ratios > 1)
+
+
+def test_qim_modulation_lands_on_bit_lattice():
+    watermarker = DWT_DCT_SVD_QIM_Watermark(quantization_step=40.0)
+    s0 = np.random.default_rng(2).uniform(50, 2000, 500).astype(np.float32)
+    bits = np.arange(500) % 2
+    
+    modulated = watermarker._modulate(s0, bits)
+    fraction = np.mod(modulated / 40.0, 1)
+    assert np.allclose(np.minimum(fraction, 1 - fraction)[bits == 0], 0, atol=1e-4)
+    assert np.allclose(np.abs(fraction - 0.5)[bits == 1], 0, atol=1e-4)
+    assert np.abs(modulated - s0).max() <= 20.0 + 1e-3
+
+
+def test_qim_blind_extraction(host, watermark):
+    watermarker = DWT_DCT_SVD_QIM_Watermark()
+    watermarked, result = watermarker.embed_array(host, watermark)
+    size = int(result['watermark_size'].split('x')[0])
+    expected = _expected_bits(watermarker, watermark, size)
+    
+    # Không cần ảnh gốc hay kích thước watermark
+    assert calculate_nc(expected, watermarker.extract_array(watermarked)) == 1.0
+    attacked = apply_attack(watermarked, 'jpeg_compression', quality=75)
+    assert calculate_nc(expected, watermarker.extract_array(attacked)) > 0.95
+
+
+def test_prepared_watermark_cache_keys_on_content(host, watermark, monkeypatch, tmp_path):
+    cache = PreparedWatermarkCache(maxsize=2, disk_dir=str(tmp_path))
+    monkeypatch.setattr(watermarking, 'prepared_watermark_cache', cache)
+    watermarker = DWT_DCT_SVD_Watermark()
+    
+    first, _ = watermarker.embed_array(host, watermark)
+    # Bản sao khác object nhưng cùng nội dung -> hit, kết quả giống hệt
+    second, _ = watermarker.embed_array(host, watermark.copy())
+    assert np.array_equal(first, second)
+    assert (cache.hits, cache.misses) == (1, 1)
+    
+    changed = watermark.copy()
+    changed[0, 0] ^= 0xFF
+    assert cache.content_key(changed, 16, 10) != cache.content_key(watermark, 16, 10)
+    assert cache.content_key(watermark, 16, 10) != cache.content_key(watermark, 16, 11)
+    
+    # Tầng đĩa dùng lại được từ một cache mới (process khác)
+    key = cache.content_key(watermark, 16, 10)
+    cache.put(key, np.eye(16))
+    fresh = PreparedWatermarkCache(disk_dir=str(tmp_path))
+    assert np.array_equal(fresh.get(key), np.eye(16)) and fresh.stats()['disk_hits'] == 1
+    
+    # LRU: vượt maxsize loại entry ít dùng nhất
+    lru = PreparedWatermarkCache(maxsize=2)
+    keys = [lru.content_key(watermark, size, 10) for size in (4, 8, 16)]
+    lru.put(keys[0], np.zeros((4, 4)))
+    lru.put(keys[1], np.zeros((8, 8)))
+    lru.get(keys[0])
+    lru.put(keys[2], np.zeros((16, 16)))
+    assert lru.get(keys[1]) is None and lru.get(keys[0]) is not None
+
+
+@pytest.mark.parametrize('extension', [
+    '.npy',
+    pytest.param('.tif', marks=pytest.mark.skipif(tifffile is None, reason="tifffile is not installed")),
+])
+def test_tiled_embed_matches_frame_strip(host_factory, watermark, tmp_path, extension):
+    host = host_factory(600, 1000)
+    host_path, output_path = str(tmp_path / f'host{extension}'), str(tmp_path / f'out{extension}')
+    watermark_path = str(tmp_path / 'watermark.png')
+    image, finalize = create_image_memmap(host_path, host.shape)
+    image[:] = host
+    finalize()
+    cv2.imwrite(watermark_path, watermark)
+    assert inspect_image(host_path) == (600, 1000, True)
+    
+    watermarker = DWT_DCT_SVD_Watermark()
+    plan = watermarker.plan_frames(watermark, 600, 1000)
+    frame, _, _ = watermarker.embed_frame(host, plan)
+    write_rows = plan['strip'][0]
+    
+    outputs = []
+    for tile_size in (64, 256, 2048):
+        result = watermarker.embed_tiled(host_path, watermark_path, output_path, tile_size=tile_size)
+        output = np.array(open_image_memmap(output_path))
+        # Dải watermark giống hệt embed_frame, ngoài dải (và lề filter) giữ nguyên pixels gốc
+        assert np.array_equal(output[:write_rows], frame[:write_rows])
+        assert np.array_equal(output[write_rows + 8:], host[write_rows + 8:])
+        # Tile rộng tile_size pixels = tile_size / 2 cột của sub-band (500 cột)
+        assert result['tiles_watermarked'] == -(-500 // (tile_size // 2))
+        outputs.append(output)
+    assert all(np.array_equal(outputs[0], output) for output in outputs[1:])
+    
+    size = int(result['watermark_size'].split('x')[0])
+    assert np.array_equal(watermarker.extract_array(outputs[0], host, watermark_size=size),
+                          watermarker.extract_array(frame, host, watermark_size=size))
+
+
+def test_inspect_image_reads_header_only_formats(host, tmp_path):
+    cv2.imwrite(str(tmp_path / 'host.png'), host)
+    (tmp_path / 'broken.tif').write_bytes(b'not an image')
+    assert inspect_image(str(tmp_path / 'host.png')) == (256, 320, False)
+    assert inspect_image(str(tmp_path / 'broken.tif')) is None
+
+
+def test_bytes_entry_points_match_path_methods(host, watermark, tmp_path):
+    paths = {name: str(tmp_path / f'{name}.png') for name in ('host', 'watermark', 'output')}
+    cv2.imwrite(paths['host'], host)
+    cv2.imwrite(paths['watermark'], watermark)
+    watermarker = DWT_DCT_SVD_Watermark()
+    
+    result = watermarker.embed(paths['host'], paths['watermark'], paths['output'])
+    watermarked_png, bytes_result = watermarker.embed_bytes(encode_image(host, '.png'), encode_image(watermark, '.png'))
+    assert np.array_equal(decode_image(watermarked_png), cv2.imread(paths['output']))
+    assert bytes_result['quality_metrics'] == result['quality_metrics']
+    
+    size = int(result['watermark_size'].split('x')[0])
+    from_path = watermarker.extract(paths['output'], paths['host'], watermark_size=size)
+    from_bytes = watermarker.extract_bytes(watermarked_png, encode_image(host, '.png'), watermark_size=size)
+    assert np.array_equal(from_path, from_bytes)
+    assert calculate_nc(_expected_bits(watermarker, watermark, size), from_bytes) == 1.0
+
+
+@pytest.mark.parametrize('settings', [{}, {'wavelet': 'db2'}, {'use_dwt': False}])
+def test_embed_frame_strip_matches_embed_array(host_factory, watermark, settings):
+    host = host_factory(480, 640)
+    watermarker = DWT_DCT_SVD_Watermark(**settings)
+    expected, result = watermarker.embed_array(host, watermark)
+    
+    plan = watermarker.plan_frames(watermark, 480, 640)
+    frame, _, quality = watermarker.embed_frame(host, plan)
+    write_rows = plan['strip'][0]
+    
+    # Dải chứa các blocks giống hệt embed_array, phần còn lại giữ nguyên pixels gốc
+    assert quality is None
+    assert np.array_equal(frame[:write_rows], expected[:write_rows])
+    assert np.array_equal(frame[write_rows:], host[write_rows:])
+    
+    size = int(result['watermark_size'].split('x')[0])
+    assert np.array_equal(watermarker.extract_array(frame, host, watermark_size=size),
+                          watermarker.extract_array(expected, host, watermark_size=size))
+
+
+def test_embed_frame_odd_size_and_plan_mismatch(host_factory, watermark):
+    host = host_factory(301, 401)
+    watermarker = DWT_DCT_SVD_Watermark()
+    plan = watermarker.plan_frames(watermark, 301, 401)
+    assert plan['strip'] is None
+    
+    frame, _, quality = watermarker.embed_frame(host, plan, with_metrics=True)
+    expected, result = watermarker.embed_array(host, watermark)
+    assert np.array_equal(frame, expected)
+    assert quality == result['quality_metrics']
+    with pytest.raises(ValueError, match="does not match the plan"):
+        watermarker.embed_frame(host_factory(300, 400), plan)